@@ -0,0 +1,188 @@
+"""
+QEMU machine group module:
+
+The group module provides the QEMUMachineGroup class, which launches and
+shuts down many QEMU VMs concurrently.
+"""
+
+# Copyright (C) 2019 Red Hat Inc.
+#
+# This work is licensed under the terms of the GNU GPL, version 2.  See
+# the COPYING file in the top-level directory.
+#
+
+import logging
+import threading
+import time
+
+from .machine import QEMUMachineError
+
+LOG = logging.getLogger(__name__)
+
+
+class QEMUMachineGroupError(QEMUMachineError):
+    """
+    Exception raised when some VMs of a group could not be launched
+    """
+    def __init__(self, errors):
+        super(QEMUMachineGroupError, self).__init__(
+            '%d of the VMs failed to launch: %s' %
+            (len(errors), '; '.join(str(err) for _, err in errors)))
+        self.errors = errors
+
+
+class QEMUMachineGroup(object):
+    """
+    A group of QEMU VMs that are launched and shut down together
+
+    Use this object as a context manager to ensure all QEMU processes
+    terminate::
+
+        with QEMUMachineGroup() as group:
+            for i in range(64):
+                group.add(QEMUMachine(binary, name='vm%d' % i))
+            group.launch()
+            ...
+        # all VMs are guaranteed to be shut down here
+
+    VMs are launched concurrently, so they must not share any file or
+    socket names.
+    """
+
+    #: Interval between checks for exited VMs during shutdown, in seconds
+    poll_interval = 0.01
+
+    def __init__(self, machines=None, timeout=30.0, max_parallel=None):
+        '''
+        Initialize a QEMUMachineGroup
+
+        @param machines: list of QEMUMachine objects to add to the group
+        @param timeout: default number of seconds a VM is given to exit
+                        after "quit" before it is killed
+        @param max_parallel: maximum number of VMs being launched at the
+                             same time (default: unlimited)
+        '''
+        self._machines = []
+        self._timeouts = {}
+        self._timeout = timeout
+        self._max_parallel = max_parallel
+        for vm in machines or []:
+            self.add(vm)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.shutdown()
+        return False
+
+    def __iter__(self):
+        return iter(self._machines)
+
+    def __len__(self):
+        return len(self._machines)
+
+    def add(self, vm, timeout=None):
+        """
+        Add a VM to the group
+
+        @param timeout: seconds the VM is given to exit after "quit"
+                        (default: the timeout of the group)
+        """
+        self._machines.append(vm)
+        if timeout is not None:
+            self._timeouts[id(vm)] = timeout
+        return vm
+
+    def launch(self):
+        """
+        Launch all VMs of the group concurrently
+
+        QEMU startup and the QMP handshakes of all VMs overlap.  If any VM
+        fails to launch, all VMs of the group are shut down again.
+
+        @raise QEMUMachineGroupError listing the VMs that failed
+        """
+        errors = []
+        lock = threading.Lock()
+        if self._max_parallel:
+            slots = threading.BoundedSemaphore(self._max_parallel)
+        else:
+            slots = None
+
+        def _launch(vm):
+            try:
+                vm.launch()
+            except Exception as err:
+                with lock:
+                    errors.append((vm, err))
+            finally:
+                if slots:
+                    slots.release()
+
+        threads = []
+        for vm in self._machines:
+            if slots:
+                slots.acquire()
+            thread = threading.Thread(target=_launch, args=(vm,))
+            thread.daemon = True
+            thread.start()
+            threads.append(thread)
+        for thread in threads:
+            thread.join()
+
+        if errors:
+            self.shutdown()
+            raise QEMUMachineGroupError(errors)
+
+    def shutdown(self, has_quit=False):
+        """
+        Terminate all VMs of the group and clean up
+
+        "quit" is sent to every running VM from its own thread, so that a
+        wedged VM does not hold up the others, then all of them are waited
+        for at once.  VMs that have not exited when their timeout expires
+        are killed with SIGKILL.
+        """
+        def _quit(vm):
+            try:
+                vm._send_quit(has_quit)
+            except Exception as err:
+                LOG.debug('Error sending quit to VM %s: %s', vm.get_pid(), err)
+
+        start = time.time()
+        pending = []
+        threads = []
+        for vm in self._machines:
+            if vm.is_running():
+                thread = threading.Thread(target=_quit, args=(vm,))
+                thread.daemon = True
+                thread.start()
+                threads.append(thread)
+                deadline = start + self._timeouts.get(id(vm), self._timeout)
+                pending.append((vm, deadline))
+
+        killed = set()
+        while pending:
+            now = time.time()
+            still_pending = []
+            for vm, deadline in pending:
+                if vm.exitcode() is not None:
+                    continue
+                if now >= deadline:
+                    LOG.warning('VM %s did not quit in time, killing it',
+                                vm.get_pid())
+                    vm.kill()
+                    killed.add(id(vm))
+                    continue
+                still_pending.append((vm, deadline))
+            pending = still_pending
+            if pending:
+                time.sleep(self.poll_interval)
+
+        # Every QEMU process is gone, so no quit command can still block
+        for thread in threads:
+            thread.join()
+        for vm in self._machines:
+            if id(vm) not in killed:
+                vm.shutdown()
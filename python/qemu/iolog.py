@@ -0,0 +1,170 @@
+"""
+QEMU output log module:
+
+The iolog module provides the StreamingLog class, which captures the
+output of a QEMU process while it is running instead of reading it back
+from a file after it has exited.
+"""
+
+# Copyright (C) 2019 Red Hat Inc.
+#
+# This work is licensed under the terms of the GNU GPL, version 2.  See
+# the COPYING file in the top-level directory.
+#
+
+import collections
+import io
+import os
+import re
+import threading
+import time
+
+
+class StreamingLog(object):
+    """
+    Output of a QEMU process, captured by a background thread
+
+    The most recent lines are kept in a bounded ring buffer.  Optionally,
+    all output is also written to a spool file, which is rotated when it
+    grows too large.
+    """
+
+    def __init__(self, max_lines=10000, spool_path=None,
+                 spool_max_bytes=None, spool_backups=1):
+        '''
+        Initialize a StreamingLog
+
+        @param max_lines: number of lines kept in memory
+        @param spool_path: file that all output is written to (optional)
+        @param spool_max_bytes: size after which the spool file is rotated
+                                (default: never rotate)
+        @param spool_backups: number of rotated spool files to keep, named
+                              spool_path.1 (the newest) to
+                              spool_path.<spool_backups>
+        '''
+        self._lines = collections.deque(maxlen=max_lines)
+        # Number of lines read so far, including those dropped from _lines
+        self._count = 0
+        self._eof = False
+        self._cond = threading.Condition()
+        self._thread = None
+        self._spool_path = spool_path
+        self._spool_max_bytes = spool_max_bytes
+        self._spool_backups = spool_backups
+        self._spool = None
+
+    def start(self, stream):
+        """
+        Start reading lines from @stream, a binary file object, until EOF
+        """
+        self._lines.clear()
+        self._count = 0
+        self._eof = False
+        if self._spool_path is not None:
+            self._spool = io.open(self._spool_path, 'ab')
+        self._thread = threading.Thread(target=self._run, args=(stream,))
+        self._thread.daemon = True
+        self._thread.start()
+
+    def _rotate_spool(self):
+        self._spool.close()
+        for i in range(self._spool_backups - 1, 0, -1):
+            src = '%s.%d' % (self._spool_path, i)
+            if os.path.exists(src):
+                os.rename(src, '%s.%d' % (self._spool_path, i + 1))
+        if self._spool_backups > 0:
+            os.rename(self._spool_path, self._spool_path + '.1')
+        self._spool = io.open(self._spool_path, 'wb')
+
+    def _write_spool(self, data):
+        self._spool.write(data)
+        self._spool.flush()
+        if (self._spool_max_bytes is not None and
+                self._spool.tell() >= self._spool_max_bytes):
+            self._rotate_spool()
+
+    def _run(self, stream):
+        try:
+            for data in iter(stream.readline, b''):
+                if self._spool is not None:
+                    self._write_spool(data)
+                line = data.decode('utf-8', 'replace')
+                with self._cond:
+                    self._lines.append(line)
+                    self._count += 1
+                    self._cond.notify_all()
+        finally:
+            stream.close()
+            if self._spool is not None:
+                self._spool.close()
+                self._spool = None
+            with self._cond:
+                self._eof = True
+                self._cond.notify_all()
+
+    def join(self, timeout=None):
+        """
+        Wait until the end of the output has been reached
+        """
+        if self._thread is not None:
+            self._thread.join(timeout)
+
+    def getvalue(self):
+        """
+        Return the lines currently held in memory as a single string
+        """
+        with self._cond:
+            return ''.join(self._lines)
+
+    def lines(self, follow=True, timeout=None):
+        """
+        Iterate over the output, one line at a time
+
+        Iteration starts at the oldest line held in memory.  Lines that are
+        dropped from the ring buffer before the iterator gets to them are
+        skipped.
+
+        @param follow: keep waiting for new lines until the end of the
+                       output; if False, stop at the last line read so far
+        @param timeout: seconds after which to stop waiting for new lines,
+                        or None to wait indefinitely
+        """
+        deadline = None
+        if timeout is not None:
+            deadline = time.time() + timeout
+        with self._cond:
+            position = self._count - len(self._lines)
+        while True:
+            with self._cond:
+                while follow and position >= self._count and not self._eof:
+                    remaining = None
+                    if deadline is not None:
+                        remaining = deadline - time.time()
+                        if remaining <= 0:
+                            return
+                    self._cond.wait(remaining)
+                first = self._count - len(self._lines)
+                position = max(position, first)
+                if position >= self._count:
+                    return
+                line = self._lines[position - first]
+            position += 1
+            yield line
+
+    def wait_for(self, pattern, timeout=None):
+        """
+        Wait for a line of output matching a regular expression
+
+        Lines already held in memory are searched first.
+
+        @param pattern: regular expression, as a string or compiled
+        @param timeout: seconds to wait, or None to wait indefinitely
+        @return the match object, or None if the output ended or the
+                timeout expired without a match
+        """
+        regex = re.compile(pattern)
+        for line in self.lines(timeout=timeout):
+            match = regex.search(line)
+            if match:
+                return match
+        return None
@@ -18,14 +18,17 @@ which provides facilities for managing the lifetime of a QEMU VM.
 #
 
 import errno
+import json
 import logging
 import os
 import subprocess
 import shutil
 import socket
 import tempfile
+import time
 
 from . import qmp
+from .iolog import StreamingLog
 
 LOG = logging.getLogger(__name__)
 
@@ -58,6 +61,66 @@ class MonitorResponseError(qmp.QMPError):
         self.reply = reply
 
 
+class QEMUMachineLaunchTiming(object):
+    """
+    Timestamps of the steps of a VM launch
+
+    Stages are recorded in the order given by STAGES:
+     - start: launch() was called
+     - temp-dir: the temporary directory was created
+     - popen: the QEMU process was started
+     - accept: QEMU connected to the QMP socket
+     - greeting: the QMP greeting was received
+     - capabilities: the qmp_capabilities command completed
+     - first-command: the first QMP command after launch completed
+    """
+
+    STAGES = ('start', 'temp-dir', 'popen', 'accept', 'greeting',
+              'capabilities', 'first-command')
+
+    def __init__(self):
+        self.timestamps = {}
+
+    def mark(self, stage, when=None):
+        """
+        Record the time at which a stage was reached
+        """
+        if when is None:
+            when = time.time()
+        self.timestamps[stage] = when
+
+    def offsets(self):
+        """
+        Return a list of (stage, seconds since start) tuples, in order,
+        for all stages reached so far
+        """
+        start = self.timestamps.get('start')
+        if start is None:
+            return []
+        return [(stage, self.timestamps[stage] - start)
+                for stage in self.STAGES if stage in self.timestamps]
+
+    def steps(self):
+        """
+        Return a list of (stage, seconds since the previous stage) tuples,
+        in order, for all stages reached so far
+        """
+        result = []
+        previous = 0.0
+        for stage, offset in self.offsets():
+            result.append((stage, offset - previous))
+            previous = offset
+        return result
+
+    def to_dict(self):
+        """
+        Return the timing information as a dict suitable for JSON
+        """
+        return {'start': self.timestamps.get('start'),
+                'offsets': dict(self.offsets()),
+                'steps': dict(self.steps())}
+
+
 class QEMUMachine(object):
     """
     A QEMU VM
@@ -69,6 +132,9 @@ class QEMUMachine(object):
         # vm is guaranteed to be shut down here
     """
 
+    #: Seconds to wait at shutdown for the end of a streaming log
+    output_log_timeout = 10.0
+
     def __init__(self, binary, args=None, wrapper=None, name=None,
                  test_dir="/var/tmp", monitor_address=None,
                  socket_scm_helper=None):
@@ -103,6 +169,7 @@ class QEMUMachine(object):
         self._iolog = None
         self._socket_scm_helper = socket_scm_helper
         self._qmp = None
+        self._qmp_set = True   # Enable QMP monitor by default.
         self._qemu_full_args = None
         self._test_dir = test_dir
         self._temp_dir = None
@@ -112,6 +179,10 @@ class QEMUMachine(object):
         self._console_device_type = None
         self._console_address = None
         self._console_socket = None
+        self._launch_timing = None
+        self._timing_log_path = None
+        self._timing_log_pending = False
+        self._output_log = None
 
         # just in case logging wasn't configured by the main script:
         logging.basicConfig()
@@ -219,20 +290,24 @@ class QEMUMachine(object):
         return self._popen.pid
 
     def _load_io_log(self):
-        if self._qemu_log_path is not None:
+        if self._output_log is not None:
+            self._output_log.join(self.output_log_timeout)
+            self._iolog = self._output_log.getvalue()
+        elif self._qemu_log_path is not None:
             with open(self._qemu_log_path, "r") as iolog:
                 self._iolog = iolog.read()
 
     def _base_args(self):
-        if isinstance(self._monitor_address, tuple):
-            moncdev = "socket,id=mon,host=%s,port=%s" % (
-                self._monitor_address[0],
-                self._monitor_address[1])
-        else:
-            moncdev = 'socket,id=mon,path=%s' % self._vm_monitor
-        args = ['-chardev', moncdev,
-                '-mon', 'chardev=mon,mode=control',
-                '-display', 'none', '-vga', 'none']
+        args = ['-display', 'none', '-vga', 'none']
+        if self._qmp_set:
+            if isinstance(self._monitor_address, tuple):
+                moncdev = "socket,id=mon,host=%s,port=%s" % (
+                    self._monitor_address[0],
+                    self._monitor_address[1])
+            else:
+                moncdev = 'socket,id=mon,path=%s' % self._vm_monitor
+            args.extend(['-chardev', moncdev, '-mon',
+                         'chardev=mon,mode=control'])
         if self._machine is not None:
             args.extend(['-machine', self._machine])
         if self._console_set:
@@ -250,19 +325,26 @@ class QEMUMachine(object):
 
     def _pre_launch(self):
         self._temp_dir = tempfile.mkdtemp(dir=self._test_dir)
+        self._launch_timing.mark('temp-dir')
         if self._monitor_address is not None:
             self._vm_monitor = self._monitor_address
         else:
             self._vm_monitor = os.path.join(self._temp_dir,
                                             self._name + "-monitor.sock")
-        self._qemu_log_path = os.path.join(self._temp_dir, self._name + ".log")
-        self._qemu_log_file = open(self._qemu_log_path, 'wb')
+        if self._output_log is None:
+            self._qemu_log_path = os.path.join(self._temp_dir,
+                                               self._name + ".log")
+            self._qemu_log_file = open(self._qemu_log_path, 'wb')
 
-        self._qmp = qmp.QEMUMonitorProtocol(self._vm_monitor,
-                                            server=True)
+        if self._qmp_set:
+            self._qmp = qmp.QEMUMonitorProtocol(self._vm_monitor,
+                                                server=True)
 
     def _post_launch(self):
-        self._qmp.accept()
+        if self._qmp is not None:
+            self._qmp.accept()
+            for stage, when in self._qmp.get_timestamps().items():
+                self._launch_timing.mark(stage, when)
 
     def _post_shutdown(self):
         if self._qemu_log_file is not None:
@@ -290,6 +372,8 @@ class QEMUMachine(object):
 
         self._iolog = None
         self._qemu_full_args = None
+        self._launch_timing = QEMUMachineLaunchTiming()
+        self._timing_log_pending = True
         try:
             self._launch()
             self._launched = True
@@ -307,17 +391,25 @@ class QEMUMachine(object):
         """
         Launch the VM and establish a QMP connection
         """
+        self._launch_timing.mark('start')
         devnull = open(os.path.devnull, 'rb')
         self._pre_launch()
         self._qemu_full_args = (self._wrapper + [self._binary] +
                                 self._base_args() + self._args)
         LOG.debug('VM launch command: %r', ' '.join(self._qemu_full_args))
+        if self._output_log is not None:
+            stdout = subprocess.PIPE
+        else:
+            stdout = self._qemu_log_file
         self._popen = subprocess.Popen(self._qemu_full_args,
                                        stdin=devnull,
-                                       stdout=self._qemu_log_file,
+                                       stdout=stdout,
                                        stderr=subprocess.STDOUT,
                                        shell=False,
                                        close_fds=False)
+        self._launch_timing.mark('popen')
+        if self._output_log is not None:
+            self._output_log.start(self._popen.stdout)
         self._post_launch()
 
     def wait(self):
@@ -325,25 +417,54 @@ class QEMUMachine(object):
         Wait for the VM to power off
         """
         self._popen.wait()
-        self._qmp.close()
+        if self._qmp is not None:
+            self._qmp.close()
         self._load_io_log()
         self._post_shutdown()
 
+    def _send_quit(self, has_quit=False):
+        """
+        Ask a running VM to terminate, without waiting for it to exit.
+        The VM is killed if the quit command cannot be sent.
+        """
+        if self._qmp is None:
+            # Nothing to send the quit command to
+            self._popen.kill()
+            return
+        try:
+            if not has_quit:
+                self._qmp.cmd('quit')
+            self._qmp.close()
+        except:
+            self._popen.kill()
+
     def shutdown(self, has_quit=False):
         """
         Terminate the VM and clean up
         """
         if self.is_running():
-            try:
-                if not has_quit:
-                    self._qmp.cmd('quit')
-                self._qmp.close()
-            except:
-                self._popen.kill()
+            self._send_quit(has_quit)
             self._popen.wait()
 
+        self._post_wait()
+
+    def kill(self):
+        """
+        Kill the VM with SIGKILL, without asking it to quit, and clean up
+        """
+        if self.is_running():
+            self._popen.kill()
+            self._popen.wait()
+
+        self._post_wait()
+
+    def _post_wait(self):
+        """
+        Clean up after the QEMU process has exited
+        """
         self._load_io_log()
         self._post_shutdown()
+        self._write_timing_log()
 
         exitcode = self.exitcode()
         if exitcode is not None and exitcode < 0:
@@ -367,7 +488,11 @@ class QEMUMachine(object):
             else:
                 qmp_args[key] = value
 
-        return self._qmp.cmd(cmd, args=qmp_args)
+        reply = self._qmp.cmd(cmd, args=qmp_args)
+        timing = self._launch_timing
+        if timing is not None and 'first-command' not in timing.timestamps:
+            timing.mark('first-command')
+        return reply
 
     def command(self, cmd, conv_keys=True, **args):
         """
@@ -477,15 +602,93 @@ class QEMUMachine(object):
         """
         After self.shutdown or failed qemu execution, this returns the output
         of the qemu process.
+
+        With a streaming log, only the lines kept in its ring buffer are
+        returned.
         """
         return self._iolog
 
+    def set_streaming_log(self, max_lines=10000, spool_path=None,
+                          spool_max_bytes=None, spool_backups=1):
+        """
+        Capture the output of the qemu process while it runs
+
+        Instead of being written to a file and read back at shutdown, the
+        output is read by a background thread into a ring buffer, which is
+        available as output_log.  Optionally, it is also spooled to a file.
+
+        @param max_lines: number of lines kept in memory
+        @param spool_path: file that all output is written to (optional)
+        @param spool_max_bytes: size after which the spool file is rotated
+                                (default: never rotate)
+        @param spool_backups: number of rotated spool files to keep
+        """
+        self._output_log = StreamingLog(max_lines, spool_path,
+                                        spool_max_bytes, spool_backups)
+
+    @property
+    def output_log(self):
+        """
+        Returns the StreamingLog of the VM, or None if set_streaming_log()
+        was not called.  Use its lines() and wait_for() methods to follow
+        the output of the running VM.
+        """
+        return self._output_log
+
+    @property
+    def launch_timing(self):
+        """
+        Returns the QEMUMachineLaunchTiming of the last launch, or None
+        """
+        return self._launch_timing
+
+    def set_timing_log(self, path):
+        """
+        Sets a file to append launch timing information to
+
+        On every shutdown, a line with a JSON object describing the binary,
+        machine type and launch timing of the VM is appended to the file.
+
+        @param path: path of the log file, or None to disable logging
+        """
+        self._timing_log_path = path
+
+    def _write_timing_log(self):
+        if self._timing_log_path is None or not self._timing_log_pending:
+            return
+        self._timing_log_pending = False
+        entry = {'name': self._name,
+                 'binary': self._binary,
+                 'machine': self._machine,
+                 'args': self._args,
+                 'timing': self._launch_timing.to_dict()}
+        with open(self._timing_log_path, 'a') as log:
+            log.write(json.dumps(entry) + '\n')
+
     def add_args(self, *args):
         """
         Adds to the list of extra arguments to be given to the QEMU binary
         """
         self._args.extend(args)
 
+    def set_qmp_monitor(self, enabled=True):
+        """
+        Set whether to launch the VM with a QMP monitor
+
+        Without a monitor, QEMU is not waited for at launch, which suits
+        invocations that exit immediately, such as -dump-vmstate.  Such a
+        VM is killed rather than asked to quit by shutdown(); use wait()
+        to let it exit by itself.
+
+        @param enabled: if False, qmp monitor options will be removed from
+                        the base arguments of the resulting QEMU command
+                        line.  Default is True.
+        @note: call this function before launch().
+        """
+        self._qmp_set = enabled
+        if not enabled:
+            self._qmp = None
+
     def set_machine(self, machine_type):
         """
         Sets the machine type
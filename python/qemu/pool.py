@@ -0,0 +1,263 @@
+"""
+QEMU machine pool module:
+
+The pool module provides the QEMUMachinePool class, which keeps a number
+of paused QEMU VMs launched in the background so that users can take an
+already started VM instead of paying the whole startup cost on demand.
+"""
+
+# Copyright (C) 2019 Red Hat Inc.
+#
+# This work is licensed under the terms of the GNU GPL, version 2.  See
+# the COPYING file in the top-level directory.
+#
+
+import logging
+import threading
+import time
+
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+from .machine import QEMUMachineError
+
+LOG = logging.getLogger(__name__)
+
+
+class QEMUMachinePoolError(QEMUMachineError):
+    """
+    Exception raised when the pool can not hand out a VM
+    """
+
+
+class QEMUMachinePool(object):
+    """
+    A pool of pre-launched, paused QEMU VMs
+
+    Every VM is created by calling @factory, which must return a new,
+    not yet launched QEMUMachine.  The pool adds "-S" to its arguments
+    and launches it in a background thread, so that a VM that is handed
+    out by get() has completed QMP negotiation but has not executed any
+    guest code yet.  Use "cont" to start it::
+
+        names = itertools.count()
+        factory = lambda: QEMUMachine(binary, name='pool-%d' % next(names))
+        with QEMUMachinePool(factory, size=4) as pool:
+            vm = pool.get()
+            vm.command('cont')
+            ...
+            pool.put(vm)
+
+    Since VMs are launched concurrently, @factory must make sure that
+    they do not share any file or socket names, as above by passing a
+    different name to each QEMUMachine.
+    """
+
+    def __init__(self, factory, size=1):
+        '''
+        Initialize a QEMUMachinePool
+
+        @param factory: callable returning a new QEMUMachine
+        @param size: number of VMs kept ready in the background
+        @note: VMs are not launched until start() or get() is used.
+        '''
+        if size < 1:
+            raise QEMUMachinePoolError("Pool size must be at least 1")
+        self._factory = factory
+        self._size = size
+        self._ready = queue.Queue()
+        self._lock = threading.Lock()
+        self._threads = []
+        # VMs that are queued in self._ready or still being launched
+        self._available = 0
+        self._started = False
+        self._closed = False
+        # launch duration in seconds for every VM owned by the pool,
+        # keyed by id(vm); entries are dropped when the VM is handed out
+        self._launch_time = {}
+        self._stats = {'launched': 0,
+                       'failed': 0,
+                       'handed-out': 0,
+                       'recycled': 0,
+                       'killed': 0,
+                       'launch-time': 0.0,
+                       'wait-time': 0.0,
+                       'hidden-latency': 0.0}
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+        return False
+
+    def _launch_one(self):
+        """
+        Create and launch one VM, queueing the result.  Runs in its own
+        thread.
+        """
+        vm = None
+        start = time.time()
+        try:
+            vm = self._factory()
+            vm.add_args('-S')
+            vm.launch()
+        except Exception as err:
+            LOG.debug('Error launching pooled VM: %s', err)
+            with self._lock:
+                self._stats['failed'] += 1
+            self._ready.put((None, err))
+            return
+
+        duration = time.time() - start
+        with self._lock:
+            self._stats['launched'] += 1
+            self._stats['launch-time'] += duration
+            closed = self._closed
+            if not closed:
+                self._launch_time[id(vm)] = duration
+        if closed:
+            vm.shutdown()
+            return
+        self._ready.put((vm, None))
+
+    def _spawn(self):
+        thread = threading.Thread(target=self._launch_one)
+        thread.daemon = True
+        with self._lock:
+            self._available += 1
+            self._threads = [t for t in self._threads if t.is_alive()]
+            self._threads.append(thread)
+        thread.start()
+
+    def start(self):
+        """
+        Start launching VMs in the background
+        """
+        if self._closed:
+            raise QEMUMachinePoolError("Pool is closed")
+        if self._started:
+            return
+        self._started = True
+        for _ in range(self._size):
+            self._spawn()
+
+    def get(self, timeout=None):
+        """
+        Take a paused VM out of the pool
+
+        A replacement VM is launched in the background right away.
+
+        @param timeout: seconds to wait for a VM to become ready, or None
+                        to wait indefinitely
+        @return a launched QEMUMachine, paused before guest execution
+        @raise QEMUMachinePoolError if no VM became ready in time
+        @raise the exception raised by a failed launch
+        """
+        self.start()
+        start = time.time()
+        try:
+            vm, err = self._ready.get(timeout=timeout)
+        except queue.Empty:
+            raise QEMUMachinePoolError("Timeout waiting for a pooled VM")
+        waited = time.time() - start
+
+        # Keep the pool populated, even if this launch failed
+        with self._lock:
+            self._available -= 1
+            refill = self._available < self._size
+        if refill:
+            self._spawn()
+        if err is not None:
+            raise err
+
+        with self._lock:
+            self._stats['handed-out'] += 1
+            self._stats['wait-time'] += waited
+            hidden = self._launch_time.pop(id(vm), 0.0) - waited
+            self._stats['hidden-latency'] += max(hidden, 0.0)
+        return vm
+
+    @staticmethod
+    def _is_pristine(vm):
+        """
+        Check whether a VM is still in the state it was launched in
+        """
+        if not vm.is_running():
+            return False
+        try:
+            status = vm.command('query-status')
+        except Exception:
+            return False
+        return status['status'] == 'prelaunch'
+
+    def put(self, vm, recycle=False):
+        """
+        Return a VM to the pool
+
+        If @recycle is True and the VM still has not executed guest code,
+        it is put back and handed out again by a later get(), which then
+        does not need to launch a replacement.  Otherwise, if the VM was
+        started with "cont", or if the pool is already full because a
+        replacement was launched, it is shut down.
+
+        @param recycle: whether the caller left the VM untouched apart
+                        from read-only queries, so that it can be reused
+        """
+        if recycle and not self._closed and self._is_pristine(vm):
+            vm.get_qmp_events()
+            with self._lock:
+                # get() already launched a replacement; do not grow the
+                # pool beyond its size
+                recycled = self._available < self._size
+                if recycled:
+                    self._available += 1
+                    self._stats['recycled'] += 1
+                    # Handing it out again saves a launch of average duration
+                    if self._stats['launched']:
+                        self._launch_time[id(vm)] = (
+                            self._stats['launch-time'] /
+                            self._stats['launched'])
+            if recycled:
+                self._ready.put((vm, None))
+                return
+
+        with self._lock:
+            self._stats['killed'] += 1
+        vm.shutdown()
+
+    def stats(self):
+        """
+        Return a dict of pool statistics
+
+        The dict contains the number of VMs launched, failed, handed out,
+        recycled and killed, the total launch time, the total time get()
+        callers spent waiting, and "hidden-latency", the startup time
+        that callers did not have to wait for.  Times are in seconds.
+        """
+        with self._lock:
+            return dict(self._stats)
+
+    def close(self):
+        """
+        Shut down all VMs that are still owned by the pool
+
+        VMs that were handed out and not returned are not touched.
+        """
+        with self._lock:
+            self._closed = True
+            threads = list(self._threads)
+        for thread in threads:
+            thread.join()
+        while True:
+            try:
+                vm, _ = self._ready.get_nowait()
+            except queue.Empty:
+                break
+            if vm is not None:
+                self._launch_time.pop(id(vm), None)
+                vm.shutdown()
+        LOG.debug('VM pool statistics: %r', self._stats)
@@ -12,6 +12,7 @@ import json
 import errno
 import socket
 import logging
+import time
 
 
 class QMPError(Exception):
@@ -52,6 +53,7 @@ class QEMUMonitorProtocol(object):
               accept() methods
         """
         self.__events = []
+        self.__timestamps = {}
         self.__address = address
         self.__sock = self.__get_sock()
         self.__sockfile = None
@@ -69,10 +71,12 @@ class QEMUMonitorProtocol(object):
 
     def __negotiate_capabilities(self):
         greeting = self.__json_read()
+        self.__timestamps['greeting'] = time.time()
         if greeting is None or "QMP" not in greeting:
             raise QMPConnectError
         # Greeting seems ok, negotiate capabilities
         resp = self.cmd('qmp_capabilities')
+        self.__timestamps['capabilities'] = time.time()
         if "return" in resp:
             return greeting
         raise QMPCapabilitiesError
@@ -138,6 +142,7 @@ class QEMUMonitorProtocol(object):
         @raise QMPCapabilitiesError if fails to negotiate capabilities
         """
         self.__sock.connect(self.__address)
+        self.__timestamps['connect'] = time.time()
         self.__sockfile = self.__sock.makefile()
         if negotiate:
             return self.__negotiate_capabilities()
@@ -153,6 +158,7 @@ class QEMUMonitorProtocol(object):
         """
         self.__sock.settimeout(15)
         self.__sock, _ = self.__sock.accept()
+        self.__timestamps['accept'] = time.time()
         self.__sockfile = self.__sock.makefile()
         return self.__negotiate_capabilities()
 
@@ -190,6 +196,34 @@ class QEMUMonitorProtocol(object):
             qmp_cmd['id'] = cmd_id
         return self.cmd_obj(qmp_cmd)
 
+    def cmd_batch(self, qmp_cmds):
+        """
+        Send several QMP commands at once and collect their responses.
+
+        The commands are written in a single send, so that their responses
+        only cost one round trip; QEMU answers them in order.
+
+        @param qmp_cmds: list of QMP commands, as Python dicts
+        @return list of QMP responses, in the same order as qmp_cmds; it
+                is shorter if the connection was closed
+        """
+        self.logger.debug(">>> %s", qmp_cmds)
+        data = ''.join(json.dumps(qmp_cmd) + '\n' for qmp_cmd in qmp_cmds)
+        try:
+            self.__sock.sendall(data.encode('utf-8'))
+        except socket.error as err:
+            if err.errno == errno.EPIPE:
+                return []
+            raise
+        resps = []
+        for _ in qmp_cmds:
+            resp = self.__json_read()
+            if resp is None:
+                break
+            resps.append(resp)
+        self.logger.debug("<<< %s", resps)
+        return resps
+
     def command(self, cmd, **kwds):
         """
         Build and send a QMP command to the monitor, report errors if any
@@ -242,6 +276,17 @@ class QEMUMonitorProtocol(object):
         """
         self.__events = []
 
+    def get_timestamps(self):
+        """
+        Get the times at which the connection was established.
+
+        @return dict mapping 'connect' or 'accept', 'greeting' and
+                'capabilities' to the time.time() value at which the
+                connection was made, the greeting was received and
+                capabilities negotiation completed
+        """
+        return dict(self.__timestamps)
+
     def close(self):
         self.__sock.close()
         self.__sockfile.close()
@@ -11,13 +11,27 @@
 # Based on qmp.py.
 #
 
+import base64
 import socket
 import os
 
 from .machine import QEMUMachine
 
 
+class QEMUQtestError(Exception):
+    """
+    Represents a qtest command that failed
+    """
+
+
 class QEMUQtestProtocol(object):
+    #: Maximum number of command bytes sent before reading back responses;
+    #: keeps QEMU from blocking on its replies while we are still sending
+    batch_bytes = 64 * 1024
+
+    #: Maximum number of bytes of guest memory moved by a single command
+    chunk_size = 16 * 1024 * 1024
+
     def __init__(self, address, server=False):
         """
         Create a QEMUQtestProtocol object.
@@ -72,6 +86,80 @@ class QEMUQtestProtocol(object):
         resp = self._sockfile.readline()
         return resp
 
+    def cmds(self, qtest_cmds):
+        """
+        Send several qtest commands on the wire and return their responses.
+
+        Commands are pipelined: up to batch_bytes worth of commands are
+        written with a single sendall() before their responses are read.
+
+        @param qtest_cmds: list of qtest command texts to be sent
+        @return list of response lines, in the order of the commands
+        """
+        resps = []
+        pending = 0
+        batch = []
+        size = 0
+        for qtest_cmd in qtest_cmds:
+            line = qtest_cmd + "\n"
+            if batch and size + len(line) > self.batch_bytes:
+                self._sock.sendall(''.join(batch).encode('utf-8'))
+                for _ in range(pending):
+                    resps.append(self._sockfile.readline())
+                batch = []
+                size = 0
+                pending = 0
+            batch.append(line)
+            size += len(line)
+            pending += 1
+        if batch:
+            self._sock.sendall(''.join(batch).encode('utf-8'))
+            for _ in range(pending):
+                resps.append(self._sockfile.readline())
+        return resps
+
+    @staticmethod
+    def _check(qtest_cmd, resp):
+        if not resp.startswith('OK'):
+            raise QEMUQtestError('%s failed: %s' %
+                                 (qtest_cmd.split(' ', 1)[0], resp.strip()))
+        return resp[2:].strip()
+
+    def read_mem(self, addr, size):
+        """
+        Read a range of guest memory with the b64read command.
+
+        @param addr: guest physical address
+        @param size: number of bytes to read
+        @return the memory contents as bytes
+        @raise QEMUQtestError if QEMU reports an error
+        """
+        qtest_cmds = []
+        for offset in range(0, size, self.chunk_size):
+            length = min(self.chunk_size, size - offset)
+            qtest_cmds.append('b64read 0x%x 0x%x' % (addr + offset, length))
+        data = []
+        for qtest_cmd, resp in zip(qtest_cmds, self.cmds(qtest_cmds)):
+            data.append(base64.b64decode(self._check(qtest_cmd, resp)))
+        return b''.join(data)
+
+    def write_mem(self, addr, data):
+        """
+        Write a range of guest memory with the b64write command.
+
+        @param addr: guest physical address
+        @param data: bytes to write
+        @raise QEMUQtestError if QEMU reports an error
+        """
+        qtest_cmds = []
+        for offset in range(0, len(data), self.chunk_size):
+            chunk = data[offset:offset + self.chunk_size]
+            qtest_cmds.append('b64write 0x%x 0x%x %s' %
+                              (addr + offset, len(chunk),
+                               base64.b64encode(chunk).decode('ascii')))
+        for qtest_cmd, resp in zip(qtest_cmds, self.cmds(qtest_cmds)):
+            self._check(qtest_cmd, resp)
+
     def close(self):
         self._sock.close()
         self._sockfile.close()
@@ -114,3 +202,15 @@ class QEMUQtestMachine(QEMUMachine):
     def qtest(self, cmd):
         '''Send a qtest command to guest'''
         return self._qtest.cmd(cmd)
+
+    def qtest_batch(self, cmds):
+        '''Send a list of qtest commands to guest, return their responses'''
+        return self._qtest.cmds(cmds)
+
+    def qtest_read(self, addr, size):
+        '''Read a range of guest memory'''
+        return self._qtest.read_mem(addr, size)
+
+    def qtest_write(self, addr, data):
+        '''Write bytes to a range of guest memory'''
+        self._qtest.write_mem(addr, data)
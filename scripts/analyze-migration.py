@@ -18,11 +18,25 @@
 # License along with this library; if not, see <http://www.gnu.org/licenses/>.
 
 from __future__ import print_function
-import numpy as np
 import json
+import mmap
 import os
+import socket
+import stat
 import argparse
+import array
 import collections
+import csv
+import fnmatch
+import hashlib
+import io
+import multiprocessing
+import struct
+import sys
+import tempfile
+import threading
+import time
+import zlib
 
 def mkdir_p(path):
     try:
@@ -30,80 +44,375 @@ def mkdir_p(path):
     except OSError:
         pass
 
+# Python 2 has no 'q' arrays and no os.pwrite()
+INDEX_TYPECODE = 'l' if array.array('l').itemsize >= 8 else 'q'
+pwrite_lock = threading.Lock()
+
+def pwrite(fd, data, offset):
+    if hasattr(os, 'pwrite'):
+        os.pwrite(fd, data, offset)
+        return
+    # The file descriptor is shared between the extraction threads
+    with pwrite_lock:
+        os.lseek(fd, offset, os.SEEK_SET)
+        while data:
+            data = data[os.write(fd, data):]
+
 class MigrationFile(object):
+    # Precompiled big endian integer formats, indexed by size and signedness
+    S64 = struct.Struct('>q')
+    S32 = struct.Struct('>i')
+    S16 = struct.Struct('>h')
+    S8 = struct.Struct('>b')
+    U64 = struct.Struct('>Q')
+    U32 = struct.Struct('>I')
+    U16 = struct.Struct('>H')
+    U8 = struct.Struct('>B')
+
     def __init__(self, filename):
         self.filename = filename
         self.file = open(self.filename, "rb")
+        self.size = os.fstat(self.file.fileno()).st_size
+        if self.size == 0:
+            raise Exception("%s is empty" % self.filename)
+        self.map = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            self.view = memoryview(self.map)
+        except TypeError:
+            # Python 2 mmap objects do not support memoryview, slicing
+            # them copies the data instead
+            self.view = self.map
+        self.pos = 0
+
+    def _unpack(self, fmt):
+        pos = self.pos
+        if pos + fmt.size > self.size:
+            raise Exception("Unexpected end of %s at 0x%x" % (self.filename, pos))
+        self.pos = pos + fmt.size
+        return fmt.unpack_from(self.map, pos)[0]
 
     def read64(self):
-        return np.asscalar(np.fromfile(self.file, count=1, dtype='>i8')[0])
+        return self._unpack(self.S64)
 
     def read32(self):
-        return np.asscalar(np.fromfile(self.file, count=1, dtype='>i4')[0])
+        return self._unpack(self.S32)
 
     def read16(self):
-        return np.asscalar(np.fromfile(self.file, count=1, dtype='>i2')[0])
+        return self._unpack(self.S16)
 
     def read8(self):
-        return np.asscalar(np.fromfile(self.file, count=1, dtype='>i1')[0])
+        return self._unpack(self.S8)
+
+    def readu64(self):
+        return self._unpack(self.U64)
+
+    def readu32(self):
+        return self._unpack(self.U32)
+
+    def readu16(self):
+        return self._unpack(self.U16)
+
+    def readu8(self):
+        return self._unpack(self.U8)
 
     def readstr(self, len = None):
         if len is None:
-            len = self.read8()
+            len = self.readu8()
         if len == 0:
             return ""
-        return np.fromfile(self.file, count=1, dtype=('S%d' % len))[0]
+        return self.readvar(len).decode('utf-8')
+
+    def readview(self, size):
+        """Return the next @size bytes without copying them"""
+        pos = self.pos
+        if pos + size > self.size:
+            raise Exception("Unexpected end of %s at 0x%x" % (self.filename, pos))
+        self.pos = pos + size
+        return self.view[pos:pos + size]
 
     def readvar(self, size = None):
         if size is None:
-            size = self.read8()
+            size = self.readu8()
         if size == 0:
-            return ""
-        value = self.file.read(size)
-        if len(value) != size:
-            raise Exception("Unexpected end of %s at 0x%x" % (self.filename, self.file.tell()))
-        return value
+            return b""
+        return bytes(self.readview(size))
 
     def tell(self):
-        return self.file.tell()
+        return self.pos
+
+    def fileno(self):
+        return self.file.fileno()
+
+    def seek(self, offset, whence = os.SEEK_SET):
+        if whence == os.SEEK_CUR:
+            offset += self.pos
+        elif whence == os.SEEK_END:
+            offset += self.size
+        self.pos = offset
 
     # The VMSD description is at the end of the file, after EOF. Look for
     # the last NULL byte, then for the beginning brace of JSON.
     def read_migration_debug_json(self):
         QEMU_VM_VMDESCRIPTION = 0x06
 
-        # Remember the offset in the file when we started
-        entrypos = self.file.tell()
-
-        # Read the last 10MB
-        self.file.seek(0, os.SEEK_END)
-        endpos = self.file.tell()
-        self.file.seek(max(-endpos, -10 * 1024 * 1024), os.SEEK_END)
-        datapos = self.file.tell()
-        data = self.file.read()
-        # The full file read closed the file as well, reopen it
-        self.file = open(self.filename, "rb")
-
-        # Find the last NULL byte, then the first brace after that. This should
-        # be the beginning of our JSON data.
-        nulpos = data.rfind("\0")
-        jsonpos = data.find("{", nulpos)
+        # Scan backwards from the end of the mapping for the last NULL byte,
+        # then forward for the first brace after that. This should be the
+        # beginning of our JSON data.
+        nulpos = self.map.rfind(b"\0")
+        jsonpos = self.map.find(b"{", nulpos)
+        if nulpos < 0 or jsonpos < 5:
+            raise Exception("No Debug Migration device found")
 
         # Check backwards from there and see whether we guessed right
-        self.file.seek(datapos + jsonpos - 5, 0)
-        if self.read8() != QEMU_VM_VMDESCRIPTION:
+        if self.map[jsonpos - 5:jsonpos - 4] != struct.pack('B', QEMU_VM_VMDESCRIPTION):
             raise Exception("No Debug Migration device found")
 
-        jsonlen = self.read32()
+        jsonlen = self.U32.unpack_from(self.map, jsonpos - 4)[0]
+
+        return self.map[jsonpos:jsonpos + jsonlen].decode('utf-8')
+
+    def close(self):
+        if self.view is not self.map:
+            self.view.release()
+        self.map.close()
+        self.file.close()
+
+class MigrationStream(MigrationFile):
+    """Forward-only reader for a migration stream arriving on a pipe or
+       socket, with the same interface as MigrationFile"""
+
+    CHUNK_SIZE = 1024 * 1024
+
+    def __init__(self, stream, name, progress = None, interval = 1.0):
+        self.filename = name
+        self.file = stream
+        self.read_chunk = getattr(stream, 'read1', stream.read)
+        self.buf = bytearray()
+        self.bufpos = 0     # position of self.buf[0] in the stream
+        self.pos = 0
+        self.eof = False
+        self.progress = progress
+        self.interval = interval
+        self.last_report = time.time()
+
+    def fill(self, size):
+        # Make sure that the next @size bytes are buffered
+        while self.pos + size > self.bufpos + len(self.buf) and not self.eof:
+            # Drop consumed data, keeping one byte for seek(-1)
+            consumed = self.pos - self.bufpos - 1
+            if consumed > self.CHUNK_SIZE:
+                del self.buf[:consumed]
+                self.bufpos += consumed
+            data = self.read_chunk(self.CHUNK_SIZE)
+            if not data:
+                self.eof = True
+                break
+            self.buf += data
+            if self.progress and time.time() - self.last_report >= self.interval:
+                self.progress(self.bufpos + len(self.buf))
+                self.last_report = time.time()
+        return self.pos + size <= self.bufpos + len(self.buf)
+
+    def _unpack(self, fmt):
+        if not self.fill(fmt.size):
+            raise Exception("Unexpected end of %s at 0x%x" % (self.filename, self.pos))
+        value = fmt.unpack_from(self.buf, self.pos - self.bufpos)[0]
+        self.pos += fmt.size
+        return value
+
+    def readview(self, size):
+        # The buffer is compacted as the stream advances, so hand out a copy
+        if not self.fill(size):
+            raise Exception("Unexpected end of %s at 0x%x" % (self.filename, self.pos))
+        start = self.pos - self.bufpos
+        self.pos += size
+        return bytes(self.buf[start:start + size])
+
+    def seek(self, offset, whence = os.SEEK_SET):
+        if whence == os.SEEK_SET:
+            offset -= self.pos
+        elif whence != os.SEEK_CUR:
+            raise Exception("Cannot seek from the end of %s" % self.filename)
+        if self.pos + offset < self.bufpos:
+            raise Exception("Cannot seek backwards in %s" % self.filename)
+        # Skip in chunks so that the buffer does not grow with large skips
+        while offset > self.CHUNK_SIZE:
+            if not self.fill(self.CHUNK_SIZE):
+                raise Exception("Unexpected end of %s at 0x%x" % (self.filename, self.pos))
+            self.pos += self.CHUNK_SIZE
+            offset -= self.CHUNK_SIZE
+        self.pos += offset
+
+    def at_eof(self):
+        return not self.fill(1)
+
+    def peek8(self):
+        """Return the next byte without consuming it, or None at the end"""
+        if not self.fill(1):
+            return None
+        return self.buf[self.pos - self.bufpos]
+
+    def section_header_at(self, pos, section_ids):
+        """Whether what follows a candidate footer at stream offset @pos
+           looks like the next section: EOF, a part of one of the started
+           and not yet ended @section_ids, or the start of a section with
+           a sane name"""
+        if not self.fill(pos - self.pos + 1):
+            return False
+        section_type = self.buf[pos - self.bufpos]
+        if section_type == MigrationDump.QEMU_VM_EOF:
+            # The stream either ends here or carries its description
+            if not self.fill(pos - self.pos + 2):
+                return True
+            return self.buf[pos + 1 - self.bufpos] == MigrationDump.QEMU_VM_VMDESCRIPTION
+        if section_type in (MigrationDump.QEMU_VM_SECTION_PART,
+                            MigrationDump.QEMU_VM_SECTION_END):
+            if not self.fill(pos - self.pos + 5):
+                return False
+            return self.U32.unpack_from(self.buf, pos + 1 - self.bufpos)[0] in section_ids
+        if section_type in (MigrationDump.QEMU_VM_SECTION_START,
+                            MigrationDump.QEMU_VM_SECTION_FULL):
+            if not self.fill(pos - self.pos + 6):
+                return False
+            namelen = self.buf[pos + 5 - self.bufpos]
+            # Name, instance id and version id
+            if namelen == 0 or not self.fill(pos - self.pos + 6 + namelen + 8):
+                return False
+            start = pos + 6 - self.bufpos
+            return all(0x20 < c < 0x7f for c in self.buf[start:start + namelen])
+        return False
+
+    def read_until_footer(self, section_id, section_ids):
+        """Return the data up to the footer of section @section_id, which
+           must be followed by a plausible header of the next section;
+           @section_ids are the ids of the sections that can still have
+           parts"""
+        footer = struct.pack('>BI', MigrationDump.QEMU_VM_SECTION_FOOTER, section_id)
+        search = self.pos
+        while True:
+            i = self.buf.find(footer, search - self.bufpos)
+            if i < 0:
+                search = max(self.pos, self.bufpos + len(self.buf) - len(footer))
+                if not self.fill(self.bufpos + len(self.buf) - self.pos + 1):
+                    raise Exception("No footer found for section %d in %s; streams "
+                                    "without section footers cannot be decoded before "
+                                    "their end, save them to a file first" %
+                                    (section_id, self.filename))
+                continue
+            # Device state can contain the footer bytes, check what follows
+            if self.section_header_at(self.bufpos + i + len(footer), section_ids):
+                return self.readview(self.bufpos + i - self.pos)
+            search = self.bufpos + i + 1
 
-        # Seek back to where we were at the beginning
-        self.file.seek(entrypos, 0)
+    def read_migration_debug_json(self):
+        raise Exception("The VMSD description of %s is only known at its end" % self.filename)
 
-        return data[jsonpos:jsonpos + jsonlen]
+    def fileno(self):
+        return self.file.fileno()
 
     def close(self):
         self.file.close()
 
+class PageCache(object):
+    """LRU cache of the latest contents of RAM pages, used as the base
+       for decoding XBZRLE pages"""
+
+    def __init__(self, max_pages):
+        self.max_pages = max_pages
+        self.pages = collections.OrderedDict()
+
+    def get(self, key):
+        data = self.pages.pop(key, None)
+        if data is not None:
+            self.pages[key] = data
+        return data
+
+    def put(self, key, data):
+        self.pages.pop(key, None)
+        self.pages[key] = data
+        if len(self.pages) > self.max_pages:
+            self.pages.popitem(last = False)
+
+    def clear(self):
+        self.pages.clear()
+
+class PageHashes(object):
+    """64-bit hashes of the latest contents of the pages of a RAM block,
+       kept in a temporary file so that they need not fit in memory.
+       Zero pages, and pages that were never sent, hash to 0."""
+
+    HASH = struct.Struct('=Q')
+    zero_hashes = { }
+
+    def __init__(self, npages):
+        self.npages = npages
+        self.file = tempfile.TemporaryFile()
+        self.map = None
+        if npages:
+            self.file.truncate(npages * self.HASH.size)
+            self.map = mmap.mmap(self.file.fileno(), npages * self.HASH.size)
+
+    @staticmethod
+    def digest(data):
+        try:
+            digest = hashlib.blake2b(data, digest_size = 8).digest()
+        except AttributeError:
+            digest = hashlib.md5(data).digest()
+        return PageHashes.HASH.unpack_from(digest)[0]
+
+    @classmethod
+    def hash(cls, data):
+        value = cls.digest(data)
+        size = len(data)
+        if size not in cls.zero_hashes:
+            cls.zero_hashes[size] = cls.digest(b'\0' * size)
+        if value == cls.zero_hashes[size]:
+            return 0
+        return value or 1
+
+    def set(self, pageno, value):
+        self.HASH.pack_into(self.map, pageno * self.HASH.size, value)
+
+    def chunks(self, pages, npages):
+        """Iterate over (first page, raw hashes) for runs of @pages pages,
+           up to page @npages"""
+        size = self.HASH.size
+        for first in range(0, npages, pages):
+            last = min(first + pages, npages)
+            yield first, self.map[first * size:last * size]
+
+    def close(self):
+        if self.map is not None:
+            self.map.close()
+        self.file.close()
+
+def uleb128_decode_small(data, pos):
+    # Values are at most 2^14-1, so encoded in one or two bytes
+    value = data[pos]
+    if value < 0x80:
+        return value, pos + 1
+    if data[pos + 1] >= 0x80:
+        raise Exception("Invalid XBZRLE length encoding")
+    return (value & 0x7f) | (data[pos + 1] << 7), pos + 2
+
+def xbzrle_decode(src, old):
+    # Apply the zero run / non-zero run pairs of an XBZRLE encoded page
+    # to the previous contents of the page, like xbzrle_decode_buffer()
+    src = bytearray(src)
+    dst = bytearray(old)
+    i = 0
+    d = 0
+    while i < len(src):
+        count, i = uleb128_decode_small(src, i)
+        d += count
+        count, i = uleb128_decode_small(src, i)
+        if count == 0 or d + count > len(dst) or i + count > len(src):
+            raise Exception("XBZRLE page decode error")
+        dst[d:d + count] = src[i:i + count]
+        d += count
+        i += count
+    return bytes(dst)
+
 class RamSection(object):
     RAM_SAVE_FLAG_COMPRESS = 0x02
     RAM_SAVE_FLAG_MEM_SIZE = 0x04
@@ -112,6 +421,16 @@ class RamSection(object):
     RAM_SAVE_FLAG_CONTINUE = 0x20
     RAM_SAVE_FLAG_XBZRLE   = 0x40
     RAM_SAVE_FLAG_HOOK     = 0x80
+    RAM_SAVE_FLAG_COMPRESS_PAGE = 0x100
+
+    ENCODING_FLAG_XBZRLE   = 0x1
+
+    PAGE_KINDS = ('normal', 'zero', 'fill', 'xbzrle', 'compressed')
+
+    # Page index entries for pages that have no payload in the stream
+    PAGE_NOT_SENT          = -1
+    PAGE_FILL_BASE         = -2   # PAGE_FILL_BASE - fill_char
+    PAGE_SPILL_BASE        = -258 # PAGE_SPILL_BASE - slot in self.spill
 
     def __init__(self, file, version_id, ramargs, section_key):
         if version_id != 4:
@@ -122,12 +441,39 @@ class RamSection(object):
         self.TARGET_PAGE_SIZE = ramargs['page_size']
         self.dump_memory = ramargs['dump_memory']
         self.write_memory = ramargs['write_memory']
+        self.jobs = ramargs['jobs']
+        self.collect_stats = ramargs['stats']
+        self.hash_pages = ramargs['hash_pages']
+        if self.hash_pages:
+            self.hashes = collections.OrderedDict()
+            self.fill_hashes = { }
+        if self.collect_stats:
+            self.blockstats = collections.OrderedDict()
+            self.sends = { }
         self.sizeinfo = collections.OrderedDict()
         self.data = collections.OrderedDict()
         self.data['section sizes'] = self.sizeinfo
+        self.stats = collections.OrderedDict()
+        for kind in self.PAGE_KINDS:
+            self.stats[kind] = collections.OrderedDict((('pages', 0), ('bytes', 0)))
+        if self.collect_stats:
+            self.data['page statistics'] = self.stats
         self.name = ''
+        self.page_cache = None
+        if self.write_memory or self.dump_memory or self.hash_pages:
+            self.page_cache = PageCache(ramargs['page_cache_pages'])
         if self.write_memory:
-            self.files = { }
+            # Memory is extracted in two passes: read() only indexes the
+            # latest copy of each page, extract() then writes them out
+            self.blocksizes = collections.OrderedDict()
+            self.index = { }
+            # Decoded XBZRLE and compressed pages have no copy in the
+            # stream, they are kept in page-sized slots of a temporary
+            # file; slots of pages that were sent again are reused
+            self.spill = None
+            self.spill_map = None
+            self.spill_slots = 0
+            self.free_slots = []
         if self.dump_memory:
             self.memory = collections.OrderedDict()
             self.data['memory'] = self.memory
@@ -139,71 +485,239 @@ class RamSection(object):
         return self.data.__str__()
 
     def getDict(self):
+        self.update_stats()
         return self.data
 
+    def read_block_name(self, flags):
+        if flags & self.RAM_SAVE_FLAG_CONTINUE:
+            return flags & ~self.RAM_SAVE_FLAG_CONTINUE
+        self.name = self.file.readstr()
+        return flags
+
+    def count_page(self, kind, start, addr):
+        size = self.file.tell() - start
+        stats = self.stats[kind]
+        stats['pages'] += 1
+        stats['bytes'] += size
+        if self.collect_stats:
+            block = self.blockstats[self.name]
+            block['pages'] += 1
+            block['bytes'] += size
+            block[kind] += 1
+            # Per-page send counts, saturating at 255
+            sends = self.sends[self.name]
+            pageno = addr // self.TARGET_PAGE_SIZE
+            if sends[pageno] < 255:
+                sends[pageno] += 1
+
+    def getStats(self):
+        blocks = []
+        for name, block in self.blockstats.items():
+            sends = self.sends[name]
+            r = collections.OrderedDict()
+            r['name'] = name
+            r.update(block)
+            r['unique pages'] = len(sends) - sends.count(0)
+            r['resent pages'] = r['unique pages'] - sends.count(1)
+            histogram = collections.OrderedDict()
+            for count in range(1, 256):
+                n = sends.count(count)
+                if n:
+                    histogram[str(count) if count < 255 else '255+'] = n
+            r['sends'] = histogram
+            blocks.append(r)
+        self.update_stats()
+        return blocks
+
+    def fill_page(self, fill_char):
+        return struct.pack('B', fill_char) * self.TARGET_PAGE_SIZE
+
+    def set_index(self, addr, value):
+        pageno = addr // self.TARGET_PAGE_SIZE
+        old = self.index[self.name][pageno]
+        if old <= self.PAGE_SPILL_BASE:
+            self.free_slots.append(self.PAGE_SPILL_BASE - old)
+        self.index[self.name][pageno] = value
+
+    def spill_page(self, addr, data):
+        if self.spill is None:
+            self.spill = tempfile.TemporaryFile()
+        if self.free_slots:
+            slot = self.free_slots.pop()
+        else:
+            slot = self.spill_slots
+            self.spill_slots += 1
+        self.spill.seek(slot * self.TARGET_PAGE_SIZE)
+        self.spill.write(data)
+        self.set_index(addr, self.PAGE_SPILL_BASE - slot)
+
+    def spilled_page(self, slot):
+        start = slot * self.TARGET_PAGE_SIZE
+        if self.spill_map is not None:
+            return self.spill_map[start:start + self.TARGET_PAGE_SIZE]
+        self.spill.seek(start)
+        return self.spill.read(self.TARGET_PAGE_SIZE)
+
+    def indexed_page(self, name, pageno):
+        offset = self.index[name][pageno]
+        if offset >= 0:
+            return self.file.view[offset:offset + self.TARGET_PAGE_SIZE]
+        elif offset <= self.PAGE_SPILL_BASE:
+            return self.spilled_page(self.PAGE_SPILL_BASE - offset)
+        elif offset == self.PAGE_NOT_SENT:
+            return self.fill_page(0)
+        return self.fill_page(self.PAGE_FILL_BASE - offset)
+
+    def previous_page(self, addr):
+        # XBZRLE pages are encoded against the previous contents of the page
+        data = self.page_cache.get((self.name, addr))
+        if data is None and self.write_memory:
+            data = self.indexed_page(self.name, addr // self.TARGET_PAGE_SIZE)
+        if data is None:
+            raise Exception("Page %s (0x%016x) dropped from the page cache, "
+                            "retry with a larger --page-cache" % (self.name, addr))
+        return data
+
+    def hash_page(self, addr, data):
+        self.hashes[self.name].set(addr // self.TARGET_PAGE_SIZE, PageHashes.hash(data))
+
+    def hash_fill_page(self, addr, fill_char):
+        if fill_char not in self.fill_hashes:
+            self.fill_hashes[fill_char] = PageHashes.hash(self.fill_page(fill_char))
+        self.hashes[self.name].set(addr // self.TARGET_PAGE_SIZE, self.fill_hashes[fill_char])
+
+    def store_decoded(self, addr, data):
+        self.page_cache.put((self.name, addr), data)
+        if self.hash_pages:
+            self.hash_page(addr, data)
+        if self.write_memory:
+            self.spill_page(addr, data)
+        if self.dump_memory:
+            hexdata = " ".join("{0:02x}".format(c) for c in bytearray(data))
+            self.memory['%s (0x%016x)' % (self.name, addr)] = hexdata
+
+    def update_stats(self):
+        total_pages = sum(self.stats[kind]['pages'] for kind in self.PAGE_KINDS)
+        for kind in self.PAGE_KINDS:
+            stats = self.stats[kind]
+            stats['saved'] = stats['pages'] * self.TARGET_PAGE_SIZE - stats['bytes']
+        if total_pages:
+            self.stats['zero page ratio'] = \
+                float(self.stats['zero']['pages']) / total_pages
+            self.stats['duplicate page ratio'] = \
+                float(self.stats['zero']['pages'] + self.stats['fill']['pages']) / total_pages
+
+    def release(self):
+        # Drop references into the mapped stream before it is closed
+        if self.page_cache is not None:
+            self.page_cache.clear()
+        if self.write_memory and self.spill is not None:
+            if self.spill_map is not None:
+                self.spill_map.close()
+                self.spill_map = None
+            self.spill.close()
+            self.spill = None
+
     def read(self):
         # Read all RAM sections
         while True:
+            start = self.file.tell()
             addr = self.file.read64()
             flags = addr & (self.TARGET_PAGE_SIZE - 1)
             addr &= ~(self.TARGET_PAGE_SIZE - 1)
 
             if flags & self.RAM_SAVE_FLAG_MEM_SIZE:
                 while True:
-                    namelen = self.file.read8()
+                    namelen = self.file.readu8()
                     # We assume that no RAM chunk is big enough to ever
                     # hit the first byte of the address, so when we see
                     # a zero here we know it has to be an address, not the
                     # length of the next block.
                     if namelen == 0:
-                        self.file.file.seek(-1, 1)
+                        self.file.seek(-1, os.SEEK_CUR)
                         break
                     self.name = self.file.readstr(len = namelen)
-                    len = self.file.read64()
-                    self.sizeinfo[self.name] = '0x%016x' % len
+                    length = self.file.read64()
+                    self.sizeinfo[self.name] = '0x%016x' % length
+                    if self.collect_stats:
+                        block = collections.OrderedDict((('size', length), ('pages', 0), ('bytes', 0)))
+                        for kind in self.PAGE_KINDS:
+                            block[kind] = 0
+                        self.blockstats[self.name] = block
+                        self.sends[self.name] = bytearray((length + self.TARGET_PAGE_SIZE - 1) // self.TARGET_PAGE_SIZE)
+                    if self.hash_pages:
+                        self.hashes[self.name] = PageHashes((length + self.TARGET_PAGE_SIZE - 1) // self.TARGET_PAGE_SIZE)
                     if self.write_memory:
-                        print(self.name)
-                        mkdir_p('./' + os.path.dirname(self.name))
-                        f = open('./' + self.name, "wb")
-                        f.truncate(0)
-                        f.truncate(len)
-                        self.files[self.name] = f
+                        self.blocksizes[self.name] = length
+                        npages = (length + self.TARGET_PAGE_SIZE - 1) // self.TARGET_PAGE_SIZE
+                        self.index[self.name] = array.array(INDEX_TYPECODE, [self.PAGE_NOT_SENT]) * npages
                 flags &= ~self.RAM_SAVE_FLAG_MEM_SIZE
 
             if flags & self.RAM_SAVE_FLAG_COMPRESS:
-                if flags & self.RAM_SAVE_FLAG_CONTINUE:
-                    flags &= ~self.RAM_SAVE_FLAG_CONTINUE
-                else:
-                    self.name = self.file.readstr()
-                fill_char = self.file.read8()
+                flags = self.read_block_name(flags)
+                fill_char = self.file.readu8()
                 # The page in question is filled with fill_char now
-                if self.write_memory and fill_char != 0:
-                    self.files[self.name].seek(addr, os.SEEK_SET)
-                    self.files[self.name].write(chr(fill_char) * self.TARGET_PAGE_SIZE)
+                if self.page_cache is not None:
+                    self.page_cache.put((self.name, addr), self.fill_page(fill_char))
+                if self.hash_pages:
+                    self.hash_fill_page(addr, fill_char)
+                if self.write_memory:
+                    self.set_index(addr, self.PAGE_FILL_BASE - fill_char)
                 if self.dump_memory:
                     self.memory['%s (0x%016x)' % (self.name, addr)] = 'Filled with 0x%02x' % fill_char
+                self.count_page('zero' if fill_char == 0 else 'fill', start, addr)
                 flags &= ~self.RAM_SAVE_FLAG_COMPRESS
             elif flags & self.RAM_SAVE_FLAG_PAGE:
-                if flags & self.RAM_SAVE_FLAG_CONTINUE:
-                    flags &= ~self.RAM_SAVE_FLAG_CONTINUE
-                else:
-                    self.name = self.file.readstr()
+                flags = self.read_block_name(flags)
+
+                if self.write_memory:
+                    self.set_index(addr, self.file.tell())
 
-                if self.write_memory or self.dump_memory:
-                    data = self.file.readvar(size = self.TARGET_PAGE_SIZE)
+                if self.page_cache is not None:
+                    data = self.file.readview(self.TARGET_PAGE_SIZE)
+                    self.page_cache.put((self.name, addr), data)
+                    if self.hash_pages:
+                        self.hash_page(addr, data)
                 else: # Just skip RAM data
-                    self.file.file.seek(self.TARGET_PAGE_SIZE, 1)
+                    self.file.seek(self.TARGET_PAGE_SIZE, os.SEEK_CUR)
 
-                if self.write_memory:
-                    self.files[self.name].seek(addr, os.SEEK_SET)
-                    self.files[self.name].write(data)
                 if self.dump_memory:
-                    hexdata = " ".join("{0:02x}".format(ord(c)) for c in data)
+                    hexdata = " ".join("{0:02x}".format(c) for c in bytearray(data))
                     self.memory['%s (0x%016x)' % (self.name, addr)] = hexdata
 
+                self.count_page('normal', start, addr)
                 flags &= ~self.RAM_SAVE_FLAG_PAGE
             elif flags & self.RAM_SAVE_FLAG_XBZRLE:
-                raise Exception("XBZRLE RAM compression is not supported yet")
+                flags = self.read_block_name(flags)
+                xh_flags = self.file.readu8()
+                if xh_flags != self.ENCODING_FLAG_XBZRLE:
+                    raise Exception("Unknown XBZRLE encoding %x" % xh_flags)
+                xh_len = self.file.readu16()
+                if xh_len > self.TARGET_PAGE_SIZE:
+                    raise Exception("XBZRLE page length overflow: %d" % xh_len)
+
+                if self.page_cache is not None:
+                    encoded = self.file.readview(xh_len)
+                    self.store_decoded(addr, xbzrle_decode(encoded, self.previous_page(addr)))
+                else:
+                    self.file.seek(xh_len, os.SEEK_CUR)
+
+                self.count_page('xbzrle', start, addr)
+                flags &= ~self.RAM_SAVE_FLAG_XBZRLE
+            elif flags & self.RAM_SAVE_FLAG_COMPRESS_PAGE:
+                flags = self.read_block_name(flags)
+                blen = self.file.readu32()
+
+                if self.page_cache is not None:
+                    data = zlib.decompress(self.file.readview(blen))
+                    if len(data) != self.TARGET_PAGE_SIZE:
+                        raise Exception("Compressed page has wrong size %d" % len(data))
+                    self.store_decoded(addr, data)
+                else:
+                    self.file.seek(blen, os.SEEK_CUR)
+
+                self.count_page('compressed', start, addr)
+                flags &= ~self.RAM_SAVE_FLAG_COMPRESS_PAGE
             elif flags & self.RAM_SAVE_FLAG_HOOK:
                 raise Exception("RAM hooks don't make sense with files")
 
@@ -214,11 +728,73 @@ class RamSection(object):
             if flags != 0:
                 raise Exception("Unknown RAM flags: %x" % flags)
 
-    def __del__(self):
-        if self.write_memory:
-            for key in self.files:
-                self.files[key].close()
+    def extract_pages(self, fd, name, first, last):
+        page_size = self.TARGET_PAGE_SIZE
+        zero_page = b'\0' * page_size
+        src_fd = self.file.fileno()
+        copy_file_range = getattr(os, 'copy_file_range', None)
+        pages = self.index[name]
+        for i in range(first, last):
+            offset = pages[i]
+            if offset >= 0:
+                data = self.file.view[offset:offset + page_size]
+                # Zero pages stay holes in the sparse output file
+                if data == zero_page:
+                    continue
+                if copy_file_range:
+                    try:
+                        copy_file_range(src_fd, fd, page_size, offset, i * page_size)
+                        continue
+                    except OSError:
+                        copy_file_range = None
+                pwrite(fd, data, i * page_size)
+            elif offset <= self.PAGE_SPILL_BASE:
+                data = self.spilled_page(self.PAGE_SPILL_BASE - offset)
+                if data != zero_page:
+                    pwrite(fd, data, i * page_size)
+            elif offset < self.PAGE_FILL_BASE:
+                fill_char = self.PAGE_FILL_BASE - offset
+                pwrite(fd, struct.pack('B', fill_char) * page_size, i * page_size)
+
+    def extract(self):
+        # Write the latest copy of every page into one sparse file per
+        # RAM block, splitting each block between self.jobs threads
+        if self.spill is not None:
+            # Mapped, the spilled pages can be read from all threads
+            self.spill.flush()
+            self.spill_map = mmap.mmap(self.spill.fileno(),
+                                       self.spill_slots * self.TARGET_PAGE_SIZE,
+                                       access = mmap.ACCESS_READ)
+        for name, size in self.blocksizes.items():
+            print(name)
+            mkdir_p('./' + os.path.dirname(name))
+            with open('./' + name, "wb") as f:
+                f.truncate(size)
+                pages = self.index[name]
+                chunk = max((len(pages) + self.jobs - 1) // self.jobs, 1)
+                threads = []
+                for first in range(0, len(pages), chunk):
+                    last = min(first + chunk, len(pages))
+                    t = threading.Thread(target=self.extract_pages,
+                                         args=(f.fileno(), name, first, last))
+                    t.start()
+                    threads.append(t)
+                for t in threads:
+                    t.join()
+
+
+class RawSection(object):
+    """Device state received before the VMSD description that decodes it"""
+
+    def __init__(self, section_type, version_id, section_key, data):
+        self.section_type = section_type
+        self.version_id = version_id
+        self.section_key = section_key
+        self.size = len(data)
+        self.data = data
 
+    def getDict(self):
+        return collections.OrderedDict((('undecoded bytes', self.size),))
 
 class HTABSection(object):
     HASH_PTE_SIZE_64       = 16
@@ -265,7 +841,11 @@ class ConfigurationSection(object):
         name_len = self.file.read32()
         name = self.file.readstr(len = name_len)
 
+# Field objects are created for every field of every device, so they use
+# __slots__ to keep full dumps small
 class VMSDFieldGeneric(object):
+    __slots__ = ('desc', 'file', 'data')
+
     def __init__(self, desc, file):
         self.file = file
         self.desc = desc
@@ -275,7 +855,7 @@ class VMSDFieldGeneric(object):
         return str(self.__str__())
 
     def __str__(self):
-        return " ".join("{0:02x}".format(ord(c)) for c in self.data)
+        return " ".join("{0:02x}".format(c) for c in bytearray(self.data))
 
     def getDict(self):
         return self.__str__()
@@ -285,19 +865,26 @@ class VMSDFieldGeneric(object):
         self.data = self.file.readvar(size)
         return self.data
 
+# Precompiled integer formats, indexed by endianness and size
+int_structs = {}
+for endian in '<>':
+    for size, code in ((1, 'b'), (2, 'h'), (4, 'i'), (8, 'q')):
+        int_structs[(endian, size)] = (struct.Struct(endian + code),
+                                       struct.Struct(endian + code.upper()))
+
 class VMSDFieldInt(VMSDFieldGeneric):
+    __slots__ = ('udata',)
+    endian = '>'
+
     def __init__(self, desc, file):
         super(VMSDFieldInt, self).__init__(desc, file)
-        self.size = int(desc['size'])
-        self.format = '0x%%0%dx' % (self.size * 2)
-        self.sdtype = '>i%d' % self.size
-        self.udtype = '>u%d' % self.size
 
     def __repr__(self):
+        format = '0x%%0%dx' % (int(self.desc['size']) * 2)
         if self.data < 0:
-            return ('%s (%d)' % ((self.format % self.udata), self.data))
+            return ('%s (%d)' % ((format % self.udata), self.data))
         else:
-            return self.format % self.data
+            return format % self.data
 
     def __str__(self):
         return self.__repr__()
@@ -307,12 +894,14 @@ class VMSDFieldInt(VMSDFieldGeneric):
 
     def read(self):
         super(VMSDFieldInt, self).read()
-        self.sdata = np.fromstring(self.data, count=1, dtype=(self.sdtype))[0]
-        self.udata = np.fromstring(self.data, count=1, dtype=(self.udtype))[0]
-        self.data = self.sdata
+        sdtype, udtype = int_structs[(self.endian, len(self.data))]
+        self.udata = udtype.unpack(self.data)[0]
+        self.data = sdtype.unpack(self.data)[0]
         return self.data
 
 class VMSDFieldUInt(VMSDFieldInt):
+    __slots__ = ()
+
     def __init__(self, desc, file):
         super(VMSDFieldUInt, self).__init__(desc, file)
 
@@ -322,11 +911,15 @@ class VMSDFieldUInt(VMSDFieldInt):
         return self.data
 
 class VMSDFieldIntLE(VMSDFieldInt):
+    __slots__ = ()
+    endian = '<'
+
     def __init__(self, desc, file):
         super(VMSDFieldIntLE, self).__init__(desc, file)
-        self.dtype = '<i%d' % self.size
 
 class VMSDFieldBool(VMSDFieldGeneric):
+    __slots__ = ()
+
     def __init__(self, desc, file):
         super(VMSDFieldBool, self).__init__(desc, file)
 
@@ -341,13 +934,14 @@ class VMSDFieldBool(VMSDFieldGeneric):
 
     def read(self):
         super(VMSDFieldBool, self).read()
-        if self.data[0] == 0:
+        if bytearray(self.data)[0] == 0:
             self.data = False
         else:
             self.data = True
         return self.data
 
 class VMSDFieldStruct(VMSDFieldGeneric):
+    __slots__ = ()
     QEMU_VM_SUBSECTION    = 0x05
 
     def __init__(self, desc, file):
@@ -363,7 +957,7 @@ class VMSDFieldStruct(VMSDFieldGeneric):
             array_len = field.pop('array_len')
             field['index'] = 0
             new_fields.append(field)
-            for i in xrange(1, array_len):
+            for i in range(1, array_len):
                 c = field.copy()
                 c['index'] = i
                 new_fields.append(c)
@@ -383,8 +977,10 @@ class VMSDFieldStruct(VMSDFieldGeneric):
             except:
                 reader = VMSDFieldGeneric
 
-            field['data'] = reader(field, self.file)
-            field['data'].read()
+            # Do not keep the field in its description, which is shared
+            # by every instance of the struct
+            data = reader(field, self.file)
+            data.read()
 
             if 'index' in field:
                 if field['name'] not in self.data:
@@ -392,9 +988,9 @@ class VMSDFieldStruct(VMSDFieldGeneric):
                 a = self.data[field['name']]
                 if len(a) != int(field['index']):
                     raise Exception("internal index of data field unmatched (%d/%d)" % (len(a), int(field['index'])))
-                a.append(field['data'])
+                a.append(data)
             else:
-                self.data[field['name']] = field['data']
+                self.data[field['name']] = data
 
         if 'subsections' in self.desc['struct']:
             for subsection in self.desc['struct']['subsections']:
@@ -462,7 +1058,26 @@ vmsd_field_readers = {
     "unknown" : VMSDFieldGeneric,
 }
 
+def vmsd_skip_struct(file, desc):
+    # Advance over a VMSD struct without decoding its fields
+    for field in desc['fields']:
+        count = field.get('array_len', 1)
+        if field['type'] == 'struct':
+            for i in range(count):
+                vmsd_skip_struct(file, field['struct'])
+        else:
+            file.seek(int(field['size']) * count, os.SEEK_CUR)
+
+    for subsection in desc.get('subsections', []):
+        if file.read8() != VMSDFieldStruct.QEMU_VM_SUBSECTION:
+            raise Exception("Subsection %s not found at offset %x" % ( subsection['vmsd_name'], file.tell()))
+        file.readstr()
+        file.read32()
+        vmsd_skip_struct(file, subsection)
+
 class VMSDSection(VMSDFieldStruct):
+    __slots__ = ('vmsd_name', 'section_key')
+
     def __init__(self, file, version_id, device, section_key):
         self.file = file
         self.data = ""
@@ -475,6 +1090,53 @@ class VMSDSection(VMSDFieldStruct):
         # A section really is nothing but a FieldStruct :)
         super(VMSDSection, self).__init__({ 'struct' : desc }, file)
 
+class LazySection(object):
+    """A device section that is only decoded when it is looked at"""
+    __slots__ = ('file', 'offset', 'version_id', 'device', 'section_key')
+
+    def __init__(self, file, version_id, device, section_key):
+        self.file = file
+        self.offset = file.tell()
+        self.version_id = version_id
+        self.device = device
+        self.section_key = section_key
+
+    def read(self):
+        vmsd_skip_struct(self.file, self.device)
+
+    def decode(self):
+        self.file.seek(self.offset)
+        section = VMSDSection(self.file, self.version_id, self.device, self.section_key)
+        section.read()
+        return section
+
+    def getDict(self):
+        return self.decode().getDict()
+
+def query_children(value):
+    # Named children of a node of the decoded state
+    if isinstance(value, LazySection):
+        value = value.decode()
+    if isinstance(value, VMSDFieldStruct):
+        return list(value.data.items())
+    if isinstance(value, (RamSection, HTABSection, RawSection)):
+        value = value.getDict()
+    if isinstance(value, dict):
+        return list(value.items())
+    if isinstance(value, list):
+        return [(str(i), v) for i, v in enumerate(value)]
+    return []
+
+def query_value(value):
+    if isinstance(value, list):
+        return [query_value(v) for v in value]
+    if isinstance(value, dict):
+        return collections.OrderedDict((k, query_value(v)) for k, v in value.items())
+    try:
+        return value.getDict()
+    except AttributeError:
+        return value
+
 ###############################################################################
 
 class MigrationDump(object):
@@ -495,11 +1157,14 @@ class MigrationDump(object):
                                  ( 'spapr/htab', 0) : ( HTABSection, None ) }
         self.filename = filename
         self.vmsd_desc = None
-
-    def read(self, desc_only = False, dump_memory = False, write_memory = False):
-        # Read in the whole file
-        file = MigrationFile(self.filename)
-
+        self.file = None
+        # Whether a streamed migration has section footers, None until
+        # the end of its first decoded section
+        self.stream_footers = None
+        # Device sections are only decoded when looked at
+        self.vmsd_class = VMSDSection
+
+    def read_header(self, file):
         # File magic
         data = file.read32()
         if data != self.QEMU_VM_FILE_MAGIC:
@@ -510,6 +1175,26 @@ class MigrationDump(object):
         if data != self.QEMU_VM_FILE_VERSION:
             raise Exception("Invalid version number %d" % data)
 
+    def ram_args(self, page_size, dump_memory, write_memory, jobs,
+                 page_cache_size, stats, hash_pages = False):
+        ramargs = {}
+        ramargs['page_size'] = page_size
+        ramargs['dump_memory'] = dump_memory
+        ramargs['write_memory'] = write_memory
+        ramargs['jobs'] = jobs
+        ramargs['page_cache_pages'] = page_cache_size // page_size
+        ramargs['stats'] = stats
+        ramargs['hash_pages'] = hash_pages
+        self.section_classes[('ram',0)][1] = ramargs
+
+    def read(self, desc_only = False, dump_memory = False, write_memory = False,
+             jobs = 1, page_cache_size = 256 * 1024 * 1024, stats = False,
+             lazy = False, hash_pages = False):
+        # Read in the whole file
+        file = MigrationFile(self.filename)
+        if lazy and not stats:
+            self.vmsd_class = LazySection
+        self.read_header(file)
         self.load_vmsd_json(file)
 
         # Read sections
@@ -518,13 +1203,102 @@ class MigrationDump(object):
         if desc_only:
             return
 
-        ramargs = {}
-        ramargs['page_size'] = self.vmsd_desc['page_size']
-        ramargs['dump_memory'] = dump_memory
-        ramargs['write_memory'] = write_memory
-        self.section_classes[('ram',0)][1] = ramargs
+        self.ram_args(self.vmsd_desc['page_size'], dump_memory, write_memory,
+                      jobs, page_cache_size, stats, hash_pages)
+        self.file_size = file.size
+        self.read_sections(file, stats)
+
+        for section in self.sections.values():
+            if isinstance(section, RamSection):
+                if write_memory:
+                    section.extract()
+                section.release()
+        if self.vmsd_class is LazySection:
+            # Lazy sections are decoded from the file later
+            self.file = file
+        else:
+            file.close()
+
+    def close(self):
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+
+    def read_stream(self, stream, page_size = 4096, dump_memory = False,
+                    page_cache_size = 256 * 1024 * 1024, stats = False,
+                    interval = 1.0):
+        """Read a migration stream from a pipe or socket, as it is sent
+
+           The VMSD description only follows the end of the stream, so
+           device state is kept undecoded until it has been received.
+           RAM is parsed right away with a page size of @page_size, and
+           progress is reported on stderr every @interval seconds."""
+        self.report_start = self.report_time = time.time()
+        self.report_bytes = 0
+        self.sections = collections.OrderedDict()
+        self.stream_footers = None
+        file = MigrationStream(stream, self.filename, self.report_progress, interval)
+        self.read_header(file)
+        self.ram_args(page_size, dump_memory, False, 1, page_cache_size, stats)
+        self.read_sections(file, stats)
+
+        # The description is optional, a stream can end right after EOF
+        if not file.at_eof():
+            section_type = file.readu8()
+            if section_type != self.QEMU_VM_VMDESCRIPTION:
+                raise Exception("Unknown section type after EOF: %d" % section_type)
+            jsonlen = file.readu32()
+            self.load_vmsd_desc(file.readview(jsonlen).decode('utf-8'))
+            if self.vmsd_desc['page_size'] != page_size:
+                raise Exception("Stream page size is %d, retry with --page-size %d" %
+                                (self.vmsd_desc['page_size'], self.vmsd_desc['page_size']))
+            if not stats:
+                self.decode_raw_sections()
+
+        self.file_size = file.tell()
+        self.report_progress(self.file_size, final = True)
+        for section in self.sections.values():
+            if isinstance(section, RamSection):
+                section.release()
+        file.close()
+
+    def report_progress(self, received, final = False):
+        now = time.time()
+        if final:
+            rate = received / max(now - self.report_start, 1e-6)
+        else:
+            rate = (received - self.report_bytes) / max(now - self.report_time, 1e-6)
+        self.report_time = now
+        self.report_bytes = received
+        pages = ''
+        for section in self.sections.values():
+            if isinstance(section, RamSection):
+                pages = ', pages: ' + ' '.join('%s %d' % (kind, section.stats[kind]['pages'])
+                                               for kind in RamSection.PAGE_KINDS)
+        sys.stderr.write('%s%.1f MiB received, %.1f MiB/s%s\n' %
+                         ('done: ' if final else '', received / 1048576.0,
+                          rate / 1048576.0, pages))
+        sys.stderr.flush()
+
+    def decode_raw_sections(self):
+        for section_id, raw in list(self.sections.items()):
+            if not isinstance(raw, RawSection):
+                continue
+            file = MigrationStream(io.BytesIO(raw.data), "section %d" % section_id)
+            classdesc = self.section_classes[raw.section_key]
+            section = classdesc[0](file, raw.version_id, classdesc[1], raw.section_key)
+            section.read()
+            self.sections[section_id] = section
+
+    def read_sections(self, file, stats):
+        # In stats mode, device state is skipped instead of decoded, and
+        # only the size of every section is recorded
+        self.section_stats = collections.OrderedDict()
+        # Sections that were started and have not ended yet
+        open_sections = set()
 
         while True:
+            start = file.tell()
             section_type = file.read8()
             if section_type == self.QEMU_VM_EOF:
                 break
@@ -537,27 +1311,66 @@ class MigrationDump(object):
                 instance_id = file.read32()
                 version_id = file.read32()
                 section_key = (name, instance_id)
+                if section_type == self.QEMU_VM_SECTION_START:
+                    open_sections.add(section_id)
+                if stats:
+                    self.section_stats[section_id] = collections.OrderedDict(
+                        (('name', name), ('instance', instance_id), ('parts', 0), ('bytes', 0)))
+                if section_key not in self.section_classes and isinstance(file, MigrationStream):
+                    # No description yet, keep the state until it arrives
+                    if self.stream_footers is False:
+                        raise Exception("%s has no section footers (old machine type or "
+                                        "send-section-footer=off), its device state cannot "
+                                        "be decoded as a stream, save it to a file first" %
+                                        self.filename)
+                    data = file.read_until_footer(section_id, open_sections)
+                    self.stream_footers = True
+                    self.sections[section_id] = RawSection(section_type, version_id, section_key, data)
+                    if stats:
+                        self.section_stats[section_id]['parts'] += 1
+                        self.section_stats[section_id]['bytes'] += file.tell() - start
+                        self.sections[section_id].data = None
+                    continue
                 classdesc = self.section_classes[section_key]
-                section = classdesc[0](file, version_id, classdesc[1], section_key)
-                self.sections[section_id] = section
-                section.read()
+                if stats and classdesc[0] in (VMSDSection, LazySection):
+                    vmsd_skip_struct(file, classdesc[1])
+                else:
+                    section = classdesc[0](file, version_id, classdesc[1], section_key)
+                    self.sections[section_id] = section
+                    section.read()
             elif section_type == self.QEMU_VM_SECTION_PART or section_type == self.QEMU_VM_SECTION_END:
                 section_id = file.read32()
+                if section_type == self.QEMU_VM_SECTION_END:
+                    open_sections.discard(section_id)
+                if isinstance(self.sections[section_id], RawSection):
+                    raise Exception("Cannot decode section %d before its description" % section_id)
                 self.sections[section_id].read()
             elif section_type == self.QEMU_VM_SECTION_FOOTER:
                 read_section_id = file.read32()
                 if read_section_id != section_id:
                     raise Exception("Mismatched section footer: %x vs %x" % (read_section_id, section_id))
+                if stats:
+                    self.section_stats[section_id]['bytes'] += file.tell() - start
+                continue
             else:
                 raise Exception("Unknown section type: %d" % section_type)
-        file.close()
+
+            if stats and section_type != self.QEMU_VM_CONFIGURATION:
+                self.section_stats[section_id]['parts'] += 1
+                self.section_stats[section_id]['bytes'] += file.tell() - start
+
+            if (isinstance(file, MigrationStream) and self.stream_footers is None and
+                    section_type != self.QEMU_VM_CONFIGURATION):
+                self.stream_footers = file.peek8() == self.QEMU_VM_SECTION_FOOTER
 
     def load_vmsd_json(self, file):
-        vmsd_json = file.read_migration_debug_json()
+        self.load_vmsd_desc(file.read_migration_debug_json())
+
+    def load_vmsd_desc(self, vmsd_json):
         self.vmsd_desc = json.loads(vmsd_json, object_pairs_hook=collections.OrderedDict)
         for device in self.vmsd_desc['devices']:
             key = (device['name'], device['instance_id'])
-            value = ( VMSDSection, device )
+            value = ( self.vmsd_class, device )
             self.section_classes[key] = value
 
     def getDict(self):
@@ -567,6 +1380,52 @@ class MigrationDump(object):
            r[key] = value.getDict()
         return r
 
+    def query(self, paths):
+        """Return the values at "/"-separated @paths in the state, whose
+           components are glob patterns.  The first one matches either
+           "name (section id)" or just the section name."""
+        r = collections.OrderedDict()
+        for path in paths:
+            components = path.strip('/').split('/')
+            matches = []
+            for (key, value) in self.sections.items():
+                name = value.section_key[0]
+                key = "%s (%d)" % (name, key)
+                if fnmatch.fnmatchcase(key, components[0]) or fnmatch.fnmatchcase(name, components[0]):
+                    matches.append((key, value))
+            for component in components[1:]:
+                matches = [(key + '/' + child, value)
+                           for (key, node) in matches
+                           for (child, value) in query_children(node)
+                           if fnmatch.fnmatchcase(child, component)]
+            for (key, value) in matches:
+                r[key] = query_value(value)
+        return r
+
+    def getStats(self):
+        r = collections.OrderedDict()
+        r['file size'] = self.file_size
+        r['sections'] = list(self.section_stats.values())
+        r['ram blocks'] = []
+        for section in self.sections.values():
+            if isinstance(section, RamSection):
+                r['ram blocks'].extend(section.getStats())
+                r['page statistics'] = section.stats
+        return r
+
+    def writeStatsCSV(self, out):
+        stats = self.getStats()
+        w = csv.writer(out)
+        w.writerow(['type', 'name', 'instance', 'parts', 'bytes', 'pages',
+                    'unique pages', 'resent pages', 'size'])
+        for section in stats['sections']:
+            w.writerow(['section', section['name'], section['instance'],
+                        section['parts'], section['bytes'], '', '', '', ''])
+        for block in stats['ram blocks']:
+            w.writerow(['ramblock', block['name'], '', '', block['bytes'],
+                        block['pages'], block['unique pages'],
+                        block['resent pages'], block['size']])
+
 ###############################################################################
 
 class JSONEncoder(json.JSONEncoder):
@@ -575,40 +1434,130 @@ class JSONEncoder(json.JSONEncoder):
             return str(o)
         return json.JSONEncoder.default(self, o)
 
-parser = argparse.ArgumentParser()
-parser.add_argument("-f", "--file", help='migration dump to read from', required=True)
-parser.add_argument("-m", "--memory", help='dump RAM contents as well', action='store_true')
-parser.add_argument("-d", "--dump", help='what to dump ("state" or "desc")', default='state')
-parser.add_argument("-x", "--extract", help='extract contents into individual files', action='store_true')
-args = parser.parse_args()
-
-jsonenc = JSONEncoder(indent=4, separators=(',', ': '))
-
-if args.extract:
-    dump = MigrationDump(args.file)
-
-    dump.read(desc_only = True)
-    print("desc.json")
-    f = open("desc.json", "wb")
-    f.truncate()
-    f.write(jsonenc.encode(dump.vmsd_desc))
-    f.close()
-
-    dump.read(write_memory = True)
-    dict = dump.getDict()
-    print("state.json")
-    f = open("state.json", "wb")
-    f.truncate()
-    f.write(jsonenc.encode(dict))
-    f.close()
-elif args.dump == "state":
-    dump = MigrationDump(args.file)
-    dump.read(dump_memory = args.memory)
-    dict = dump.getDict()
-    print(jsonenc.encode(dict))
-elif args.dump == "desc":
-    dump = MigrationDump(args.file)
-    dump.read(desc_only = True)
-    print(jsonenc.encode(dump.vmsd_desc))
-else:
-    raise Exception("Please specify either -x, -d state or -d dump")
+def open_stream(spec):
+    """Open "-" (stdin), "unix:PATH", "tcp:HOST:PORT" or a pipe"""
+    if spec == "-":
+        return getattr(sys.stdin, 'buffer', sys.stdin)
+    if spec.startswith("unix:") or spec.startswith("tcp:"):
+        if spec.startswith("unix:"):
+            sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            sock.bind(spec[5:])
+        else:
+            host, port = spec[4:].rsplit(":", 1)
+            sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            sock.bind((host, int(port)))
+        sock.listen(1)
+        sys.stderr.write("Waiting for a migration on %s\n" % spec)
+        conn, _ = sock.accept()
+        sock.close()
+        return conn.makefile('rb')
+    return open(spec, "rb")
+
+def is_stream(spec):
+    if spec == "-" or spec.startswith("unix:") or spec.startswith("tcp:"):
+        return True
+    return os.path.exists(spec) and not stat.S_ISREG(os.stat(spec).st_mode)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-f", "--file", help='migration dump to read from; "-" (stdin), a pipe, '
+                        '"unix:PATH" or "tcp:HOST:PORT" (listen for one migration) are read as a stream',
+                        required=True)
+    parser.add_argument("-m", "--memory", help='dump RAM contents as well', action='store_true')
+    parser.add_argument("-d", "--dump", help='what to dump ("state" or "desc")', default='state')
+    parser.add_argument("-x", "--extract", help='extract contents into individual files', action='store_true')
+    parser.add_argument("-j", "--jobs", help='number of threads writing extracted RAM (default: number of CPUs)',
+                        type=int, default=multiprocessing.cpu_count())
+    parser.add_argument("--page-cache", help='size in MiB of the cache of decoded pages used for XBZRLE (default: 256)',
+                        type=int, default=256)
+    parser.add_argument("-s", "--stats", help='only report per-section and per-RAM-block sizes and page counts',
+                        action='store_true')
+    parser.add_argument("--format", help='output format of --stats', choices=['json', 'csv'], default='json')
+    parser.add_argument("--stream", help='read the file as a stream, while it is being written; '
+                        'streams must have section footers, which old machine types and '
+                        'send-section-footer=off disable',
+                        action='store_true')
+    parser.add_argument("--page-size", help='target page size of a streamed migration (default: 4096)',
+                        type=int, default=4096)
+    parser.add_argument("--interval", help='seconds between progress reports of a streamed migration (default: 1)',
+                        type=float, default=1.0)
+    parser.add_argument("--lazy", help='only decode device state when it is printed, to save memory',
+                        action='store_true')
+    parser.add_argument("-q", "--query", help='only print the state at these paths, e.g. "apic (3)/timer" '
+                        'or "kvm-tpr-opt/*"; components are glob patterns', nargs='+')
+    args = parser.parse_args()
+
+    jsonenc = JSONEncoder(indent=4, separators=(',', ': '))
+
+    if args.stream or is_stream(args.file):
+        if args.extract:
+            raise Exception("Cannot extract a streamed migration, save it to a file first")
+        dump = MigrationDump(args.file)
+        dump.read_stream(open_stream(args.file), page_size = args.page_size,
+                         dump_memory = args.memory and not args.stats,
+                         page_cache_size = args.page_cache * 1024 * 1024,
+                         stats = args.stats, interval = args.interval)
+        if args.stats and args.format == "csv":
+            dump.writeStatsCSV(sys.stdout)
+        elif args.stats:
+            print(json.dumps(dump.getStats(), separators=(',', ':')))
+        elif args.dump == "desc":
+            print(jsonenc.encode(dump.vmsd_desc))
+        elif args.query:
+            print(jsonenc.encode(dump.query(args.query)))
+        else:
+            print(jsonenc.encode(dump.getDict()))
+    elif args.stats:
+        dump = MigrationDump(args.file)
+        dump.read(stats = True)
+        if args.format == "csv":
+            dump.writeStatsCSV(sys.stdout)
+        else:
+            print(json.dumps(dump.getStats(), separators=(',', ':')))
+    elif args.extract:
+        dump = MigrationDump(args.file)
+
+        dump.read(desc_only = True)
+        print("desc.json")
+        f = open("desc.json", "w")
+        f.truncate()
+        f.write(jsonenc.encode(dump.vmsd_desc))
+        f.close()
+
+        dump.read(write_memory = True, jobs = max(args.jobs, 1),
+                  page_cache_size = args.page_cache * 1024 * 1024)
+        dict = dump.getDict()
+        print("state.json")
+        f = open("state.json", "w")
+        f.truncate()
+        f.write(jsonenc.encode(dict))
+        f.close()
+    elif args.query:
+        dump = MigrationDump(args.file)
+        dump.read(dump_memory = args.memory, lazy = True,
+                  page_cache_size = args.page_cache * 1024 * 1024)
+        print(jsonenc.encode(dump.query(args.query)))
+        dump.close()
+    elif args.dump == "state":
+        dump = MigrationDump(args.file)
+        dump.read(dump_memory = args.memory, lazy = args.lazy,
+                  page_cache_size = args.page_cache * 1024 * 1024)
+        if args.lazy:
+            # Encode one section at a time, so that only one is decoded
+            print("{")
+            for (i, (key, value)) in enumerate(dump.sections.items()):
+                key = "%s (%d)" % (value.section_key[0], key)
+                item = jsonenc.encode({ key : value.getDict() })
+                print(item[2:-2] + ("," if i < len(dump.sections) - 1 else ""))
+            print("}")
+        else:
+            dict = dump.getDict()
+            print(jsonenc.encode(dict))
+        dump.close()
+    elif args.dump == "desc":
+        dump = MigrationDump(args.file)
+        dump.read(desc_only = True)
+        print(jsonenc.encode(dump.vmsd_desc))
+    else:
+        raise Exception("Please specify either -x, -d state or -d dump")
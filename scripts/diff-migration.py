@@ -0,0 +1,204 @@
+#!/usr/bin/env python
+#
+#  Migration Stream Diff
+#
+#  Compare two migration streams saved to files, e.g. two checkpoints of
+#  the same guest, and report which RAM pages and which device state
+#  changed between them.
+#
+#  Copyright (c) 2019 Red Hat Inc.
+#
+# This library is free software; you can redistribute it and/or
+# modify it under the terms of the GNU Lesser General Public
+# License as published by the Free Software Foundation; either
+# version 2 of the License, or (at your option) any later version.
+#
+# This library is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public
+# License along with this library; if not, see <http://www.gnu.org/licenses/>.
+
+from __future__ import print_function
+import argparse
+import collections
+import os
+import struct
+
+def load_analyzer():
+    # analyze-migration.py is not a valid module name, load it by path
+    path = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                        'analyze-migration.py')
+    try:
+        import importlib.util
+        spec = importlib.util.spec_from_file_location('analyze_migration', path)
+        module = importlib.util.module_from_spec(spec)
+        spec.loader.exec_module(module)
+    except ImportError:
+        import imp
+        module = imp.load_source('analyze_migration', path)
+    return module
+
+analyze = load_analyzer()
+
+# Number of page hashes compared at once
+CHUNK_PAGES = 65536
+
+def ram_hashes(dump):
+    for section in dump.sections.values():
+        if isinstance(section, analyze.RamSection):
+            return section.hashes
+    return collections.OrderedDict()
+
+def diff_block(name, old, new, page_size, granularity):
+    r = collections.OrderedDict()
+    r['name'] = name
+    npages = min(old.npages, new.npages)
+    # Pages that only exist in one of the streams count as changed
+    extra = max(old.npages, new.npages) - npages
+    r['pages'] = max(old.npages, new.npages)
+    r['changed pages'] = extra
+    r['modified'] = 0
+    r['zeroed'] = 0
+    r['populated'] = 0
+    r['runs'] = 1 if extra else 0
+    distribution = collections.OrderedDict()
+
+    in_run = False
+    for ((first, a), (_, b)) in zip(old.chunks(CHUNK_PAGES, npages),
+                                     new.chunks(CHUNK_PAGES, npages)):
+        if a == b:
+            in_run = False
+            continue
+        count = len(a) // analyze.PageHashes.HASH.size
+        a = struct.unpack('=%dQ' % count, a)
+        b = struct.unpack('=%dQ' % count, b)
+        for i in range(count):
+            if a[i] == b[i]:
+                in_run = False
+                continue
+            if not in_run:
+                r['runs'] += 1
+                in_run = True
+            r['changed pages'] += 1
+            if b[i] == 0:
+                r['zeroed'] += 1
+            elif a[i] == 0:
+                r['populated'] += 1
+            else:
+                r['modified'] += 1
+            bucket = (first + i) * page_size // granularity * granularity
+            key = '0x%016x' % bucket
+            distribution[key] = distribution.get(key, 0) + 1
+
+    if extra:
+        bucket = npages * page_size // granularity * granularity
+        key = '0x%016x' % bucket
+        distribution[key] = distribution.get(key, 0) + extra
+    r['changed bytes'] = r['changed pages'] * page_size
+    r['distribution'] = distribution
+    return r
+
+def diff_ram(old, new, page_size, granularity):
+    old_hashes = ram_hashes(old)
+    new_hashes = ram_hashes(new)
+    blocks = []
+    for name in old_hashes:
+        if name in new_hashes:
+            blocks.append(diff_block(name, old_hashes[name], new_hashes[name],
+                                     page_size, granularity))
+    added = [name for name in new_hashes if name not in old_hashes]
+    removed = [name for name in old_hashes if name not in new_hashes]
+    return blocks, added, removed
+
+def diff_state(path, old, new, changes):
+    if isinstance(old, dict) and isinstance(new, dict):
+        for key in old:
+            if key in new:
+                diff_state(path + '/' + key, old[key], new[key], changes)
+            else:
+                changes.append(collections.OrderedDict(
+                    (('path', path + '/' + key), ('old', old[key]), ('new', None))))
+        for key in new:
+            if key not in old:
+                changes.append(collections.OrderedDict(
+                    (('path', path + '/' + key), ('old', None), ('new', new[key]))))
+    elif isinstance(old, list) and isinstance(new, list) and len(old) == len(new):
+        for i in range(len(old)):
+            diff_state('%s/%d' % (path, i), old[i], new[i], changes)
+    elif old != new:
+        changes.append(collections.OrderedDict(
+            (('path', path), ('old', old), ('new', new))))
+
+def device_sections(dump):
+    r = collections.OrderedDict()
+    for section in dump.sections.values():
+        if not isinstance(section, analyze.RamSection):
+            r[section.section_key] = section
+    return r
+
+def diff_devices(old, new):
+    old_sections = device_sections(old)
+    new_sections = device_sections(new)
+    changes = []
+    for key in old_sections:
+        if key not in new_sections:
+            continue
+        # Only one pair of sections is decoded at a time
+        diff_state("%s (instance %d)" % key, old_sections[key].getDict(),
+                   new_sections[key].getDict(), changes)
+    added = ["%s (instance %d)" % key for key in new_sections if key not in old_sections]
+    removed = ["%s (instance %d)" % key for key in old_sections if key not in new_sections]
+    return changes, added, removed
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Compare the RAM and device state of two migration streams')
+    parser.add_argument("old", help='older migration dump')
+    parser.add_argument("new", help='newer migration dump')
+    parser.add_argument("--granularity", help='size in MiB of the regions that changed pages '
+                        'are counted in (default: 64)', type=int, default=64)
+    parser.add_argument("--page-cache", help='size in MiB of the cache of decoded pages used '
+                        'for XBZRLE (default: 256)', type=int, default=256)
+    parser.add_argument("--ram-only", help='do not compare device state', action='store_true')
+    args = parser.parse_args()
+
+    dumps = []
+    for filename in (args.old, args.new):
+        dump = analyze.MigrationDump(filename)
+        dump.read(lazy = True, hash_pages = True,
+                  page_cache_size = args.page_cache * 1024 * 1024)
+        dumps.append(dump)
+    old, new = dumps
+
+    page_size = old.vmsd_desc['page_size']
+    if new.vmsd_desc['page_size'] != page_size:
+        raise Exception("Page sizes differ: %d vs %d" %
+                        (page_size, new.vmsd_desc['page_size']))
+
+    r = collections.OrderedDict()
+    blocks, added, removed = diff_ram(old, new, page_size,
+                                      max(args.granularity, 1) * 1024 * 1024)
+    r['changed pages'] = sum(block['changed pages'] for block in blocks)
+    r['changed bytes'] = r['changed pages'] * page_size
+    r['ram blocks'] = blocks
+    r['added ram blocks'] = added
+    r['removed ram blocks'] = removed
+    if not args.ram_only:
+        changes, added, removed = diff_devices(old, new)
+        r['device changes'] = changes
+        r['added devices'] = added
+        r['removed devices'] = removed
+
+    for dump in dumps:
+        for hashes in ram_hashes(dump).values():
+            hashes.close()
+        dump.close()
+
+    jsonenc = analyze.JSONEncoder(indent=4, separators=(',', ': '))
+    print(jsonenc.encode(r))
+
+if __name__ == '__main__':
+    main()
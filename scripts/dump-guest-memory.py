@@ -14,8 +14,16 @@ the COPYING file in the top-level directory.
 """
 from __future__ import print_function
 
+import collections
 import ctypes
+import mmap
+import multiprocessing
+import multiprocessing.pool
+import os
+import re
 import struct
+import sys
+import zlib
 
 try:
     UINTPTR_T = gdb.lookup_type("uintptr_t")
@@ -27,6 +35,13 @@ except Exception as inst:
 TARGET_PAGE_SIZE = 0x1000
 TARGET_PAGE_MASK = 0xFFFFFFFFFFFFF000
 
+# Bounds for the size of gdb memory reads. The chunk size grows while
+# reads succeed and shrinks when they fail, down to a single page.
+MIN_CHUNK_SIZE = TARGET_PAGE_SIZE
+MAX_CHUNK_SIZE = 64 << 20
+
+ZERO_PAGE = bytes(bytearray(TARGET_PAGE_SIZE))
+
 # Special value for e_phnum. This indicates that the real number of
 # program headers is too large to fit into e_phnum. Instead the real
 # value is in the field sh_info of section 0.
@@ -54,6 +69,28 @@ EM_X86_64 = 62
 
 VMCOREINFO_FORMAT_ELF = 1
 
+# kdump-compressed format, see include/sysemu/dump.h
+DUMP_DH_COMPRESSED_ZLIB = 0x1
+DUMP_DH_COMPRESSED_LZO = 0x2
+DUMP_DH_COMPRESSED_SNAPPY = 0x4
+
+KDUMP_SIGNATURE = b"KDUMP   "
+DUMP_LEVEL = 1
+DISKDUMP_HEADER_BLOCKS = 1
+
+# Number of pages compressed by a worker at once
+KDUMP_BATCH_PAGES = 256
+
+ELF_MACHINE_UNAME = {
+    'aarch64-le': "aarch64",
+    'aarch64-be': "aarch64_be",
+    'X86_64': "x86_64",
+    '386': "i686",
+    's390': "S390X",
+    'ppc64-le': "ppc64le",
+    'ppc64-be': "ppc64",
+}
+
 def le16_to_cpu(val):
     return struct.unpack("<H", struct.pack("=H", val))[0]
 
@@ -157,14 +194,18 @@ class ELF(object):
         self.segments[0].p_filesz += ctypes.sizeof(note)
         self.segments[0].p_memsz += ctypes.sizeof(note)
 
-    def add_segment(self, p_type, p_paddr, p_size):
-        """Adds a segment to the elf."""
+    def add_segment(self, p_type, p_paddr, p_size, p_filesz=None):
+        """Adds a segment to the elf.
+
+        Memory beyond @p_filesz, if given, is not stored in the file and
+        reads as zero.
+        """
 
         phdr = get_arch_phdr(self.endianness, self.elfclass)
         phdr.p_type = p_type
         phdr.p_paddr = p_paddr
         phdr.p_vaddr = p_paddr
-        phdr.p_filesz = p_size
+        phdr.p_filesz = p_size if p_filesz is None else p_filesz
         phdr.p_memsz = p_size
         self.segments.append(phdr)
         self.ehdr.e_phnum += 1
@@ -349,6 +390,433 @@ def get_arch_phdr(endianness, elfclass):
         return PHDR32()
 
 
+class CoreFile(object):
+    """Direct access to the memory saved in a QEMU core file.
+
+    The PT_LOAD segments of the core are parsed once, so that guest RAM
+    can be copied from the core into the vmcore without going through
+    gdb.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.file = open(path, "rb")
+        self.map = None
+        self.segments = []
+
+        ident = self.file.read(16)
+        if ident[:4] != b"\x7fELF":
+            raise ValueError("%s is not an ELF file" % path)
+        endian = "<" if bytearray(ident)[5] == ELFDATA2LSB else ">"
+        if bytearray(ident)[4] == ELFCLASS64:
+            ehdr = struct.Struct(endian + "HHIQQQIHHHHHH")
+            phdr = struct.Struct(endian + "IIQQQQQQ")
+            shdr = struct.Struct(endian + "IIQQQQIIQQ")
+            fields = (2, 3, 5, 6)  # p_offset, p_vaddr, p_filesz, p_memsz
+        else:
+            ehdr = struct.Struct(endian + "HHIIIIIHHHHHH")
+            phdr = struct.Struct(endian + "IIIIIIII")
+            shdr = struct.Struct(endian + "IIIIIIIIII")
+            fields = (1, 2, 4, 5)
+        hdr = ehdr.unpack(self.file.read(ehdr.size))
+        e_phoff, e_shoff, e_phentsize, e_phnum = hdr[4], hdr[5], hdr[8], hdr[9]
+        if e_phnum == PN_XNUM:
+            # The real count is in sh_info of the first section header
+            self.file.seek(e_shoff)
+            e_phnum = shdr.unpack(self.file.read(shdr.size))[7]
+
+        for i in range(e_phnum):
+            self.file.seek(e_phoff + i * e_phentsize)
+            entry = phdr.unpack(self.file.read(phdr.size))
+            if entry[0] != PT_LOAD:
+                continue
+            offset, vaddr, filesz, memsz = [entry[f] for f in fields]
+            self.segments.append((vaddr, memsz, offset, filesz))
+        self.segments.sort()
+
+    def pieces(self, haddr, size):
+        """Splits a host range into (file offset, length) pieces.
+
+        The offset is False for memory that is not saved in the file,
+        either because no segment covers it or because it is past the
+        file size of its segment, i.e. excluded from the dump.
+        """
+
+        for vaddr, memsz, offset, filesz in self.segments:
+            if size == 0:
+                return
+            if vaddr + memsz <= haddr:
+                continue
+            if vaddr > haddr:
+                length = min(vaddr - haddr, size)
+                yield False, length
+                haddr += length
+                size -= length
+                if size == 0:
+                    return
+            while size > 0 and haddr < vaddr + memsz:
+                skip = haddr - vaddr
+                if skip < filesz:
+                    length = min(filesz - skip, size)
+                    yield offset + skip, length
+                else:
+                    # Not zero but missing, e.g. MADV_DONTDUMP memory
+                    length = min(memsz - skip, size)
+                    yield False, length
+                haddr += length
+                size -= length
+        if size:
+            yield False, size
+
+    def chunks(self, offset, length):
+        """Yields the contents of @length bytes at @offset of the core."""
+
+        if self.map is None:
+            self.map = mmap.mmap(self.file.fileno(), 0,
+                                 access=mmap.ACCESS_READ)
+        while length > 0:
+            chunk_size = min(MAX_CHUNK_SIZE, length)
+            try:
+                chunk = memoryview(self.map)[offset:offset + chunk_size]
+            except TypeError:
+                # Python 2 mmap objects do not support memoryview
+                chunk = self.map[offset:offset + chunk_size]
+            yield chunk
+            offset += chunk_size
+            length -= chunk_size
+
+    def copy(self, vmcore, offset, length):
+        """Appends @length bytes at @offset of the core to @vmcore."""
+
+        vmcore.flush()
+        dst = vmcore.tell()
+        copy_file_range = getattr(os, "copy_file_range", None)
+        try:
+            while copy_file_range and length > 0:
+                done = copy_file_range(self.file.fileno(), vmcore.fileno(),
+                                       length, offset, dst)
+                if done == 0:
+                    break
+                offset += done
+                dst += done
+                length -= done
+        except OSError:
+            # e.g. not supported by the kernel or between file systems
+            pass
+        vmcore.seek(dst)
+
+        for chunk in self.chunks(offset, length):
+            vmcore.write(chunk)
+
+    def close(self):
+        if self.map is not None:
+            self.map.close()
+        self.file.close()
+
+
+def get_core_file():
+    """Returns a CoreFile for the core being debugged, or None."""
+
+    target = gdb.execute("info target", to_string=True)
+    match = re.search(r"core dump file:\s*`(.*)', file type", target)
+    if match is None:
+        return None
+    try:
+        return CoreFile(match.group(1))
+    except (IOError, OSError, ValueError, struct.error) as err:
+        print("cannot read core file directly, using gdb: %s" % err)
+        return None
+
+
+def zero_runs(chunk):
+    """Splits a buffer into runs of zero and non-zero pages.
+
+    Yields (is_zero, start, end) tuples covering all of @chunk.
+    """
+
+    # Comparing bytes is much faster than comparing memoryviews
+    view = memoryview(chunk)
+    size = len(view)
+    zero = None
+    start = 0
+    for pos in range(0, size, TARGET_PAGE_SIZE):
+        end = min(pos + TARGET_PAGE_SIZE, size)
+        page_zero = view[pos:end].tobytes() == ZERO_PAGE[:end - pos]
+        if page_zero != zero:
+            if zero is not None:
+                yield zero, start, pos
+            zero = page_zero
+            start = pos
+    if zero is not None:
+        yield zero, start, size
+
+
+class VmcoreWriter(object):
+    """Appends guest memory to a vmcore.
+
+    In sparse mode, zero pages are not written but left as holes in
+    the file.
+    """
+
+    def __init__(self, vmcore, core=None, sparse=False):
+        self.vmcore = vmcore
+        self.core = core
+        self.sparse = sparse
+
+    def write(self, chunk):
+        if not self.sparse:
+            self.vmcore.write(chunk)
+            return
+        view = memoryview(chunk)
+        for zero, start, end in zero_runs(view):
+            if zero:
+                self.vmcore.seek(end - start, os.SEEK_CUR)
+            else:
+                self.vmcore.write(view[start:end])
+
+    def copy(self, offset, length):
+        """Appends @length bytes at @offset of the core file."""
+
+        if self.sparse:
+            for chunk in self.core.chunks(offset, length):
+                self.write(chunk)
+        else:
+            self.core.copy(self.vmcore, offset, length)
+
+    def finish(self):
+        # A hole at the end of the file is only created by truncate()
+        if self.sparse:
+            self.vmcore.truncate()
+
+
+def get_compressor(fmt):
+    """Returns the header flag and page compression function for a
+    kdump-compressed format."""
+
+    if fmt == "kdump-zlib":
+        return DUMP_DH_COMPRESSED_ZLIB, lambda page: zlib.compress(page, 1)
+    elif fmt == "kdump-lzo":
+        try:
+            import lzo
+        except ImportError:
+            raise gdb.GdbError("kdump-lzo needs the python-lzo module")
+        return DUMP_DH_COMPRESSED_LZO, lambda page: lzo.compress(page, 1, False)
+    elif fmt == "kdump-snappy":
+        try:
+            import snappy
+        except ImportError:
+            raise gdb.GdbError("kdump-snappy needs the python-snappy module")
+        return DUMP_DH_COMPRESSED_SNAPPY, snappy.compress
+    raise gdb.GdbError("unknown dump format %s" % fmt)
+
+
+def compress_pages(flag, compress, data):
+    """Compresses the pages of @data in a worker thread.
+
+    Returns a (flags, data) pair for every page, or None for zero pages.
+    Pages that do not shrink are stored uncompressed, with flags 0.
+    """
+
+    pages = []
+    for pos in range(0, len(data), TARGET_PAGE_SIZE):
+        page = data[pos:pos + TARGET_PAGE_SIZE]
+        if page == ZERO_PAGE:
+            pages.append(None)
+            continue
+        compressed = compress(page)
+        if len(compressed) < TARGET_PAGE_SIZE:
+            pages.append((flag, compressed))
+        else:
+            pages.append((0, page))
+    return pages
+
+
+def page_batches(chunks, batch_size):
+    """Regroups buffers into bytes objects of @batch_size bytes."""
+
+    buf = bytearray()
+    for chunk in chunks:
+        buf += chunk
+        while len(buf) >= batch_size:
+            yield bytes(buf[:batch_size])
+            del buf[:batch_size]
+    if buf:
+        yield bytes(buf)
+
+
+class KdumpWriter(object):
+    """Writes a vmcore in the kdump-compressed format read by crash.
+
+    The layout is the same as for the QMP command, except that the file
+    is not in the flattened format, see create_kdump_vmcore() in
+    dump/dump.c. Pages are compressed by a pool of worker threads, while
+    the main thread reads guest memory and writes the results in order.
+    """
+
+    BUFFER_SIZE = 1 << 20
+
+    def __init__(self, vmcore, elf, arch, blocks, fmt, jobs, nr_cpus):
+        self.vmcore = vmcore
+        self.elf = elf
+        self.blocks = blocks
+        self.flag, self.compress = get_compressor(fmt)
+        self.jobs = jobs
+        self.nr_cpus = nr_cpus
+        self.machine = ELF_MACHINE_UNAME[arch]
+        self.endian = "<" if elf.endianness == ELFDATA2LSB else ">"
+
+        for block in blocks:
+            assert block["target_start"] % TARGET_PAGE_SIZE == 0
+            assert block["target_end"] % TARGET_PAGE_SIZE == 0
+        self.max_mapnr = blocks[-1]["target_end"] // TARGET_PAGE_SIZE
+        self.num_dumpable = sum((block["target_end"] - block["target_start"])
+                                // TARGET_PAGE_SIZE for block in blocks)
+        bitmap_pages = -(-self.max_mapnr // 8 // TARGET_PAGE_SIZE) or 1
+        self.len_dump_bitmap = bitmap_pages * TARGET_PAGE_SIZE
+
+        self.stats = collections.Counter()
+        self.desc_buf = bytearray()
+        self.data_buf = bytearray()
+
+    def write_at(self, offset, data):
+        self.vmcore.seek(offset)
+        self.vmcore.write(data)
+
+    def write_header(self):
+        """Writes the headers, notes and bitmaps."""
+
+        endian = self.endian
+        block_size = TARGET_PAGE_SIZE
+        notes = b"".join(ctypes.string_at(ctypes.addressof(note),
+                                          ctypes.sizeof(note))
+                         for note in self.elf.notes)
+        if self.elf.elfclass == ELFCLASS64:
+            timestamp = 22
+            sub_header = struct.Struct(endian + "QIIQQQQQQQQQQQ")
+        else:
+            timestamp = 10
+            sub_header = struct.Struct(endian + "IIIIIQIQIQIQQQ")
+        sub_hdr_size = -(-(sub_header.size + len(notes)) // block_size)
+        bitmap_blocks = self.len_dump_bitmap // block_size * 2
+
+        utsname = b"\0" * 65 * 4 + \
+            self.machine.encode().ljust(65, b"\0") + b"\0" * 65
+        header = struct.pack(endian + "8sI390s%dsIIIIIIIIII" % timestamp,
+                             KDUMP_SIGNATURE, 6, utsname, b"",
+                             self.flag, block_size, sub_hdr_size,
+                             bitmap_blocks, min(self.max_mapnr, 0xffffffff),
+                             0, 0, 0, 0, self.nr_cpus)
+        self.write_at(0, header)
+
+        offset_note = DISKDUMP_HEADER_BLOCKS * block_size + sub_header.size
+        offset_vmcoreinfo = 0
+        size_vmcoreinfo = 0
+        pos = 0
+        for note in self.elf.notes:
+            if note.n_name == b"VMCOREINFO":
+                offset_vmcoreinfo = (offset_note + pos +
+                                     type(note).n_desc.offset)
+                size_vmcoreinfo = note.n_descsz
+            pos += ctypes.sizeof(note)
+        self.write_at(DISKDUMP_HEADER_BLOCKS * block_size,
+                      sub_header.pack(0, DUMP_LEVEL, 0, 0, 0,
+                                      offset_vmcoreinfo, size_vmcoreinfo,
+                                      offset_note, len(notes), 0, 0,
+                                      0, 0, self.max_mapnr))
+        self.write_at(offset_note, notes)
+
+        # Dump level 1 is used, so both bitmaps are the same: every
+        # page of guest RAM is dumped.
+        bitmap = bytearray(self.len_dump_bitmap)
+        for block in self.blocks:
+            first = block["target_start"] // TARGET_PAGE_SIZE
+            last = block["target_end"] // TARGET_PAGE_SIZE
+            while first < last and first % 8:
+                bitmap[first // 8] |= 1 << (first % 8)
+                first += 1
+            while first + 8 <= last:
+                bitmap[first // 8] = 0xff
+                first += 8
+            while first < last:
+                bitmap[first // 8] |= 1 << (first % 8)
+                first += 1
+        offset_bitmap = (DISKDUMP_HEADER_BLOCKS + sub_hdr_size) * block_size
+        self.write_at(offset_bitmap, bitmap)
+        self.write_at(offset_bitmap + self.len_dump_bitmap, bitmap)
+
+        # Page descriptors, then page data starting with the zero page
+        # that all zero pages share
+        self.offset_desc = offset_bitmap + bitmap_blocks * block_size
+        self.offset_data = self.offset_desc + 24 * self.num_dumpable
+        self.page_desc = struct.Struct(endian + "QIIQ")
+        self.zero_desc = self.page_desc.pack(self.offset_data,
+                                             TARGET_PAGE_SIZE, 0, 0)
+        self.write_at(self.offset_data, ZERO_PAGE)
+        self.offset_data += TARGET_PAGE_SIZE
+
+    def flush(self):
+        if self.desc_buf:
+            self.write_at(self.offset_desc, self.desc_buf)
+            self.offset_desc += len(self.desc_buf)
+            del self.desc_buf[:]
+        if self.data_buf:
+            self.write_at(self.offset_data, self.data_buf)
+            self.offset_data += len(self.data_buf)
+            del self.data_buf[:]
+
+    def add_pages(self, pages):
+        for page in pages:
+            if page is None:
+                self.desc_buf += self.zero_desc
+                self.stats["zero"] += 1
+                continue
+            flags, data = page
+            offset = self.offset_data + len(self.data_buf)
+            self.desc_buf += self.page_desc.pack(offset, len(data), flags, 0)
+            self.data_buf += data
+            self.stats["compressed" if flags else "plain"] += 1
+        if (len(self.desc_buf) >= self.BUFFER_SIZE or
+                len(self.data_buf) >= self.BUFFER_SIZE):
+            self.flush()
+
+    def write_pages(self, chunks):
+        """Writes guest memory, given as buffers in physical address
+        order, with @jobs compression threads."""
+
+        pool = multiprocessing.pool.ThreadPool(self.jobs)
+        pending = collections.deque()
+        try:
+            for data in page_batches(chunks,
+                                     KDUMP_BATCH_PAGES * TARGET_PAGE_SIZE):
+                pending.append(pool.apply_async(
+                    compress_pages, (self.flag, self.compress, data)))
+                # Bound the memory used by batches in flight
+                while len(pending) > 2 * self.jobs:
+                    self.add_pages(pending.popleft().get())
+            while pending:
+                self.add_pages(pending.popleft().get())
+        finally:
+            pool.terminate()
+        self.flush()
+        print("%d pages: %d compressed, %d uncompressed, %d zero" %
+              (self.num_dumpable, self.stats["compressed"],
+               self.stats["plain"], self.stats["zero"]))
+
+
+def get_nr_cpus():
+    """Returns the number of VCPUs, or 1 if they cannot be found."""
+
+    try:
+        cpu = gdb.parse_and_eval("cpus")["tqh_first"]
+        nr_cpus = 0
+        while cpu != 0:
+            nr_cpus += 1
+            cpu = cpu["node"]["tqe_next"]
+        return max(nr_cpus, 1)
+    except gdb.error:
+        return 1
+
+
 def int128_get64(val):
     """Returns low 64bit part of Int128 struct."""
 
@@ -476,11 +944,28 @@ The two required arguments are FILE and ARCH:
 FILE identifies the target file to write the guest vmcore to.
 ARCH specifies the architecture for which the core will be generated.
 
+Options:
+-sparse            leave zero pages as holes in FILE instead of writing
+                   them
+-split-zeroes MIB  split the PT_LOAD segments around runs of at least
+                   MIB MiB of zero pages, and do not store these runs in
+                   FILE at all; guest memory is read twice
+-format FORMAT     "elf" (the default), or "kdump-zlib", "kdump-lzo" or
+                   "kdump-snappy" for the kdump-compressed format;
+                   the latter two need the python-lzo and python-snappy
+                   modules
+-jobs N            number of threads compressing pages in the
+                   kdump-compressed formats (default: number of CPUs)
+
 This GDB command reimplements the dump-guest-memory QMP command in
 python, using the representation of guest memory as captured in the qemu
 coredump. The qemu process that has been dumped must have had the
 command line option "-machine dump-guest-core=on" which is the default.
 
+When debugging a core file, guest memory is copied from the core file
+directly, and gdb is only used to locate it. Otherwise memory is read
+through gdb in chunks of up to 64 MiB.
+
 For simplicity, the "paging", "begin" and "end" parameters of the QMP
 command are not supported -- no attempt is made to get the guest's
 internal paging structures (ie. paging=false is hard-wired), and guest
@@ -507,6 +992,8 @@ shape and this command should mostly work."""
                                               gdb.COMPLETE_FILENAME)
         self.elf = None
         self.guest_phys_blocks = None
+        self.core = None
+        self.layout = None
 
     def dump_init(self, vmcore):
         """Prepares and writes ELF structures to core file."""
@@ -519,31 +1006,158 @@ shape and this command should mostly work."""
         # there's just a handful of discontiguous ranges after
         # merging.
         # The constant is needed to account for the PT_NOTE segment.
-        phdr_num = len(self.guest_phys_blocks) + 1
+        phdr_num = sum(len(pieces) for pieces in self.layout) + 1
         assert phdr_num < PN_XNUM
 
-        for block in self.guest_phys_blocks:
-            block_size = block["target_end"] - block["target_start"]
-            self.elf.add_segment(PT_LOAD, block["target_start"], block_size)
+        for block, pieces in zip(self.guest_phys_blocks, self.layout):
+            for start, length, zero in pieces:
+                self.elf.add_segment(PT_LOAD, block["target_start"] + start,
+                                     length, 0 if zero else length)
 
         self.elf.to_file(vmcore)
 
-    def dump_iterate(self, vmcore):
-        """Writes guest core to file."""
+    def read_chunks(self, cur, left):
+        """Reads host memory through gdb.
+
+        Reads start at one page and double in size up to
+        MAX_CHUNK_SIZE; after a failed read, the chunk size is halved
+        and the read retried.
+        """
 
         qemu_core = gdb.inferiors()[0]
-        for block in self.guest_phys_blocks:
-            cur = block["host_addr"]
+        chunk_size = MIN_CHUNK_SIZE
+        while left > 0:
+            size = min(chunk_size, left)
+            try:
+                chunk = qemu_core.read_memory(cur, size)
+            except gdb.MemoryError:
+                if chunk_size <= MIN_CHUNK_SIZE:
+                    raise
+                chunk_size //= 2
+                continue
+            yield chunk
+            cur += size
+            left -= size
+            chunk_size = min(chunk_size * 2, MAX_CHUNK_SIZE)
+
+    def host_pieces(self, cur, left):
+        """Splits a host range like CoreFile.pieces().
+
+        Yields (core file offset, length, host address) tuples. With a
+        core file, RAM is copied from it directly and gdb is only needed
+        to find the RAM blocks.
+        """
+
+        if self.core is None:
+            yield False, left, cur
+            return
+        for offset, length in self.core.pieces(cur, left):
+            yield offset, length, cur
+            cur += length
+
+    def dump_range(self, writer, cur, left):
+        for offset, length, haddr in self.host_pieces(cur, left):
+            if offset is False:
+                for chunk in self.read_chunks(haddr, length):
+                    writer.write(chunk)
+            else:
+                writer.copy(offset, length)
+
+    def range_chunks(self, cur, left):
+        """Yields the contents of a host range as buffers."""
+
+        for offset, length, haddr in self.host_pieces(cur, left):
+            if offset is False:
+                for chunk in self.read_chunks(haddr, length):
+                    yield chunk
+            else:
+                for chunk in self.core.chunks(offset, length):
+                    yield chunk
+
+    def range_runs(self, cur, left):
+        """Yields (is_zero, length) runs of pages of a host range."""
+
+        for offset, length, haddr in self.host_pieces(cur, left):
+            if offset is False:
+                chunks = self.read_chunks(haddr, length)
+            else:
+                chunks = self.core.chunks(offset, length)
+            for chunk in chunks:
+                for zero, start, end in zero_runs(chunk):
+                    yield zero, end - start
+
+    def split_zero_runs(self, min_size):
+        """Splits the RAM blocks around runs of at least @min_size zero
+        bytes, which are then written as segments without file data."""
+
+        # Each zero run can add two segments, besides the PT_NOTE one
+        budget = PN_XNUM - 2 - len(self.guest_phys_blocks)
+        for i, block in enumerate(self.guest_phys_blocks):
+            cur = int(block["host_addr"].cast(UINTPTR_T))
+            size = block["target_end"] - block["target_start"]
+            print("scanning range at %016x for length %016x" % (cur, size))
+
+            runs = []
+            pos = 0
+            run_start = None
+            for zero, length in self.range_runs(cur, size):
+                if zero and run_start is None:
+                    run_start = pos
+                elif not zero and run_start is not None:
+                    if pos - run_start >= min_size:
+                        runs.append((run_start, pos - run_start))
+                    run_start = None
+                pos += length
+            if run_start is not None and pos - run_start >= min_size:
+                runs.append((run_start, pos - run_start))
+
+            pieces = []
+            pos = 0
+            for start, length in runs:
+                if budget < 2:
+                    break
+                budget -= 2
+                if start > pos:
+                    pieces.append((pos, start - pos, False))
+                pieces.append((start, length, True))
+                pos = start + length
+            if pos < size:
+                pieces.append((pos, size - pos, False))
+            self.layout[i] = pieces
+
+    def dump_iterate(self, vmcore, sparse=False):
+        """Writes guest core to file."""
+
+        writer = VmcoreWriter(vmcore, self.core, sparse)
+        for block, pieces in zip(self.guest_phys_blocks, self.layout):
+            cur = int(block["host_addr"].cast(UINTPTR_T))
             left = block["target_end"] - block["target_start"]
             print("dumping range at %016x for length %016x" %
-                  (cur.cast(UINTPTR_T), left))
+                  (cur, left))
+
+            for start, length, zero in pieces:
+                if not zero:
+                    self.dump_range(writer, cur + start, length)
+        writer.finish()
+
+    def dump_kdump(self, vmcore, arch, fmt, jobs):
+        """Writes guest core to file in kdump-compressed format."""
+
+        self.elf.add_note("NONE", "EMPTY", 0)
+        writer = KdumpWriter(vmcore, self.elf, arch, self.guest_phys_blocks,
+                             fmt, jobs, get_nr_cpus())
+        writer.write_header()
+
+        def chunks():
+            for block in self.guest_phys_blocks:
+                cur = int(block["host_addr"].cast(UINTPTR_T))
+                left = block["target_end"] - block["target_start"]
+                print("dumping range at %016x for length %016x" %
+                      (cur, left))
+                for chunk in self.range_chunks(cur, left):
+                    yield chunk
 
-            while left > 0:
-                chunk_size = min(TARGET_PAGE_SIZE, left)
-                chunk = qemu_core.read_memory(cur, chunk_size)
-                vmcore.write(chunk)
-                cur += chunk_size
-                left -= chunk_size
+        writer.write_pages(chunks())
 
     def phys_memory_read(self, addr, size):
         qemu_core = gdb.inferiors()[0]
@@ -584,16 +1198,57 @@ shape and this command should mostly work."""
         # not dump the same multi-gig coredump to the same file.
         self.dont_repeat()
 
+        usage = ("usage: dump-guest-memory [-sparse] [-split-zeroes MIB] "
+                 "[-format FORMAT] [-jobs N] FILE ARCH")
         argv = gdb.string_to_argv(args)
+        sparse = False
+        split_size = None
+        fmt = "elf"
+        jobs = multiprocessing.cpu_count()
+        while argv and argv[0].startswith("-"):
+            opt = argv.pop(0)
+            if opt == "-sparse":
+                sparse = True
+            elif opt in ("-split-zeroes", "-jobs") and argv:
+                try:
+                    value = int(argv.pop(0))
+                except ValueError:
+                    raise gdb.GdbError(usage)
+                if opt == "-jobs":
+                    jobs = max(value, 1)
+                else:
+                    split_size = value << 20
+            elif opt == "-format" and argv:
+                fmt = argv.pop(0)
+            else:
+                raise gdb.GdbError(usage)
         if len(argv) != 2:
-            raise gdb.GdbError("usage: dump-guest-memory FILE ARCH")
+            raise gdb.GdbError(usage)
+        if fmt != "elf":
+            get_compressor(fmt)
+            if sparse or split_size:
+                raise gdb.GdbError("-sparse and -split-zeroes only apply "
+                                   "to the elf format")
 
         self.elf = ELF(argv[1])
         self.guest_phys_blocks = get_guest_phys_blocks()
+        self.layout = [[(0, block["target_end"] - block["target_start"], False)]
+                       for block in self.guest_phys_blocks]
         self.add_vmcoreinfo()
 
-        with open(argv[0], "wb") as vmcore:
-            self.dump_init(vmcore)
-            self.dump_iterate(vmcore)
+        self.core = get_core_file()
+        try:
+            if split_size:
+                self.split_zero_runs(split_size)
+            with open(argv[0], "wb") as vmcore:
+                if fmt != "elf":
+                    self.dump_kdump(vmcore, argv[1], fmt, jobs)
+                else:
+                    self.dump_init(vmcore)
+                    self.dump_iterate(vmcore, sparse)
+        finally:
+            if self.core is not None:
+                self.core.close()
+                self.core = None
 
 DumpGuestMemory()
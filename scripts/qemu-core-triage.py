@@ -0,0 +1,193 @@
+#!/usr/bin/env python
+#
+# Batch triage of QEMU core files
+#
+# Run the qemugdb commands over many core files with parallel batch gdb
+# processes, keep one JSON report per core and group cores that crashed
+# the same way.
+#
+# Copyright (c) 2019 Red Hat Inc.
+#
+# This work is licensed under the terms of the GNU GPL, version 2 or
+# later.  See the COPYING file in the top-level directory.
+
+from __future__ import print_function
+import argparse
+import fnmatch
+import hashlib
+import json
+import multiprocessing
+import multiprocessing.pool
+import os
+import re
+import subprocess
+import sys
+import threading
+
+QEMU_GDB = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                        'qemu-gdb.py')
+
+def find_cores(paths, pattern):
+    for path in paths:
+        if not os.path.isdir(path):
+            yield path
+            continue
+        for name in sorted(os.listdir(path)):
+            filename = os.path.join(path, name)
+            if fnmatch.fnmatch(name, pattern) and os.path.isfile(filename):
+                yield filename
+
+class Timeout(Exception):
+    pass
+
+def run(cmd, timeout):
+    '''Run cmd and return its output, killing it after timeout seconds'''
+    proc = subprocess.Popen(cmd, stdout=subprocess.PIPE,
+                            stderr=subprocess.STDOUT)
+    killed = []
+    def kill():
+        killed.append(True)
+        try:
+            proc.kill()
+        except OSError:
+            pass
+    # Popen.communicate() has no timeout in Python 2
+    timer = threading.Timer(timeout, kill) if timeout else None
+    if timer is not None:
+        timer.start()
+    try:
+        output = proc.communicate()[0]
+    finally:
+        if timer is not None:
+            timer.cancel()
+    if killed:
+        raise Timeout("gdb timed out after %g seconds" % timeout)
+    return output
+
+def core_binary(args, core):
+    '''Find the program that dumped a core from gdb's banner'''
+    output = run([args.gdb, '-batch', '-nx', '-c', core], args.timeout)
+    m = re.search(r"Core was generated by `(\S+)", output.decode('utf-8', 'replace'))
+    if m is None:
+        raise Exception("cannot find the program that generated %s" % core)
+    return m.group(1)
+
+def report_path(output_dir, core):
+    # Cores from different directories often have the same name
+    digest = hashlib.sha1(os.path.abspath(core).encode('utf-8')).hexdigest()
+    return os.path.join(output_dir, '%s-%s.json' % (os.path.basename(core),
+                                                    digest[:8]))
+
+def triage(args, core):
+    '''Run gdb on a core, returning (core, report or None, error)'''
+    path = report_path(args.output, core)
+    if not args.force and os.path.exists(path):
+        with open(path) as f:
+            return core, json.load(f), None
+    try:
+        binary = args.qemu or core_binary(args, core)
+        cmd = [args.gdb, '-batch', '-nx',
+               '-ex', 'set pagination off',
+               '-ex', 'set confirm off',
+               '-x', QEMU_GDB,
+               '-ex', 'qemu triage --depth %d "%s"' % (args.depth, path),
+               binary, core]
+        try:
+            output = run(cmd, args.timeout)
+        except Timeout:
+            # Do not reuse a report that gdb was killed while writing
+            if os.path.exists(path):
+                os.unlink(path)
+            raise
+        if not os.path.exists(path):
+            return core, None, output.decode('utf-8', 'replace')
+        with open(path) as f:
+            return core, json.load(f), None
+    except Exception as e:
+        return core, None, str(e)
+
+def strip_location(frame):
+    # "func (file:line)" -> "func", so that rebuilt binaries still match
+    return frame.split(' (')[0]
+
+def signature(report, frames):
+    '''The top frames of the crashing thread and of the most common
+    coroutine stack
+
+    When the coroutine stacks could not be collected, the signature says
+    so, so that such cores are not mixed with cores that have no live
+    coroutines.'''
+    sig = {'signal': report.get('signal')}
+    threads = report.get('threads')
+    if isinstance(threads, list) and threads:
+        sig['thread'] = [strip_location(f) for f in threads[0]['frames'][:frames]]
+    coroutines = report.get('coroutines')
+    if not isinstance(coroutines, dict) or coroutines.get('error'):
+        sig['coroutine'] = 'unavailable'
+    elif coroutines.get('stacks'):
+        top = coroutines['stacks'][0]['frames']
+        sig['coroutine'] = [strip_location(f) for f in top[:frames]]
+    return sig
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Collect qemugdb reports from QEMU core files and '
+                    'cluster the cores by stack signature')
+    parser.add_argument('cores', nargs='+',
+                        help='core files, or directories containing them')
+    parser.add_argument('--pattern', default='core*',
+                        help='name of the core files in directories (default: core*)')
+    parser.add_argument('--qemu', help='QEMU binary (default: from each core)')
+    parser.add_argument('--gdb', default='gdb', help='gdb binary')
+    parser.add_argument('-o', '--output', default='.',
+                        help='directory for the per-core reports, existing '
+                        'reports are reused (default: .)')
+    parser.add_argument('--force', action='store_true',
+                        help='regenerate existing reports')
+    parser.add_argument('-j', '--jobs', type=int,
+                        default=multiprocessing.cpu_count(),
+                        help='number of gdb processes to run in parallel')
+    parser.add_argument('--timeout', type=float, default=600,
+                        help='seconds after which gdb is killed and the core '
+                        'is reported as failed, 0 to wait forever '
+                        '(default: 600)')
+    parser.add_argument('--depth', type=int, default=32,
+                        help='number of frames to collect per stack')
+    parser.add_argument('--frames', type=int, default=5,
+                        help='number of frames in a signature (default: 5)')
+    args = parser.parse_args()
+
+    if not os.path.isdir(args.output):
+        os.makedirs(args.output)
+
+    cores = list(find_cores(args.cores, args.pattern))
+    clusters = {}
+    failed = []
+    # gdb does the work, threads are enough to drive it
+    pool = multiprocessing.pool.ThreadPool(max(args.jobs, 1))
+    try:
+        for core, report, error in pool.imap_unordered(
+                lambda core: triage(args, core), cores):
+            if report is None:
+                print('%s: %s' % (core, error.strip()), file=sys.stderr)
+                failed.append(core)
+                continue
+            sig = signature(report, args.frames)
+            key = json.dumps(sig, sort_keys=True)
+            clusters.setdefault(key, (sig, []))[1].append(core)
+    finally:
+        pool.close()
+        pool.join()
+
+    result = {
+        'cores': len(cores),
+        'failed': sorted(failed),
+        'clusters': [{'count': len(members), 'signature': sig,
+                      'cores': sorted(members)}
+                     for sig, members in sorted(clusters.values(),
+                                                key=lambda c: -len(c[1]))],
+    }
+    print(json.dumps(result, indent=2))
+
+if __name__ == '__main__':
+    main()
@@ -23,7 +23,7 @@ import os, sys
 
 sys.path.append(os.path.dirname(__file__))
 
-from qemugdb import aio, mtree, coroutine, tcg, timers
+from qemugdb import aio, mtree, coroutine, tcg, timers, triage
 
 class QemuCommand(gdb.Command):
     '''Prefix for QEMU debug support commands'''
@@ -33,10 +33,14 @@ class QemuCommand(gdb.Command):
 
 QemuCommand()
 coroutine.CoroutineCommand()
+coroutine.CoroutinesCommand()
 mtree.MtreeCommand()
+mtree.MtreeLookupCommand()
 aio.HandlersCommand()
+aio.AioReportCommand()
 tcg.TCGLockStatusCommand()
 timers.TimersCommand()
+triage.TriageCommand()
 
 coroutine.CoroutineSPFunction()
 coroutine.CoroutinePCFunction()
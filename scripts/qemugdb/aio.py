@@ -10,26 +10,116 @@
 # later.  See the COPYING file in the top-level directory.
 #
 
+import json
 import gdb
 from qemugdb import coroutine
 
 def isnull(ptr):
     return ptr == gdb.Value(0).cast(ptr.type)
 
+def walk_list(ptr, next_elem, limit=None):
+    '''Follow a linked list and return its elements, and whether the walk
+    stopped early or found a cycle.
+
+    next_elem(ptr) returns the element after ptr.  The walk stops at
+    limit elements or when an element is seen twice.'''
+    elems = []
+    seen = set()
+    truncated = cycle = False
+    while not isnull(ptr):
+        if limit is not None and len(elems) >= limit:
+            truncated = True
+            break
+        if int(ptr) in seen:
+            cycle = True
+            break
+        seen.add(int(ptr))
+        elems.append(ptr)
+        ptr = next_elem(ptr)
+    return elems, truncated, cycle
+
+def iterate_list(ptr, next_elem):
+    '''Iterate over a linked list, stopping if an element repeats'''
+    seen = set()
+    while not isnull(ptr) and int(ptr) not in seen:
+        seen.add(int(ptr))
+        yield ptr
+        ptr = next_elem(ptr)
+
+def qtailq(head, field):
+    '''Iterate over the elements of a QTAILQ'''
+    return iterate_list(head['tqh_first'],
+                        lambda ptr: ptr[field]['tqe_next'])
+
+def qlist(head, field):
+    '''Iterate over the elements of a QLIST'''
+    return iterate_list(head['lh_first'], lambda ptr: ptr[field]['le_next'])
+
+def block_states():
+    '''Iterate over all BlockDriverStates'''
+    return qtailq(gdb.parse_and_eval('all_bdrv_states'), 'bs_list')
+
+def iothread_contexts():
+    '''Return the AioContexts of the running IOThreads
+
+    IOThread objects are only reachable through QOM hash tables, so
+    every thread is asked for its thread-local my_iothread instead.'''
+    contexts = []
+    selected = gdb.selected_thread()
+    try:
+        for thread in gdb.selected_inferior().threads():
+            thread.switch()
+            try:
+                iothread = gdb.parse_and_eval('my_iothread')
+            except gdb.error:
+                continue
+            if not isnull(iothread):
+                contexts.append(iothread['ctx'])
+    finally:
+        if selected is not None:
+            selected.switch()
+    return contexts
+
+def aio_contexts():
+    '''Return the AioContexts reachable from global state
+
+    This is the main loop context, the iohandler context, the contexts
+    of all IOThreads and those of all block nodes.'''
+    contexts = []
+    seen = set()
+    def add(ctx):
+        if not isnull(ctx) and int(ctx) not in seen:
+            seen.add(int(ctx))
+            contexts.append(ctx)
+    for name in ('qemu_aio_context', 'iohandler_ctx'):
+        try:
+            add(gdb.parse_and_eval(name))
+        except gdb.error:
+            pass
+    try:
+        for ctx in iothread_contexts():
+            add(ctx)
+    except gdb.error:
+        pass
+    try:
+        for bs in block_states():
+            add(bs['aio_context'])
+    except gdb.error:
+        pass
+    return contexts
+
 def dump_aiocontext(context, verbose):
     '''Display a dump and backtrace for an aiocontext'''
-    cur = context['aio_handlers']['lh_first']
     # Get pointers to functions we're going to process specially
     sym_fd_coroutine_enter = gdb.parse_and_eval('fd_coroutine_enter')
 
-    while not isnull(cur):
+    for cur in qlist(context['aio_handlers'], 'node'):
         entry = cur.dereference()
         gdb.write('----\n%s\n' % entry)
         if verbose and cur['io_read'] == sym_fd_coroutine_enter:
             coptr = (cur['opaque'].cast(gdb.lookup_type('FDYieldUntilData').pointer()))['co']
             coptr = coptr.cast(gdb.lookup_type('CoroutineUContext').pointer())
             coroutine.bt_jmpbuf(coptr['env']['__jmpbuf'])
-        cur = cur['node']['le_next'];
 
     gdb.write('----\n')
 
@@ -56,3 +146,229 @@ class HandlersCommand(gdb.Command):
         else:
             handlers_name = 'qemu_aio_context'
         dump_aiocontext(gdb.parse_and_eval(handlers_name), verbose)
+
+def clock_name(clock_type):
+    '''Short name of a QEMUClockType, e.g. "virtual_rt"'''
+    name = str(clock_type)
+    if name.startswith('QEMU_CLOCK_'):
+        name = name[len('QEMU_CLOCK_'):]
+    return name.lower()
+
+class AioReport(object):
+    '''Summarise the fd handlers, bottom halves and timers of AioContexts'''
+    def __init__(self, now=None, limit=None):
+        self.functions = {}
+        # Current time in ns of each clock given by the user, by name
+        self.now = now or {}
+        self.clock_now = {}
+        # Maximum number of elements read from each list
+        self.limit = limit
+
+    def function(self, ptr):
+        '''Name the function that ptr points to, caching the result'''
+        addr = int(ptr)
+        if addr not in self.functions:
+            name = '-'
+            if addr:
+                try:
+                    block = gdb.block_for_pc(addr)
+                except RuntimeError:
+                    block = None
+                if block is not None and block.function is not None:
+                    name = block.function.print_name
+                else:
+                    name = '0x%x' % addr
+            self.functions[addr] = name
+        return self.functions[addr]
+
+    def clock_time(self, clock):
+        '''Current time of a clock in ns, or None if it cannot be found'''
+        clock_type = int(clock['type'])
+        if clock_type not in self.clock_now:
+            now = self.now.get(clock_name(clock['type']))
+            if now is None:
+                struct = clock.type.target().strip_typedefs()
+                if 'last' in [f.name for f in struct.fields()]:
+                    now = int(clock['last'])
+                else:
+                    try:
+                        now = int(gdb.parse_and_eval(
+                            '(int64_t)qemu_clock_get_ns(%d)' % clock_type))
+                    except gdb.error:
+                        # No process to call into, e.g. with a core file
+                        now = None
+            self.clock_now[clock_type] = now
+        return self.clock_now[clock_type]
+
+    def handlers(self, ctx):
+        handlers = []
+        deleted = 0
+        elems, truncated, cycle = walk_list(
+            ctx['aio_handlers']['lh_first'],
+            lambda ptr: ptr['node']['le_next'], self.limit)
+        for handler in elems:
+            if int(handler['deleted']):
+                deleted += 1
+                continue
+            handlers.append({'fd': int(handler['pfd']['fd']),
+                             'read': self.function(handler['io_read']),
+                             'write': self.function(handler['io_write']),
+                             'poll': self.function(handler['io_poll']),
+                             'opaque': int(handler['opaque'])})
+        counts = {}
+        for handler in handlers:
+            key = (handler['read'], handler['write'], handler['poll'])
+            counts[key] = counts.get(key, 0) + 1
+        callbacks = [{'count': count, 'read': key[0], 'write': key[1],
+                      'poll': key[2]}
+                     for key, count in sorted(counts.items(),
+                                              key=lambda item: -item[1])]
+        return {'count': len(handlers), 'deleted': deleted,
+                'callbacks': callbacks, 'handlers': handlers,
+                'truncated': truncated, 'cycle': cycle}
+
+    def bottom_halves(self, ctx):
+        total = 0
+        pending = []
+        bhs, truncated, cycle = walk_list(ctx['first_bh'],
+                                          lambda ptr: ptr['next'], self.limit)
+        for bh in bhs:
+            if not bool(bh['deleted']):
+                total += 1
+                if bool(bh['scheduled']):
+                    pending.append({'cb': self.function(bh['cb']),
+                                    'opaque': int(bh['opaque']),
+                                    'idle': bool(bh['idle'])})
+        return {'count': total, 'pending': pending,
+                'truncated': truncated, 'cycle': cycle}
+
+    def timers(self, tlg):
+        lists = []
+        for i in range(tlg['tl'].type.range()[1] + 1):
+            timer_list = tlg['tl'][i]
+            if isnull(timer_list):
+                continue
+            clock = timer_list['clock']
+            now = self.clock_time(clock)
+            timers = []
+            elems, truncated, cycle = walk_list(timer_list['active_timers'],
+                                                lambda ptr: ptr['next'],
+                                                self.limit)
+            for timer in elems:
+                expire_time = int(timer['expire_time'])
+                timers.append({'expire_time': expire_time,
+                               'late': None if now is None else now - expire_time,
+                               'cb': self.function(timer['cb']),
+                               'opaque': int(timer['opaque'])})
+            if not timers:
+                continue
+            timers.sort(key=lambda timer: timer['expire_time'])
+            lists.append({'clock': str(clock['type']), 'now': now,
+                          'timers': timers, 'truncated': truncated,
+                          'cycle': cycle})
+        return lists
+
+    def context(self, ctx):
+        return {'context': int(ctx),
+                'handlers': self.handlers(ctx),
+                'bottom_halves': self.bottom_halves(ctx),
+                'timers': self.timers(ctx['tlg'])}
+
+    @staticmethod
+    def write_walk(what, walk):
+        if walk['truncated']:
+            gdb.write('    ... %s list truncated at --limit\n' % what)
+        if walk['cycle']:
+            gdb.write('    ... cycle in the %s list\n' % what)
+
+    @staticmethod
+    def write_timers(lists):
+        for timer_list in lists:
+            now = timer_list['now']
+            gdb.write('  %s timers: %d, now %s\n' % (
+                timer_list['clock'], len(timer_list['timers']),
+                'unknown' if now is None else now))
+            for timer in timer_list['timers']:
+                if now is None:
+                    when = ''
+                elif timer['late'] >= 0:
+                    when = ' late by %d us' % (timer['late'] // 1000)
+                else:
+                    when = ' in %d us' % (-timer['late'] // 1000)
+                gdb.write('    %d%s  %s(0x%x)\n' % (
+                    timer['expire_time'], when, timer['cb'], timer['opaque']))
+            AioReport.write_walk('timer', timer_list)
+
+    @staticmethod
+    def write_context(context):
+        gdb.write('AioContext 0x%x\n' % context['context'])
+        handlers = context['handlers']
+        gdb.write('  fd handlers: %d (%d deleted)\n' %
+                  (handlers['count'], handlers['deleted']))
+        for cb in handlers['callbacks']:
+            gdb.write('    %5d  read=%s write=%s poll=%s\n' % (
+                cb['count'], cb['read'], cb['write'], cb['poll']))
+        AioReport.write_walk('fd handler', handlers)
+        bhs = context['bottom_halves']
+        gdb.write('  bottom halves: %d, %d pending\n' %
+                  (bhs['count'], len(bhs['pending'])))
+        for bh in bhs['pending']:
+            gdb.write('    %s(0x%x)%s\n' % (bh['cb'], bh['opaque'],
+                                            ' idle' if bh['idle'] else ''))
+        AioReport.write_walk('bottom half', bhs)
+        AioReport.write_timers(context['timers'])
+
+class AioReportCommand(gdb.Command):
+    '''Summarise AioContext fd handlers, bottom halves and timers
+
+Usage: qemu aio-report [--json] [--limit N] [--now CLOCK=NS]... [AIOCONTEXT...]
+
+By default all AioContexts that can be found from global state and from
+the IOThreads are reported, followed by the main loop timers.  Timer
+lateness is relative to the clock's current time, which is only
+available on a live process; when debugging a core file, use --now to
+provide it for each clock (realtime, virtual, host or virtual_rt).
+Clocks whose time is not known print "unknown".  --limit stops after
+N elements of each handler, bottom half and timer list; lists that
+loop back are cut at the first repeated element.  --json prints the
+report, including every fd handler, as JSON.'''
+    def __init__(self):
+        gdb.Command.__init__(self, 'qemu aio-report', gdb.COMMAND_DATA,
+                             gdb.COMPLETE_NONE)
+
+    def invoke(self, arg, from_tty):
+        argv = gdb.string_to_argv(arg)
+        usage = ('usage: qemu aio-report [--json] [--limit N] '
+                 '[--now CLOCK=NS]... [AIOCONTEXT...]')
+        now = {}
+        limit = None
+        as_json = False
+        while argv and argv[0].startswith('--'):
+            opt = argv.pop(0)
+            if opt == '--json':
+                as_json = True
+            elif opt == '--limit' and argv:
+                limit = int(argv.pop(0))
+            elif opt == '--now' and argv and '=' in argv[0]:
+                clock, value = argv.pop(0).split('=', 1)
+                now[clock.lower()] = int(gdb.parse_and_eval(value))
+            else:
+                raise gdb.GdbError(usage)
+        report = AioReport(now, limit)
+        if argv:
+            contexts = [gdb.parse_and_eval(expr) for expr in argv]
+        else:
+            contexts = aio_contexts()
+        result = {'contexts': [report.context(ctx) for ctx in contexts]}
+        if not argv:
+            result['main_loop'] = {
+                'timers': report.timers(gdb.parse_and_eval('main_loop_tlg'))}
+
+        if as_json:
+            gdb.write(json.dumps(result, indent=2) + '\n')
+            return
+        for context in result['contexts']:
+            report.write_context(context)
+        if 'main_loop' in result:
+            gdb.write('main loop\n')
+            report.write_timers(result['main_loop']['timers'])
@@ -10,6 +10,8 @@
 # This work is licensed under the terms of the GNU GPL, version 2
 # or later.  See the COPYING file in the top-level directory.
 
+import json
+import struct
 import gdb
 
 VOID_PTR = gdb.lookup_type('void').pointer()
@@ -24,18 +26,53 @@ def get_fs_base():
     gdb.execute('set *(uint64_t*)($rsp - 120) = %s' % old, False, True)
     return fs_base
 
-def pthread_self():
-    '''Fetch pthread_self() from the glibc start_thread function.'''
+def is_live_process():
+    '''Whether the inferior is a running process rather than a core file'''
+    connection = getattr(gdb.selected_inferior(), 'connection', None)
+    if connection is not None:
+        return connection.type != 'core'
+    return 'core dump' not in gdb.execute('info target', False, True)
+
+def start_thread_arg(thread):
+    '''Fetch the argument of thread's glibc start_thread frame, or None'''
+    thread.switch()
     f = gdb.newest_frame()
-    while f.name() != 'start_thread':
+    while f is not None and f.name() != 'start_thread':
         f = f.older()
-        if f is None:
-            return get_fs_base()
-
+    if f is None:
+        return None
     try:
         return f.read_var("arg")
     except ValueError:
-        return get_fs_base()
+        return None
+
+def pthread_self():
+    '''Fetch the thread pointer of a thread; any thread will do for the
+       pointer guard.  Only call into the inferior as a last resort, which
+       is impossible on a core file.'''
+    try:
+        fs_base = gdb.parse_and_eval('$fs_base')
+        if int(fs_base):
+            return fs_base
+    except (gdb.error, TypeError, ValueError):
+        pass
+
+    # The main thread has no start_thread frame, try the other threads
+    selected = gdb.selected_thread()
+    threads = sorted(gdb.selected_inferior().threads(),
+                     key=lambda thread: thread != selected)
+    try:
+        for thread in threads:
+            arg = start_thread_arg(thread)
+            if arg is not None:
+                return arg
+    finally:
+        if selected is not None:
+            selected.switch()
+
+    if not is_live_process():
+        raise gdb.error('cannot find the thread pointer in a core file')
+    return get_fs_base()
 
 def get_glibc_pointer_guard():
     '''Fetch glibc pointer guard value'''
@@ -114,3 +151,234 @@ class CoroutinePCFunction(gdb.Function):
 
     def invoke(self, addr):
         return get_jmpbuf_regs(coroutine_to_jmpbuf(addr))['rip'].cast(VOID_PTR)
+
+def isnull(ptr):
+    return ptr == gdb.Value(0).cast(ptr.type)
+
+def qsimpleq(head, field):
+    '''Iterate over the elements of a QSIMPLEQ'''
+    ptr = head['sqh_first']
+    while not isnull(ptr):
+        yield ptr
+        ptr = ptr[field]['sqe_next']
+
+def qslist(head, field):
+    '''Iterate over the elements of a QSLIST'''
+    ptr = head['slh_first']
+    while not isnull(ptr):
+        yield ptr
+        ptr = ptr[field]['sle_next']
+
+def live_coroutines():
+    '''Return (coroutine, where) pairs for the coroutines reachable from
+    global state: owners of and waiters on in-flight block requests, and
+    coroutines scheduled on an AioContext'''
+    # aio imports this module
+    from qemugdb import aio
+    found = []
+    seen = set()
+    def add(co, where):
+        if not isnull(co) and int(co) not in seen:
+            seen.add(int(co))
+            found.append((co, where))
+    try:
+        for bs in aio.block_states():
+            for req in aio.qlist(bs['tracked_requests'], 'list'):
+                add(req['co'], 'block request')
+                for co in qsimpleq(req['wait_queue']['entries'],
+                                   'co_queue_next'):
+                    add(co, 'block request waiter')
+    except gdb.error:
+        pass
+    for ctx in aio.aio_contexts():
+        for co in qslist(ctx['scheduled_coroutines'], 'co_scheduled_next'):
+            add(co, 'scheduled')
+    return found
+
+class StackCensus(object):
+    '''Unwind coroutines from their jmpbuf and group identical stacks'''
+    REGS = ('rbx', 'rbp', 'r12', 'r13', 'r14', 'r15', 'rsp', 'rip')
+
+    def __init__(self, depth, frame_pointers):
+        self.depth = depth
+        self.frame_pointers = frame_pointers
+        self.inferior = gdb.selected_inferior()
+        self.symbols = {}
+        self.stacks = {}
+        try:
+            self.pointer_guard = (int(get_glibc_pointer_guard()) &
+                                  0xffffffffffffffff)
+        except gdb.error:
+            # Without it the saved registers cannot be decoded
+            self.pointer_guard = None
+        ucontext = gdb.lookup_type('CoroutineUContext').strip_typedefs()
+        env = [f for f in ucontext.fields() if f.name == 'env'][0]
+        self.env_offset = env.bitpos // 8
+        self.saved = None
+
+    def demangle(self, val):
+        val = ((val >> 0x11) | (val << (64 - 0x11))) & 0xffffffffffffffff
+        return val ^ self.pointer_guard
+
+    def read_regs(self, co):
+        # One read for the whole jmpbuf instead of an evaluation per
+        # register
+        data = self.inferior.read_memory(int(co) + self.env_offset, 8 * 8)
+        jmpbuf = struct.unpack('<8Q', bytes(data))
+        regs = dict(zip(self.REGS, jmpbuf))
+        for reg in ('rbp', 'rsp', 'rip'):
+            regs[reg] = self.demangle(regs[reg])
+        return regs
+
+    def symbol(self, pc):
+        '''Describe pc as "function (file:line)", caching the result'''
+        if pc not in self.symbols:
+            # Return addresses point after the call instruction
+            lookup = pc - 1 if pc else pc
+            try:
+                block = gdb.block_for_pc(lookup)
+            except RuntimeError:
+                block = None
+            while block is not None and block.function is None:
+                block = block.superblock
+            name = block.function.print_name if block is not None else '??'
+            sal = gdb.find_pc_line(lookup)
+            if sal.symtab is not None:
+                name = '%s (%s:%d)' % (name, sal.symtab.filename, sal.line)
+            if name == '??':
+                name = '0x%016x ??' % pc
+            self.symbols[pc] = name
+        return self.symbols[pc]
+
+    def unwind_gdb(self, regs):
+        if self.saved is None:
+            gdb.newest_frame().select()
+            self.saved = dict((reg, int(gdb.parse_and_eval('(uint64_t)$%s' % reg)))
+                              for reg in self.REGS)
+        for reg in self.REGS:
+            gdb.execute('set $%s = %d' % (reg, regs[reg]), False, True)
+        pcs = []
+        frame = gdb.newest_frame()
+        while frame is not None and len(pcs) < self.depth:
+            pcs.append(frame.pc())
+            try:
+                frame = frame.older()
+            except gdb.error:
+                break
+        return pcs
+
+    def unwind_frame_pointers(self, regs):
+        pcs = [regs['rip']]
+        rbp = regs['rbp']
+        while rbp and len(pcs) < self.depth:
+            try:
+                data = self.inferior.read_memory(rbp, 16)
+            except gdb.MemoryError:
+                break
+            next_rbp, pc = struct.unpack('<QQ', bytes(data))
+            if not pc:
+                break
+            pcs.append(pc)
+            if next_rbp <= rbp:
+                break
+            rbp = next_rbp
+        return pcs
+
+    def add(self, co):
+        regs = self.read_regs(co)
+        if not self.frame_pointers:
+            try:
+                pcs = self.unwind_gdb(regs)
+            except gdb.error:
+                # Registers cannot be written when debugging a core
+                # file, fall back to walking the frame pointer chain
+                self.frame_pointers = True
+                self.saved = None
+        if self.frame_pointers:
+            pcs = self.unwind_frame_pointers(regs)
+        stack = tuple(self.symbol(pc) for pc in pcs)
+        self.stacks.setdefault(stack, []).append(int(co))
+
+    def restore(self):
+        if self.saved is not None:
+            for reg in self.REGS:
+                gdb.execute('set $%s = %d' % (reg, self.saved[reg]), False, True)
+            self.saved = None
+
+class CoroutinesCommand(gdb.Command):
+    '''Display the stacks of all live coroutines, grouped by call chain
+
+Usage: qemu coroutines [--depth N] [--fp] [--json] [COROUTINE...]
+
+Coroutines are found through in-flight block requests, the coroutines
+waiting on them and the coroutines scheduled on AioContexts; more can
+be given as arguments.  Stacks are printed most common first.  --fp
+walks frame pointers instead of using the gdb unwinder, which is
+faster and is used automatically on core files.  --json prints the
+census as JSON.'''
+    def __init__(self):
+        gdb.Command.__init__(self, 'qemu coroutines', gdb.COMMAND_DATA,
+                             gdb.COMPLETE_NONE)
+
+    def invoke(self, arg, from_tty):
+        argv = gdb.string_to_argv(arg)
+        depth = 32
+        frame_pointers = False
+        as_json = False
+        while argv and argv[0].startswith('--'):
+            opt = argv.pop(0)
+            if opt == '--fp':
+                frame_pointers = True
+            elif opt == '--json':
+                as_json = True
+            elif opt == '--depth' and argv:
+                depth = int(argv.pop(0))
+            else:
+                raise gdb.GdbError('usage: qemu coroutines [--depth N] [--fp] '
+                                   '[--json] [COROUTINE...]')
+
+        coroutines = live_coroutines()
+        for expr in argv:
+            coroutines.append((gdb.parse_and_eval(expr), 'argument'))
+
+        census = StackCensus(depth, frame_pointers)
+        kinds = {}
+        try:
+            for co, where in coroutines:
+                kinds[where] = kinds.get(where, 0) + 1
+                if census.pointer_guard is not None:
+                    census.add(co)
+        finally:
+            census.restore()
+        error = None
+        if census.pointer_guard is None:
+            error = 'pointer guard unavailable'
+
+        try:
+            pool_size = int(gdb.parse_and_eval('release_pool_size'))
+        except gdb.error:
+            pool_size = None
+        stacks = sorted(census.stacks.items(), key=lambda item: -len(item[1]))
+        if as_json:
+            gdb.write(json.dumps({
+                'coroutines': len(coroutines),
+                'found in': kinds,
+                'release pool': pool_size,
+                'error': error,
+                'stacks': [{'count': len(cos), 'coroutines': cos,
+                            'frames': list(stack)} for stack, cos in stacks],
+            }, indent=2) + '\n')
+            return
+
+        gdb.write('%d coroutines in %d distinct stacks (%s)\n' % (
+            len(coroutines), len(census.stacks),
+            ', '.join('%d %s' % (n, where) for where, n in sorted(kinds.items()))))
+        if pool_size is not None:
+            gdb.write('%d coroutines in the release pool\n' % pool_size)
+        if error is not None:
+            gdb.write('%s, cannot unwind the stacks\n' % error)
+        for stack, cos in stacks:
+            gdb.write('\n%d coroutines, e.g. %s\n' % (
+                len(cos), ' '.join('0x%x' % co for co in cos[:4])))
+            for i, frame in enumerate(stack):
+                gdb.write('  #%-3d %s\n' % (i, frame))
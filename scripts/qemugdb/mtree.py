@@ -11,7 +11,11 @@
 # later.  See the COPYING file in the top-level directory.
 
 # 'qemu mtree' -- display the memory hierarchy
+# 'qemu mtree-lookup' -- find the memory region backing an address
 
+import bisect
+import json
+import struct
 import gdb
 
 def isnull(ptr):
@@ -29,16 +33,59 @@ def int128(p):
         return int(("%s" % p), 16)
 
 class MtreeCommand(gdb.Command):
-    '''Display the memory tree hierarchy'''
+    '''Display the memory tree hierarchy
+
+Usage: qemu mtree [--limit N] [--json] [-f [ADDRESS-SPACE...]]
+
+With -f, print the flattened view of each address space instead.
+--limit stops after N regions, --json prints the tree as JSON.'''
     def __init__(self):
         gdb.Command.__init__(self, 'qemu mtree', gdb.COMMAND_DATA,
                              gdb.COMPLETE_NONE)
         self.queue = []
     def invoke(self, arg, from_tty):
+        argv = gdb.string_to_argv(arg)
+        self.limit = None
+        self.json = False
+        # Options can come before or after -f
+        args = []
+        while argv:
+            opt = argv.pop(0)
+            if opt == '--json':
+                self.json = True
+            elif opt == '--limit' and argv:
+                self.limit = int(argv.pop(0))
+            elif opt.startswith('--'):
+                raise gdb.GdbError('usage: qemu mtree [--limit N] [--json] '
+                                   '[-f [ADDRESS-SPACE...]]')
+            else:
+                args.append(opt)
+        argv = args
+        if argv and argv[0] == '-f':
+            views = [flatview(name) for name in argv[1:] or
+                     ['address_space_memory', 'address_space_io']]
+            if self.json:
+                gdb.write(json.dumps([view.to_json() for view in views],
+                                     indent=2) + '\n', gdb.STDOUT)
+            else:
+                for view in views:
+                    view.dump()
+            return
         self.seen = set()
+        self.regions = {}
+        self.count = 0
+        self.truncated = False
+        self.trees = []
         self.queue_root('address_space_memory')
         self.queue_root('address_space_io')
         self.process_queue()
+        if self.json:
+            gdb.write(json.dumps({'regions': self.trees,
+                                  'truncated': self.truncated},
+                                 indent=2) + '\n', gdb.STDOUT)
+        elif self.truncated:
+            gdb.write('... stopped after %d regions\n' % self.count,
+                      gdb.STDOUT)
     def queue_root(self, varname):
         ptr = gdb.parse_and_eval(varname)['root']
         self.queue.append(ptr)
@@ -48,40 +95,278 @@ class MtreeCommand(gdb.Command):
             if int(ptr) in self.seen:
                 continue
             self.print_item(ptr)
-    def print_item(self, ptr, offset = gdb.Value(0), level = 0):
-        self.seen.add(int(ptr))
-        addr = ptr['addr']
-        addr += offset
-        size = int128(ptr['size'])
-        alias = ptr['alias']
-        klass = ''
-        if not isnull(alias):
-            klass = ' (alias)'
-        elif not isnull(ptr['ops']):
-            klass = ' (I/O)'
-        elif bool(ptr['ram']):
-            klass = ' (RAM)'
-        gdb.write('%s%016x-%016x %s%s (@ %s)\n'
-                  % ('  ' * level,
-                     int(addr),
-                     int(addr + (size - 1)),
-                     ptr['name'].string(),
-                     klass,
-                     ptr,
-                     ),
-                  gdb.STDOUT)
-        if not isnull(alias):
-            gdb.write('%s    alias: %s@%016x (@ %s)\n' %
-                      ('  ' * level,
-                       alias['name'].string(),
-                       int(ptr['alias_offset']),
-                       alias,
-                       ),
-                      gdb.STDOUT)
-            self.queue.append(alias)
-        subregion = ptr['subregions']['tqh_first']
-        level += 1
-        while not isnull(subregion):
-            self.print_item(subregion, addr, level)
-            subregion = subregion['subregions_link']['tqe_next']
+    def region(self, ptr):
+        '''Read the fields of a MemoryRegion once, however many times
+        it is reached'''
+        key = int(ptr)
+        if key not in self.regions:
+            mr = ptr.dereference()
+            alias = mr['alias']
+            klass = ''
+            if not isnull(alias):
+                klass = ' (alias)'
+            elif not isnull(mr['ops']):
+                klass = ' (I/O)'
+            elif bool(mr['ram']):
+                klass = ' (RAM)'
+            subregions = []
+            visited = set()
+            subregion = mr['subregions']['tqh_first']
+            while not isnull(subregion) and int(subregion) not in visited:
+                visited.add(int(subregion))
+                subregions.append(subregion)
+                subregion = subregion['subregions_link']['tqe_next']
+            self.regions[key] = {
+                'name': mr['name'].string(),
+                'addr': int(mr['addr']),
+                'size': int128(mr['size']),
+                'class': klass,
+                'alias': None if isnull(alias) else alias,
+                'alias_offset': int(mr['alias_offset']),
+                'subregions': subregions,
+            }
+        return self.regions[key]
+    def print_item(self, ptr, offset = 0, level = 0):
+        # Walk the tree with an explicit stack, a deep hierarchy must not
+        # hit Python's recursion limit.  The path of each entry is used to
+        # detect cycles in corrupted lists.
+        stack = [(ptr, offset, level, (), self.trees)]
+        while stack:
+            ptr, offset, level, path, siblings = stack.pop()
+            if self.limit is not None and self.count >= self.limit:
+                self.truncated = True
+                return
+            self.count += 1
+            self.seen.add(int(ptr))
+            mr = self.region(ptr)
+            addr = (mr['addr'] + offset) & 0xffffffffffffffff
+            end = (addr + mr['size'] - 1) & 0xffffffffffffffff
+            alias = mr['alias']
+            cycle = int(ptr) in path
+            if self.json:
+                node = {'name': mr['name'], 'start': addr, 'end': end,
+                        'class': mr['class'].strip(' ()') or None,
+                        'pointer': int(ptr), 'subregions': []}
+                if alias is not None:
+                    node['alias'] = {'name': self.region(alias)['name'],
+                                     'offset': mr['alias_offset'],
+                                     'pointer': int(alias)}
+                if cycle:
+                    node['cycle'] = True
+                siblings.append(node)
+            else:
+                gdb.write('%s%016x-%016x %s%s (@ %s)%s\n'
+                          % ('  ' * level, addr, end, mr['name'], mr['class'],
+                             ptr, ' (cycle)' if cycle else ''),
+                          gdb.STDOUT)
+            if alias is not None:
+                if not self.json:
+                    gdb.write('%s    alias: %s@%016x (@ %s)\n' %
+                              ('  ' * level,
+                               self.region(alias)['name'],
+                               mr['alias_offset'],
+                               alias,
+                               ),
+                              gdb.STDOUT)
+                self.queue.append(alias)
+            if cycle:
+                continue
+            children = node['subregions'] if self.json else None
+            for subregion in reversed(mr['subregions']):
+                stack.append((subregion, addr, level + 1,
+                              path + (int(ptr),), children))
+
+def is_little_endian():
+    return 'little' in gdb.execute('show endian', to_string=True)
+
+class FlatView(object):
+    '''Sorted index of the FlatRanges in the current map of an AddressSpace'''
+    def __init__(self, address_space):
+        self.name = address_space['name'].string()
+        view = address_space['current_map']
+        self.starts = []
+        self.ranges = []
+        self.regions = {}
+        if isnull(view):
+            return
+        nr = int(view['nr'])
+        range_type = gdb.lookup_type('FlatRange').strip_typedefs()
+        data = b''
+        if nr:
+            # Fetch the whole array with a single read, evaluating
+            # each field through gdb.Value is very slow on big maps
+            data = bytes(gdb.selected_inferior().read_memory(
+                view['ranges'], nr * range_type.sizeof))
+        fields = dict((f.name, f) for f in range_type.fields())
+        endian = '<' if is_little_endian() else '>'
+        ptr_fmt = endian + ('Q' if fields['mr'].type.sizeof == 8 else 'I')
+        addr_range = fields['addr'].type.strip_typedefs()
+        addr_fields = dict((f.name, f) for f in addr_range.fields())
+        offset_fmt = endian + 'Q'
+        mr_offset = fields['mr'].bitpos // 8
+        offset_offset = fields['offset_in_region'].bitpos // 8
+        start_offset = (fields['addr'].bitpos + addr_fields['start'].bitpos) // 8
+        size_offset = (fields['addr'].bitpos + addr_fields['size'].bitpos) // 8
+        readonly_offset = fields['readonly'].bitpos // 8
+        romd_offset = fields['romd_mode'].bitpos // 8
+        int128_type = addr_fields['start'].type.strip_typedefs()
+        if int128_type.code == gdb.TYPE_CODE_STRUCT:
+            int128_fields = dict((f.name, f.bitpos // 8)
+                                 for f in int128_type.fields())
+            lo_offset = int128_fields['lo']
+            hi_offset = int128_fields['hi']
+        elif endian == '<':
+            lo_offset, hi_offset = 0, 8
+        else:
+            lo_offset, hi_offset = 8, 0
+
+        def read_int128(base):
+            lo, = struct.unpack_from(offset_fmt, data, base + lo_offset)
+            hi, = struct.unpack_from(offset_fmt, data, base + hi_offset)
+            return lo + (hi << 64)
+
+        for i in range(nr):
+            base = i * range_type.sizeof
+            mr, = struct.unpack_from(ptr_fmt, data, base + mr_offset)
+            offset_in_region, = struct.unpack_from(offset_fmt, data,
+                                                   base + offset_offset)
+            start = read_int128(base + start_offset)
+            size = read_int128(base + size_offset)
+            if not size:
+                continue
+            self.starts.append(start)
+            self.ranges.append((start, size, mr, offset_in_region,
+                                data[base + readonly_offset] not in (0, b'\0'),
+                                data[base + romd_offset] not in (0, b'\0')))
+        # FlatView ranges are kept sorted by address; do not rely on it
+        # when the inferior is stopped in the middle of an update
+        if self.starts != sorted(self.starts):
+            self.ranges.sort()
+            self.starts = [r[0] for r in self.ranges]
+
+    def region(self, mr):
+        '''Return (name, kind, host base) for a MemoryRegion pointer'''
+        if mr not in self.regions:
+            ptr = gdb.Value(mr).cast(gdb.lookup_type('MemoryRegion').pointer())
+            name = ptr['name']
+            name = '<anonymous>' if isnull(name) else name.string()
+            host = None
+            if bool(ptr['ram']):
+                kind = 'RAM'
+                ram_block = ptr['ram_block']
+                if not isnull(ram_block) and not isnull(ram_block['host']):
+                    host = int(ram_block['host'])
+            elif bool(ptr['rom_device']):
+                kind = 'ROM device'
+            elif not isnull(ptr['ops']):
+                kind = 'I/O'
+            else:
+                kind = 'unassigned'
+            self.regions[mr] = (name, kind, host)
+        return self.regions[mr]
+
+    def lookup(self, addr):
+        '''Return the range tuple containing addr, or None'''
+        i = bisect.bisect_right(self.starts, addr) - 1
+        if i >= 0:
+            r = self.ranges[i]
+            if addr < r[0] + r[1]:
+                return r
+        return None
+
+    def describe(self, r):
+        start, size, mr, offset_in_region, readonly, romd_mode = r
+        name, kind, host = self.region(mr)
+        flags = ''
+        if readonly:
+            flags += ' [ro]'
+        if kind == 'ROM device' and romd_mode:
+            flags += ' [romd]'
+        return '%016x-%016x %s (%s)%s @%016x (@ 0x%x)' % (
+            start, start + size - 1, name, kind, flags,
+            offset_in_region, mr)
+
+    def to_json(self):
+        ranges = []
+        for r in self.ranges:
+            start, size, mr, offset_in_region, readonly, romd_mode = r
+            name, kind, host = self.region(mr)
+            ranges.append({'start': start, 'end': start + size - 1,
+                           'name': name, 'class': kind,
+                           'offset_in_region': offset_in_region,
+                           'readonly': readonly, 'romd_mode': romd_mode,
+                           'pointer': mr})
+        return {'address_space': self.name, 'ranges': ranges}
 
+    def dump(self):
+        gdb.write('%s:\n' % self.name, gdb.STDOUT)
+        for r in self.ranges:
+            gdb.write('  %s\n' % self.describe(r), gdb.STDOUT)
+
+# Flat views are cached by AddressSpace address until the inferior
+# runs again, so repeated lookups do not walk guest structures
+flatviews = {}
+
+def invalidate_flatviews(event=None):
+    flatviews.clear()
+
+for registry in ('stop', 'cont', 'exited', 'memory_changed'):
+    if hasattr(gdb.events, registry):
+        getattr(gdb.events, registry).connect(invalidate_flatviews)
+
+def find_address_space(name):
+    '''Look up an AddressSpace by variable name or by its QEMU name'''
+    try:
+        address_space = gdb.parse_and_eval(name)
+    except gdb.error:
+        pass
+    else:
+        if address_space.type.code != gdb.TYPE_CODE_PTR:
+            address_space = address_space.address
+        if (address_space is not None and
+            str(address_space.type.target().strip_typedefs()) ==
+                'struct AddressSpace'):
+            return address_space
+    ptr = gdb.parse_and_eval('address_spaces')['tqh_first']
+    while not isnull(ptr):
+        if ptr['name'].string() == name:
+            return ptr
+        ptr = ptr['address_spaces_link']['tqe_next']
+    raise gdb.GdbError('no address space named "%s"' % name)
+
+def flatview(name):
+    address_space = find_address_space(name)
+    key = int(address_space)
+    if key not in flatviews:
+        flatviews[key] = FlatView(address_space)
+    return flatviews[key]
+
+class MtreeLookupCommand(gdb.Command):
+    '''Find the memory region that an address is dispatched to
+
+Usage: qemu mtree-lookup ADDR [ADDRESS-SPACE]
+
+ADDRESS-SPACE is a variable, e.g. address_space_io, or the name of an
+address space, e.g. "cpu-memory-0"; it defaults to address_space_memory.
+The flat view of the address space is cached until the program resumes.'''
+    def __init__(self):
+        gdb.Command.__init__(self, 'qemu mtree-lookup', gdb.COMMAND_DATA,
+                             gdb.COMPLETE_NONE)
+    def invoke(self, arg, from_tty):
+        argv = gdb.string_to_argv(arg)
+        if len(argv) not in (1, 2):
+            raise gdb.GdbError('usage: qemu mtree-lookup ADDR [ADDRESS-SPACE]')
+        addr = int(gdb.parse_and_eval(argv[0])) & ((1 << 64) - 1)
+        view = flatview(argv[1] if len(argv) > 1 else 'address_space_memory')
+        r = view.lookup(addr)
+        if r is None:
+            gdb.write('%s: 0x%x is not mapped\n' % (view.name, addr),
+                      gdb.STDOUT)
+            return
+        name, kind, host = view.region(r[2])
+        offset = r[3] + addr - r[0]
+        gdb.write('%s\n' % view.describe(r), gdb.STDOUT)
+        gdb.write('  0x%x -> %s+0x%x' % (addr, name, offset), gdb.STDOUT)
+        if host is not None:
+            gdb.write(' (host 0x%x)' % (host + offset), gdb.STDOUT)
+        gdb.write('\n', gdb.STDOUT)
@@ -13,45 +13,112 @@
 
 # 'qemu timers' -- display the current timerlists
 
+import json
 import gdb
 
 class TimersCommand(gdb.Command):
-    '''Display the current QEMU timers'''
+    '''Display the current QEMU timers
+
+Usage: qemu timers [--limit N] [--json]
+
+--limit stops after N timers per list, --json prints the timers as JSON.'''
 
     def __init__(self):
         'Register the class as a gdb command'
         gdb.Command.__init__(self, 'qemu timers', gdb.COMMAND_DATA,
                              gdb.COMPLETE_NONE)
 
-    def dump_timers(self, timer):
-        "Follow a timer and recursively dump each one in the list."
-        # timer should be of type QemuTimer
-        gdb.write("    timer %s/%s (cb:%s,opq:%s)\n" % (
-            timer['expire_time'],
-            timer['scale'],
-            timer['cb'],
-            timer['opaque']))
+    def walk_timers(self, timer):
+        """Follow a timer list and return its timers, each read once,
+        and whether the walk stopped early or found a cycle.
 
-        if int(timer['next']) > 0:
-            self.dump_timers(timer['next'])
+        The list is walked iteratively, stopping at --limit timers or
+        when a timer is seen twice."""
+        timers = []
+        seen = set()
+        truncated = cycle = False
+        while int(timer) != 0:
+            if self.limit is not None and len(timers) >= self.limit:
+                truncated = True
+                break
+            if int(timer) in seen:
+                cycle = True
+                break
+            seen.add(int(timer))
+            # timer should be of type QemuTimer
+            t = timer.dereference()
+            timers.append({'expire_time': int(t['expire_time']),
+                           'scale': int(t['scale']),
+                           'cb': t['cb'],
+                           'opaque': t['opaque']})
+            timer = t['next']
+        return timers, truncated, cycle
 
+    def dump_timers(self, timers, truncated, cycle):
+        "Dump each timer in the list."
+        for timer in timers:
+            gdb.write("    timer %s/%s (cb:%s,opq:%s)\n" % (
+                timer['expire_time'],
+                timer['scale'],
+                timer['cb'],
+                timer['opaque']))
+        if truncated:
+            gdb.write("    ... stopped after %d timers\n" % len(timers))
+        if cycle:
+            gdb.write("    ... cycle in the timer list\n")
 
     def process_timerlist(self, tlist, ttype):
-        gdb.write("Processing %s timers\n" % (ttype))
-        gdb.write("  clock %s is enabled:%s, last:%s\n" % (
-            tlist['clock']['type'],
-            tlist['clock']['enabled'],
-            tlist['clock']['last']))
-        if int(tlist['active_timers']) > 0:
-            self.dump_timers(tlist['active_timers'])
+        clock = tlist['clock'].dereference()
+        # Not all versions keep the last value read from the clock
+        last = None
+        if 'last' in [f.name for f in clock.type.strip_typedefs().fields()]:
+            last = int(clock['last'])
+        timers, truncated, cycle = self.walk_timers(tlist['active_timers'])
 
+        if self.json:
+            for timer in timers:
+                timer['cb'] = str(timer['cb'])
+                timer['opaque'] = int(timer['opaque'])
+            return {'type': ttype,
+                    'clock': str(clock['type']),
+                    'enabled': bool(clock['enabled']),
+                    'last': last,
+                    'timers': timers,
+                    'truncated': truncated,
+                    'cycle': cycle}
+
+        gdb.write("Processing %s timers\n" % (ttype))
+        if last is None:
+            gdb.write("  clock %s is enabled:%s\n" % (
+                clock['type'],
+                clock['enabled']))
+        else:
+            gdb.write("  clock %s is enabled:%s, last:%s\n" % (
+                clock['type'],
+                clock['enabled'],
+                last))
+        self.dump_timers(timers, truncated, cycle)
 
     def invoke(self, arg, from_tty):
         'Run the command'
+        argv = gdb.string_to_argv(arg)
+        self.limit = None
+        self.json = False
+        while argv:
+            opt = argv.pop(0)
+            if opt == '--json':
+                self.json = True
+            elif opt == '--limit' and argv:
+                self.limit = int(argv.pop(0))
+            else:
+                raise gdb.GdbError('usage: qemu timers [--limit N] [--json]')
+
         main_timers = gdb.parse_and_eval("main_loop_tlg")
 
         # This will break if QEMUClockType in timer.h is redfined
-        self.process_timerlist(main_timers['tl'][0], "Realtime")
-        self.process_timerlist(main_timers['tl'][1], "Virtual")
-        self.process_timerlist(main_timers['tl'][2], "Host")
-        self.process_timerlist(main_timers['tl'][3], "Virtual RT")
+        lists = [self.process_timerlist(main_timers['tl'][0], "Realtime"),
+                 self.process_timerlist(main_timers['tl'][1], "Virtual"),
+                 self.process_timerlist(main_timers['tl'][2], "Host"),
+                 self.process_timerlist(main_timers['tl'][3], "Virtual RT")]
+        if self.json:
+            gdb.write(json.dumps(lists, indent=2) + "\n")
@@ -0,0 +1,100 @@
+#!/usr/bin/python
+
+# GDB debugging support: collect a report for offline triage
+#
+# Copyright (c) 2019 Red Hat, Inc.
+#
+# This work is licensed under the terms of the GNU GPL, version 2 or
+# later.  See the COPYING file in the top-level directory.
+
+# 'qemu triage' -- gather the output of the qemu commands as JSON
+
+import json
+import gdb
+
+def frame_name(frame):
+    name = frame.name()
+    if name is None:
+        name = '0x%x' % frame.pc()
+    sal = frame.find_sal()
+    if sal.symtab is not None:
+        name = '%s (%s:%d)' % (name, sal.symtab.filename, sal.line)
+    return name
+
+def thread_stacks(depth):
+    '''Backtrace all threads, starting with the selected one, which is
+    the one that received the fatal signal when a core file is loaded'''
+    selected = gdb.selected_thread()
+    threads = sorted(gdb.selected_inferior().threads(),
+                     key=lambda thread: thread != selected)
+    stacks = []
+    try:
+        for thread in threads:
+            thread.switch()
+            frames = []
+            frame = gdb.newest_frame()
+            while frame is not None and len(frames) < depth:
+                frames.append(frame_name(frame))
+                try:
+                    frame = frame.older()
+                except gdb.error:
+                    break
+            stacks.append({'thread': thread.num, 'name': thread.name,
+                           'lwp': thread.ptid[1], 'frames': frames})
+    finally:
+        if selected is not None:
+            selected.switch()
+    return stacks
+
+def signal_number():
+    try:
+        return int(gdb.parse_and_eval('$_siginfo.si_signo'))
+    except gdb.error:
+        return None
+
+def run_json(command):
+    return json.loads(gdb.execute(command, False, True))
+
+class TriageCommand(gdb.Command):
+    '''Collect thread stacks and the output of the qemu commands as JSON
+
+Usage: qemu triage [--depth N] [FILE]
+
+The report is written to FILE, or printed.  A section that fails, for
+example because the relevant code is not linked in, records the error
+instead of aborting the report.  This is meant to be run in batch mode,
+see scripts/qemu-core-triage.py.'''
+    def __init__(self):
+        gdb.Command.__init__(self, 'qemu triage', gdb.COMMAND_DATA,
+                             gdb.COMPLETE_FILENAME)
+
+    def invoke(self, arg, from_tty):
+        argv = gdb.string_to_argv(arg)
+        depth = 32
+        if len(argv) > 1 and argv[0] == '--depth':
+            depth = int(argv[1])
+            argv = argv[2:]
+        if len(argv) > 1:
+            raise gdb.GdbError('usage: qemu triage [--depth N] [FILE]')
+
+        report = {'signal': signal_number()}
+        sections = [
+            ('threads', lambda: thread_stacks(depth)),
+            ('coroutines',
+             lambda: run_json('qemu coroutines --json --depth %d' % depth)),
+            ('timers', lambda: run_json('qemu timers --json --limit 1000')),
+            ('flatview', lambda: run_json('qemu mtree --json -f')),
+            ('aio', lambda: run_json('qemu aio-report --json --limit 1000')),
+        ]
+        for name, collect in sections:
+            try:
+                report[name] = collect()
+            except (gdb.error, gdb.GdbError, ValueError) as e:
+                report[name] = {'error': str(e)}
+
+        data = json.dumps(report, indent=2) + '\n'
+        if argv:
+            with open(argv[0], 'w') as f:
+                f.write(data)
+        else:
+            gdb.write(data)
@@ -20,12 +20,15 @@
 
 import os
 import sys
+import argparse
 import subprocess
 import json
+import time
 from graphviz import Digraph
 
 sys.path.append(os.path.join(os.path.dirname(__file__), '..', 'python'))
 from qemu.machine import MonitorResponseError
+from qemu.qmp import QEMUMonitorProtocol
 
 
 def perm(arr):
@@ -37,33 +40,46 @@ def perm(arr):
     return s
 
 
-def render_block_graph(qmp, filename, format='png'):
+def query(qmp, commands):
     '''
-    Render graph in text (dot) representation into "@filename" and
-    representation in @format into "@filename.@format"
+    Run a list of (command, arguments) pairs, in a single round trip when
+    the connection supports it, and return their results
     '''
+    if not hasattr(qmp, 'cmd_batch'):
+        return [qmp.command(cmd, **args) for cmd, args in commands]
 
-    bds_nodes = qmp.command('query-named-block-nodes')
-    bds_nodes = {n['node-name']: n for n in bds_nodes}
+    replies = qmp.cmd_batch([{'execute': cmd, 'arguments': args}
+                             for cmd, args in commands])
+    if len(replies) != len(commands):
+        raise Exception('connection closed')
+    for reply in replies:
+        if 'error' in reply:
+            raise MonitorResponseError(reply)
+    return [reply['return'] for reply in replies]
 
-    job_nodes = qmp.command('query-block-jobs')
-    job_nodes = {n['device']: n for n in job_nodes}
 
-    block_graph = qmp.command('x-debug-query-block-graph')
+# Counters of query-blockstats kept in snapshots
+STATS = ('rd_operations', 'wr_operations', 'flush_operations',
+         'rd_bytes', 'wr_bytes')
 
-    graph = Digraph(comment='Block Nodes Graph')
-    graph.format = format
-    graph.node('permission symbols:\l'
-               '  w - Write\l'
-               '  r - consistent-Read\l'
-               '  u - write - Unchanged\l'
-               '  g - Graph-mod\l'
-               '  s - reSize\l'
-               'edge label scheme:\l'
-               '  <child type>\l'
-               '  <perm>\l'
-               '  <shared_perm>\l', shape='none')
 
+def snapshot(qmp):
+    '''
+    Take a compact snapshot of the block graph and of the I/O counters
+    of its nodes.  Nodes are identified by name, because the ids of
+    x-debug-query-block-graph are not stable across queries.
+    '''
+    bds_nodes, job_nodes, block_graph, blockstats = query(qmp, [
+        ('query-named-block-nodes', {}),
+        ('query-block-jobs', {}),
+        ('x-debug-query-block-graph', {}),
+        ('query-blockstats', {'query-nodes': True})])
+    bds_nodes = {n['node-name']: n for n in bds_nodes}
+    job_nodes = {n['device']: n for n in job_nodes}
+
+    nodes = {}
+    names = {}
+    unnamed = []
     for n in block_graph['nodes']:
         if n['type'] == 'block-driver':
             info = bds_nodes[n['name']]
@@ -79,27 +95,195 @@ def render_block_graph(qmp, filename, format='png'):
             assert n['type'] == 'block-backend'
             label = n['name'] if n['name'] else 'unnamed blk'
             shape = 'box'
+        if n['name']:
+            names[n['id']] = n['name']
+            nodes[n['name']] = [n['type'], label, shape]
+        else:
+            unnamed.append((n['id'], [n['type'], label, shape]))
 
-        graph.node(str(n['id']), label, shape=shape)
+    # Backends without a name or a device are keyed by their root node
+    roots = {e['parent']: e['child'] for e in block_graph['edges']
+             if e['name'] == 'root'}
+    for node_id, node in unnamed:
+        base = 'unnamed blk'
+        if node_id in roots:
+            base += ' on ' + names[roots[node_id]]
+        name = base
+        i = 1
+        while name in nodes:
+            i += 1
+            name = '%s (%d)' % (base, i)
+        names[node_id] = name
+        nodes[name] = node
 
+    edges = {}
     for e in block_graph['edges']:
-        label = '%s\l%s\l%s\l' % (e['name'], perm(e['perm']),
-                                  perm(e['shared-perm']))
-        graph.edge(str(e['parent']), str(e['child']), label=label)
+        key = '%s -> %s (%s)' % (names[e['parent']], names[e['child']],
+                                 e['name'])
+        edges[key] = [names[e['parent']], names[e['child']], e['name'],
+                      perm(e['perm']), perm(e['shared-perm'])]
+
+    stats = {}
+    for s in blockstats:
+        if s.get('node-name'):
+            stats[s['node-name']] = [s['stats'][k] for k in STATS]
+
+    return {'time': time.time(), 'nodes': nodes, 'edges': edges,
+            'stats': stats}
+
+
+def diff_snapshots(old, new):
+    '''
+    Compare two snapshots: graph changes, and per-node rates of the I/O
+    counters between them
+    '''
+    elapsed = max(new['time'] - old['time'], 1e-6)
+    rates = {}
+    for name, counters in new['stats'].items():
+        if name in old['stats']:
+            rates[name] = [(c - o) / elapsed
+                           for c, o in zip(counters, old['stats'][name])]
+    changed = [key for key in new['edges'] if key in old['edges'] and
+               new['edges'][key] != old['edges'][key]]
+    return {
+        'elapsed': elapsed,
+        'added nodes': sorted(set(new['nodes']) - set(old['nodes'])),
+        'removed nodes': sorted(set(old['nodes']) - set(new['nodes'])),
+        'added edges': sorted(set(new['edges']) - set(old['edges'])),
+        'removed edges': sorted(set(old['edges']) - set(new['edges'])),
+        'changed edges': sorted(changed),
+        'rates': rates,
+    }
+
+
+def format_rates(rates):
+    rd_ops, wr_ops, flush_ops, rd_bytes, wr_bytes = rates
+    return 'r %.0f/s %.1f MiB/s, w %.0f/s %.1f MiB/s, flush %.0f/s' % (
+        rd_ops, rd_bytes / 1048576, wr_ops, wr_bytes / 1048576, flush_ops)
+
 
-    graph.render(filename)
+def print_diff(diff, new):
+    print('--- %s (%.1fs)' % (time.strftime('%H:%M:%S',
+                                           time.localtime(new['time'])),
+                              diff['elapsed']))
+    for key in ('added nodes', 'removed nodes', 'added edges',
+                'removed edges', 'changed edges'):
+        for item in diff[key]:
+            print('%s: %s' % (key, item))
+    for name in sorted(diff['rates']):
+        if any(diff['rates'][name]):
+            print('%s: %s' % (name, format_rates(diff['rates'][name])))
+
+
+def snapshot_graph(snap, diff=None, format='png'):
+    '''
+    Build the graph of a snapshot; with @diff, annotate nodes with their
+    I/O rates and highlight what changed since the previous snapshot
+    '''
+    graph = Digraph(comment='Block Nodes Graph')
+    graph.format = format
+    graph.node('permission symbols:\l'
+               '  w - Write\l'
+               '  r - consistent-Read\l'
+               '  u - write - Unchanged\l'
+               '  g - Graph-mod\l'
+               '  s - reSize\l'
+               'edge label scheme:\l'
+               '  <child type>\l'
+               '  <perm>\l'
+               '  <shared_perm>\l', shape='none')
+
+    ids = {}
+    for name, (_, label, shape) in sorted(snap['nodes'].items()):
+        ids[name] = str(len(ids))
+        attrs = {'shape': shape}
+        if diff is not None:
+            if name in diff['rates'] and any(diff['rates'][name]):
+                label += '\n' + format_rates(diff['rates'][name])
+            if name in diff['added nodes']:
+                attrs['color'] = 'green'
+        graph.node(ids[name], label, **attrs)
+
+    for key, (parent, child, name, p, shared) in sorted(snap['edges'].items()):
+        label = '%s\l%s\l%s\l' % (name, p, shared)
+        attrs = {}
+        if diff is not None and (key in diff['added edges'] or
+                                 key in diff['changed edges']):
+            attrs['color'] = 'green'
+        graph.edge(ids[parent], ids[child], label=label, **attrs)
+
+    return graph
+
+
+def render_block_graph(qmp, filename, format='png'):
+    '''
+    Render graph in text (dot) representation into "@filename" and
+    representation in @format into "@filename.@format"
+    '''
+
+    snapshot_graph(snapshot(qmp), format=format).render(filename)
+
+
+def monitor_block_graph(qmp, filename, interval, count=None, text=False,
+                        snapshots=None):
+    '''
+    Take a snapshot every @interval seconds over one connection and report
+    the differences between successive snapshots, either as text or by
+    re-rendering an annotated graph into "@filename".  Snapshots are
+    appended, one JSON object per line, to the file @snapshots.
+    '''
+    log = open(snapshots, 'a') if snapshots else None
+    try:
+        old = None
+        taken = 0
+        while count is None or taken < count:
+            if old is not None:
+                time.sleep(max(old['time'] + interval - time.time(), 0))
+            new = snapshot(qmp)
+            taken += 1
+            if log:
+                log.write(json.dumps(new, sort_keys=True) + '\n')
+                log.flush()
+            if old is not None:
+                diff = diff_snapshots(old, new)
+                if text:
+                    print_diff(diff, new)
+                else:
+                    snapshot_graph(new, diff).render(filename)
+            old = new
+    finally:
+        if log:
+            log.close()
 
 
 class LibvirtGuest():
     def __init__(self, name):
         self.name = name
+        self.dom = None
+        # Use one connection to libvirtd if the bindings are available,
+        # rather than one virsh process per command
+        try:
+            import libvirt
+            import libvirt_qemu
+        except ImportError:
+            return
+        try:
+            self.conn = libvirt.open(None)
+            self.dom = self.conn.lookupByName(name)
+            self.monitor_command = libvirt_qemu.qemuMonitorCommand
+        except libvirt.libvirtError:
+            # e.g. no access to libvirtd, virsh reports a better error
+            self.dom = None
 
-    def command(self, cmd):
-        # only supports qmp commands without parameters
+    def command(self, cmd, **args):
         m = {'execute': cmd}
-        ar = ['virsh', 'qemu-monitor-command', self.name, json.dumps(m)]
-
-        reply = json.loads(subprocess.check_output(ar))
+        if args:
+            m['arguments'] = args
+        if self.dom is not None:
+            reply = json.loads(self.monitor_command(self.dom, json.dumps(m), 0))
+        else:
+            ar = ['virsh', 'qemu-monitor-command', self.name, json.dumps(m)]
+            reply = json.loads(subprocess.check_output(ar))
 
         if 'error' in reply:
             raise MonitorResponseError(reply)
@@ -108,9 +292,27 @@ class LibvirtGuest():
 
 
 if __name__ == '__main__':
-    obj = sys.argv[1]
-    out = sys.argv[2]
+    parser = argparse.ArgumentParser(description='Render the QEMU block graph')
+    parser.add_argument('target',
+                        help='QMP unix socket path, or libvirt guest name')
+    parser.add_argument('filename', nargs='?',
+                        help='output file name (.dot source, rendered to '
+                        'FILENAME.png)')
+    parser.add_argument('--monitor', type=float, metavar='SECONDS',
+                        help='sample the graph and I/O counters every '
+                        'SECONDS and report the differences')
+    parser.add_argument('--count', type=int,
+                        help='number of samples to take in monitor mode')
+    parser.add_argument('--text', action='store_true',
+                        help='in monitor mode, print differences as text '
+                        'instead of rendering the graph')
+    parser.add_argument('--snapshots', metavar='FILE',
+                        help='in monitor mode, append snapshots to FILE')
+    args = parser.parse_args()
+    if args.filename is None and not (args.monitor and args.text):
+        parser.error('an output file name is required')
 
+    obj = args.target
     if os.path.exists(obj):
         # assume unix socket
         qmp = QEMUMonitorProtocol(obj)
@@ -119,4 +321,8 @@ if __name__ == '__main__':
         # assume libvirt guest name
         qmp = LibvirtGuest(obj)
 
-    render_block_graph(qmp, out)
+    if args.monitor:
+        monitor_block_graph(qmp, args.filename, args.monitor, args.count,
+                            args.text, args.snapshots)
+    else:
+        render_block_graph(qmp, args.filename)
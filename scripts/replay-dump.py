@@ -20,6 +20,8 @@
 
 from __future__ import print_function
 import argparse
+import bisect
+import os
 import struct
 from collections import namedtuple
 
@@ -35,6 +37,16 @@ class ReplayState(object):
         self.already_read = False
         self.current_checkpoint = 0
         self.checkpoint = 0
+        # file offset of the last event read
+        self.event_offset = 0
+        # sum of the EVENT_INSTRUCTION deltas read so far
+        self.icount = 0
+        # decoders only print when set
+        self.verbose = True
+        # called for each checkpoint when building an index
+        self.checkpoint_hook = None
+        # kind of the last async event read
+        self.async_kind = None
 
     def set_event(self, ev):
         self.event = ev
@@ -56,39 +68,90 @@ class ReplayState(object):
 
 replay_state = ReplayState()
 
+class DumpFile(object):
+    """Buffered reader for record/replay dumps.
+
+    Fields are decoded straight from a large buffer rather than with a
+    file read per field."""
+    CHUNK_SIZE = 1 << 20
+
+    def __init__(self, filename):
+        self.f = open(filename, "rb")
+        self.buf = b''
+        self.pos = 0
+        # file offset of buf[0]
+        self.base = 0
+
+    def tell(self):
+        return self.base + self.pos
+
+    def seek(self, offset):
+        self.f.seek(offset)
+        self.buf = b''
+        self.pos = 0
+        self.base = offset
+
+    def fill(self, size):
+        data = self.f.read(max(size, self.CHUNK_SIZE))
+        self.base += self.pos
+        self.buf = self.buf[self.pos:] + data
+        self.pos = 0
+        if len(self.buf) < size:
+            raise EOFError()
+
+    def unpack(self, fmt):
+        "Decode a single value with a struct.Struct"
+        if self.pos + fmt.size > len(self.buf):
+            self.fill(fmt.size)
+        value = fmt.unpack_from(self.buf, self.pos)[0]
+        self.pos += fmt.size
+        return value
+
+    def close(self):
+        self.f.close()
+
 # Simple read functions that mirror replay-internal.c
 # The file-stream is big-endian and manually written out a byte at a time.
 
+BYTE = struct.Struct('>B')
+WORD = struct.Struct('>H')
+DWORD = struct.Struct('>I')
+QWORD = struct.Struct('>Q')
+
 def read_byte(fin):
     "Read a single byte"
-    return struct.unpack('>B', fin.read(1))[0]
+    return fin.unpack(BYTE)
 
 def read_event(fin):
     "Read a single byte event, but save some state"
     if replay_state.already_read:
         return replay_state.get_event()
     else:
+        replay_state.event_offset = fin.tell()
         replay_state.set_event(read_byte(fin))
         return replay_state.event
 
 def read_word(fin):
     "Read a 16 bit word"
-    return struct.unpack('>H', fin.read(2))[0]
+    return fin.unpack(WORD)
 
 def read_dword(fin):
     "Read a 32 bit word"
-    return struct.unpack('>I', fin.read(4))[0]
+    return fin.unpack(DWORD)
 
 def read_qword(fin):
     "Read a 64 bit word"
-    return struct.unpack('>Q', fin.read(8))[0]
+    return fin.unpack(QWORD)
 
 # Generic decoder structure
 Decoder = namedtuple("Decoder", "eid name fn")
 
 def call_decode(table, index, dumpfile):
     "Search decode table for next step"
-    decoder = next((d for d in table if d.eid == index), None)
+    # tables are indexed by event id
+    decoder = None
+    if index < len(table) and table[index].eid == index:
+        decoder = table[index]
     if not decoder:
         print("Could not decode index: %d" % (index))
         print("Entry is: %s" % (decoder))
@@ -98,8 +161,15 @@ def call_decode(table, index, dumpfile):
         return decoder.fn(decoder.eid, decoder.name, dumpfile)
 
 # Print event
+def emit(string):
+    "Print decoder output unless running quietly"
+    if replay_state.verbose:
+        print(string)
+
 def print_event(eid, name, string=None, event_count=None):
     "Print event with count"
+    if not replay_state.verbose:
+        return
     if not event_count:
         event_count = replay_state.event_count
 
@@ -120,7 +190,7 @@ def decode_unimp(eid, name, _unused_dumpfile):
 def swallow_async_qword(eid, name, dumpfile):
     "Swallow a qword of data without looking at it"
     step_id = read_qword(dumpfile)
-    print("  %s(%d) @ %d" % (name, eid, step_id))
+    emit("  %s(%d) @ %d" % (name, eid, step_id))
     return True
 
 async_decode_table = [ Decoder(0, "REPLAY_ASYNC_EVENT_BH", swallow_async_qword),
@@ -138,9 +208,10 @@ def decode_async(eid, name, dumpfile):
 
     async_event_kind = read_byte(dumpfile)
     async_event_checkpoint = read_byte(dumpfile)
+    replay_state.async_kind = async_event_kind
 
     if async_event_checkpoint != replay_state.current_checkpoint:
-        print("  mismatch between checkpoint %d and async data %d" % (
+        emit("  mismatch between checkpoint %d and async data %d" % (
             replay_state.current_checkpoint, async_event_checkpoint))
         return True
 
@@ -149,6 +220,7 @@ def decode_async(eid, name, dumpfile):
 
 def decode_instruction(eid, name, dumpfile):
     ins_diff = read_dword(dumpfile)
+    replay_state.icount += ins_diff
     print_event(eid, name, "0x%x" % (ins_diff))
     return True
 
@@ -165,7 +237,14 @@ def decode_checkpoint(eid, name, dumpfile):
     replay_state.set_checkpoint()
     # save event count as we peek ahead
     event_number = replay_state.event_count
-    next_event = read_event(dumpfile)
+    if replay_state.checkpoint_hook:
+        replay_state.checkpoint_hook()
+    try:
+        next_event = read_event(dumpfile)
+    except EOFError:
+        # the dump ends with this checkpoint
+        print_event(eid, name, "no additional data", event_number)
+        return True
 
     # if the next event is EVENT_ASYNC there are a bunch of
     # async events to read, otherwise we are done
@@ -178,6 +257,8 @@ def decode_checkpoint(eid, name, dumpfile):
     return True
 
 def decode_checkpoint_init(eid, name, dumpfile):
+    if replay_state.checkpoint_hook:
+        replay_state.checkpoint_hook()
     print_event(eid, name)
     return True
 
@@ -269,22 +350,99 @@ v7_event_table = [Decoder(0, "EVENT_INSTRUCTION", decode_instruction),
                   Decoder(28, "EVENT_CP_RESET", decode_checkpoint),
 ]
 
+# Checkpoint index
+#
+# The index is kept next to the dump.  It records, for each checkpoint
+# in file order, the offset of its event, the event count and the
+# number of instructions executed so far, so that decoding can start
+# at any checkpoint.
+
+INDEX_MAGIC = b'QRRINDX1'
+INDEX_HEADER = struct.Struct('<8sQQ')
+INDEX_ENTRY = struct.Struct('<QQQ')
+
+def build_index(filename, index_filename):
+    "Decode the whole dump quietly, recording every checkpoint"
+    entries = []
+    def record():
+        entries.append((replay_state.event_offset, replay_state.event_count,
+                        replay_state.icount))
+    replay_state.verbose = False
+    replay_state.checkpoint_hook = record
+    dumpfile, table = open_dump(filename)
+    try:
+        decode_events(dumpfile, table)
+    finally:
+        replay_state.verbose = True
+        replay_state.checkpoint_hook = None
+        dumpfile.close()
+
+    st = os.stat(filename)
+    with open(index_filename, "wb") as f:
+        f.write(INDEX_HEADER.pack(INDEX_MAGIC, st.st_size, int(st.st_mtime)))
+        for entry in entries:
+            f.write(INDEX_ENTRY.pack(*entry))
+    return entries
+
+def load_index(filename, index_filename):
+    "Load the checkpoint index, or None if it is missing or stale"
+    try:
+        with open(index_filename, "rb") as f:
+            data = f.read()
+    except IOError:
+        return None
+    if len(data) < INDEX_HEADER.size:
+        return None
+    magic, size, mtime = INDEX_HEADER.unpack_from(data)
+    st = os.stat(filename)
+    if magic != INDEX_MAGIC or size != st.st_size or mtime != int(st.st_mtime):
+        return None
+    return [INDEX_ENTRY.unpack_from(data, offset)
+            for offset in range(INDEX_HEADER.size, len(data), INDEX_ENTRY.size)]
+
+def find_checkpoint(index, checkpoint=None, icount=None):
+    "Number of the requested checkpoint, or of the last one before icount"
+    if checkpoint is not None:
+        if checkpoint >= len(index):
+            raise Exception("checkpoint %d out of range, the dump has %d"
+                            % (checkpoint, len(index)))
+        return checkpoint
+    icounts = [entry[2] for entry in index]
+    return max(bisect.bisect_right(icounts, icount) - 1, 0)
+
 def parse_arguments():
     "Grab arguments for script"
     parser = argparse.ArgumentParser()
     parser.add_argument("-f", "--file", help='record/replay dump to read from',
                         required=True)
+    parser.add_argument("--index", help='checkpoint index file '
+                        '(default: FILE.idx, built when missing or stale)')
+    parser.add_argument("--build-index", action='store_true',
+                        help='only (re)build the checkpoint index')
+    group = parser.add_mutually_exclusive_group()
+    group.add_argument("--checkpoint", type=int,
+                       help='start decoding at the Nth checkpoint')
+    group.add_argument("--icount", type=int,
+                       help='start decoding at the last checkpoint '
+                       'before instruction count N')
+    parser.add_argument("--before", type=int, default=0,
+                        help='start this many checkpoints earlier')
+    parser.add_argument("--events", type=int, default=100,
+                        help='number of events to decode when seeking '
+                        '(default: 100)')
+    parser.add_argument("--stats", action='store_true',
+                        help='print statistics instead of the events')
     return parser.parse_args()
 
-def decode_file(filename):
-    "Decode a record/replay dump"
-    dumpfile = open(filename, "rb")
+def open_dump(filename):
+    "Open a record/replay dump and return it with its event decode table"
+    dumpfile = DumpFile(filename)
 
     # read and throwaway the header
     version = read_dword(dumpfile)
     junk = read_qword(dumpfile)
 
-    print("HEADER: version 0x%x" % (version))
+    emit("HEADER: version 0x%x" % (version))
 
     if version == 0xe02007:
         event_decode_table = v7_event_table
@@ -295,15 +453,167 @@ def decode_file(filename):
     else:
         event_decode_table = v5_event_table
         replay_state.checkpoint_start = 10
+    return dumpfile, event_decode_table
 
+def decode_events(dumpfile, event_decode_table, max_events=None):
+    "Decode events until the end of the dump or max_events more events"
+    last_event = None
+    if max_events is not None:
+        last_event = replay_state.event_count + max_events
     try:
         decode_ok = True
         while decode_ok:
+            if (last_event is not None and not replay_state.already_read and
+                    replay_state.event_count >= last_event):
+                break
             event = read_event(dumpfile)
             decode_ok = call_decode(event_decode_table, event, dumpfile)
+    except EOFError:
+        pass
+
+def decode_file(filename):
+    "Decode a record/replay dump"
+    dumpfile, event_decode_table = open_dump(filename)
+    try:
+        decode_events(dumpfile, event_decode_table)
     finally:
         dumpfile.close()
 
+def decode_window(filename, index, checkpoint, before, max_events):
+    "Decode max_events events, starting before checkpoint checkpoint"
+    first = max(checkpoint - before, 0)
+    offset, event_count, icount = index[first]
+    dumpfile, event_decode_table = open_dump(filename)
+    print("CHECKPOINT %d of %d: offset 0x%x, event %d, icount %d" % (
+        first, len(index), offset, event_count, icount))
+    # restore the state from just before the checkpoint event
+    dumpfile.seek(offset)
+    replay_state.event_count = event_count - 1
+    replay_state.icount = icount
+    try:
+        decode_events(dumpfile, event_decode_table, max_events)
+    finally:
+        dumpfile.close()
+
+# Statistics
+
+class Distribution(object):
+    "Summary of a series of values, with power of two buckets for quantiles"
+    def __init__(self):
+        self.count = 0
+        self.total = 0
+        self.min = None
+        self.max = None
+        self.buckets = [0] * 65
+
+    def add(self, value):
+        self.count += 1
+        self.total += value
+        if self.min is None or value < self.min:
+            self.min = value
+        if self.max is None or value > self.max:
+            self.max = value
+        self.buckets[value.bit_length()] += 1
+
+    def quantile(self, q):
+        "Upper bound of the bucket holding the q quantile"
+        target = q * self.count
+        seen = 0
+        for bits, n in enumerate(self.buckets):
+            seen += n
+            if n and seen >= target:
+                return (1 << bits) - 1
+        return self.max
+
+    def __str__(self):
+        if not self.count:
+            return "none"
+        return "n=%d min=%d mean=%d max=%d p50<=%d p99<=%d" % (
+            self.count, self.min, self.total // self.count, self.max,
+            self.quantile(0.5), self.quantile(0.99))
+
+def print_stats(filename):
+    "Stream the whole dump and print where its volume comes from"
+    replay_state.verbose = False
+    dumpfile, event_decode_table = open_dump(filename)
+    counts = [0] * len(event_decode_table)
+    sizes = [0] * len(event_decode_table)
+    async_counts = [0] * len(async_decode_table)
+    async_icount = Distribution()
+    checkpoint_icount = Distribution()
+    checkpoint_bytes = Distribution()
+    last_async = None
+    last_checkpoint = None
+    stopped = None
+    try:
+        decode_ok = True
+        while decode_ok:
+            event = read_event(dumpfile)
+            start = replay_state.event_offset
+            decode_ok = call_decode(event_decode_table, event, dumpfile)
+            if not decode_ok:
+                stopped = (event, start)
+                break
+            # checkpoints peek at the following event
+            if replay_state.already_read:
+                end = replay_state.event_offset
+            else:
+                end = dumpfile.tell()
+            counts[event] += 1
+            sizes[event] += end - start
+            decoder = event_decode_table[event].fn
+            if decoder == decode_async:
+                if replay_state.async_kind < len(async_counts):
+                    async_counts[replay_state.async_kind] += 1
+                if last_async is not None:
+                    async_icount.add(replay_state.icount - last_async)
+                last_async = replay_state.icount
+            elif decoder in (decode_checkpoint, decode_checkpoint_init):
+                if last_checkpoint is not None:
+                    checkpoint_icount.add(replay_state.icount - last_checkpoint[0])
+                    checkpoint_bytes.add(start - last_checkpoint[1])
+                last_checkpoint = (replay_state.icount, start)
+    except EOFError:
+        pass
+    finally:
+        total_bytes = dumpfile.tell()
+        dumpfile.close()
+        replay_state.verbose = True
+
+    total_events = sum(counts)
+    print("%d events, %d bytes, %d instructions" % (
+        total_events, total_bytes, replay_state.icount))
+    print("%-32s %12s %14s %6s" % ("event", "count", "bytes", "bytes%"))
+    order = sorted(range(len(counts)), key=lambda i: -sizes[i])
+    for i in order:
+        if counts[i]:
+            print("%-32s %12d %14d %5.1f%%" % (
+                event_decode_table[i].name, counts[i], sizes[i],
+                100.0 * sizes[i] / max(total_bytes, 1)))
+    for i, n in enumerate(async_counts):
+        if n:
+            print("  %-30s %12d" % (async_decode_table[i].name, n))
+    print("instructions between async events: %s" % async_icount)
+    print("instructions between checkpoints: %s" % checkpoint_icount)
+    print("bytes between checkpoints: %s" % checkpoint_bytes)
+    if stopped:
+        print("stopped at undecodable event %d at offset 0x%x" % stopped)
+
 if __name__ == "__main__":
     args = parse_arguments()
-    decode_file(args.file)
+    index_filename = args.index or args.file + ".idx"
+    if args.stats:
+        print_stats(args.file)
+    elif args.build_index:
+        index = build_index(args.file, index_filename)
+        print("%d checkpoints indexed in %s" % (len(index), index_filename))
+    elif args.checkpoint is not None or args.icount is not None:
+        index = load_index(args.file, index_filename)
+        if index is None:
+            index = build_index(args.file, index_filename)
+        if not index:
+            raise Exception("no checkpoints in %s" % args.file)
+        checkpoint = find_checkpoint(index, args.checkpoint, args.icount)
+        decode_window(args.file, index, checkpoint, args.before, args.events)
+    else:
+        decode_file(args.file)
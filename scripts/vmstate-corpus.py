@@ -0,0 +1,215 @@
+#!/usr/bin/env python
+#
+# Generate -dump-vmstate JSON files for vmstate-static-checker.py
+#
+# Run a list of QEMU binaries with -dump-vmstate for a list of machine
+# types, concurrently.  Dumps are cached, compressed, by the build ID of
+# the binary and the machine type, so that only new binaries are run.
+#
+# Copyright (c) 2019 Red Hat Inc.
+#
+# This work is licensed under the terms of the GNU GPL, version 2 or
+# later.  See the COPYING file in the top-level directory.
+
+from __future__ import print_function
+import argparse
+import gzip
+import hashlib
+import multiprocessing
+import multiprocessing.pool
+import os
+import shutil
+import struct
+import subprocess
+import sys
+import tempfile
+
+sys.path.append(os.path.join(os.path.dirname(__file__), '..', 'python'))
+from qemu.machine import QEMUMachine
+
+PT_NOTE = 4
+NT_GNU_BUILD_ID = 3
+
+def elf_build_id(path):
+    '''Return the GNU build ID of an ELF file as a hex string, or None'''
+    with open(path, 'rb') as f:
+        ident = f.read(16)
+        if len(ident) < 16 or ident[:4] != b'\x7fELF':
+            return None
+        is64 = ident[4:5] == b'\x02'
+        endian = '<' if ident[5:6] == b'\x01' else '>'
+        if is64:
+            f.seek(0x20)
+            phoff, = struct.unpack(endian + 'Q', f.read(8))
+            f.seek(0x36)
+        else:
+            f.seek(0x1c)
+            phoff, = struct.unpack(endian + 'I', f.read(4))
+            f.seek(0x2a)
+        phentsize, phnum = struct.unpack(endian + 'HH', f.read(4))
+        for i in range(phnum):
+            f.seek(phoff + i * phentsize)
+            if is64:
+                p_type, _, p_offset, _, _, p_filesz = struct.unpack(
+                    endian + 'IIQQQQ', f.read(40))
+            else:
+                p_type, p_offset, _, _, p_filesz = struct.unpack(
+                    endian + 'IIIII', f.read(20))
+            if p_type != PT_NOTE:
+                continue
+            f.seek(p_offset)
+            notes = f.read(p_filesz)
+            pos = 0
+            while pos + 12 <= len(notes):
+                namesz, descsz, n_type = struct.unpack_from(endian + 'III',
+                                                            notes, pos)
+                pos += 12
+                name = notes[pos:pos + namesz]
+                pos += (namesz + 3) & ~3
+                desc = notes[pos:pos + descsz]
+                pos += (descsz + 3) & ~3
+                if n_type == NT_GNU_BUILD_ID and name.rstrip(b'\0') == b'GNU':
+                    return ''.join('%02x' % c for c in bytearray(desc))
+    return None
+
+def binary_id(path):
+    '''Build ID of a binary, or the hash of its contents if it has none'''
+    build_id = elf_build_id(path)
+    if build_id is not None:
+        return build_id
+    h = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            h.update(chunk)
+    return 'sha256-' + h.hexdigest()
+
+def machine_types(binary):
+    '''Machine types supported by a binary, except aliases and "none"'''
+    output = subprocess.check_output([binary, '-machine', 'help'])
+    machines = []
+    for line in output.decode('utf-8').splitlines()[1:]:
+        words = line.split()
+        if words and words[0] != 'none' and '(alias of' not in line:
+            machines.append(words[0])
+    return machines
+
+def cache_path(cache_dir, build_id, machine):
+    return os.path.join(cache_dir, build_id, machine + '.json.gz')
+
+def dump_vmstate(binary, machine, path, test_dir):
+    '''Run binary to dump the vmstate of a machine type, compressed, to path'''
+    tmp_dir = tempfile.mkdtemp(dir=test_dir)
+    try:
+        dump = os.path.join(tmp_dir, 'vmstate.json')
+        vm = QEMUMachine(binary, test_dir=tmp_dir, name='vmstate')
+        vm.set_qmp_monitor(False)
+        vm.set_machine(machine)
+        vm.add_args('-dump-vmstate', dump)
+        vm.launch()
+        vm.wait()
+        if vm.exitcode() != 0 or not os.path.exists(dump):
+            raise Exception('%s -machine %s failed with status %s: %s' % (
+                binary, machine, vm.exitcode(), (vm.get_log() or '').strip()))
+        # Write under a unique temporary name, so that an interrupted run
+        # does not leave a truncated dump in the cache
+        fd, tmp = tempfile.mkstemp(dir=os.path.dirname(path), suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                with gzip.GzipFile(filename='', mode='wb', fileobj=f) as dst:
+                    with open(dump, 'rb') as src:
+                        shutil.copyfileobj(src, dst)
+            os.rename(tmp, path)
+        except:
+            os.unlink(tmp)
+            raise
+    finally:
+        shutil.rmtree(tmp_dir)
+
+def run_job(job):
+    binary, build_id, machine, args = job
+    path = cache_path(args.cache, build_id, machine)
+    if os.path.exists(path) and not args.force:
+        return job, path, True, None
+    try:
+        dump_vmstate(binary, machine, path, args.test_dir)
+        return job, path, False, None
+    except Exception as e:
+        return job, path, False, str(e)
+
+def parse_binary(arg):
+    '''Split [LABEL=]BINARY; a path can contain "=" but labels have no "/"'''
+    label, sep, binary = arg.partition('=')
+    if not sep or not label or '/' in label:
+        return None, arg
+    return label, binary
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Generate -dump-vmstate JSON files for '
+                    'vmstate-static-checker.py, caching them by build ID')
+    parser.add_argument('binaries', nargs='+', metavar='[LABEL=]BINARY',
+                        help='QEMU binaries; LABEL names their output files '
+                        '(default: the start of the build ID)')
+    parser.add_argument('-m', '--machine', action='append',
+                        help='machine type, can be repeated '
+                        '(default: all machine types of each binary)')
+    parser.add_argument('-o', '--output',
+                        help='directory to write LABEL_MACHINE.json files to')
+    parser.add_argument('--cache', default=os.path.join(
+                            os.path.expanduser('~'), '.cache', 'qemu-vmstate'),
+                        help='cache directory (default: ~/.cache/qemu-vmstate)')
+    parser.add_argument('--force', action='store_true',
+                        help='regenerate cached dumps')
+    parser.add_argument('-j', '--jobs', type=int,
+                        default=multiprocessing.cpu_count(),
+                        help='number of QEMU processes run in parallel')
+    parser.add_argument('--test-dir', default=tempfile.gettempdir(),
+                        help='directory for temporary files')
+    args = parser.parse_args()
+
+    if args.output and not os.path.isdir(args.output):
+        os.makedirs(args.output)
+
+    jobs = []
+    # The same binary can be given more than once, maybe with different
+    # labels: dump each machine once and write it for every label
+    queued = set()
+    labels = {}
+    for arg in args.binaries:
+        label, binary = parse_binary(arg)
+        build_id = binary_id(binary)
+        label = label or build_id[:12]
+        if label not in labels.setdefault(build_id, []):
+            labels[build_id].append(label)
+        if not os.path.isdir(os.path.join(args.cache, build_id)):
+            os.makedirs(os.path.join(args.cache, build_id))
+        for machine in args.machine or machine_types(binary):
+            if (build_id, machine) not in queued:
+                queued.add((build_id, machine))
+                jobs.append((binary, build_id, machine, args))
+
+    # QEMU does the work, threads are enough to drive it
+    pool = multiprocessing.pool.ThreadPool(max(args.jobs, 1))
+    failed = 0
+    try:
+        for (binary, build_id, machine, _), path, cached, error in \
+                pool.imap_unordered(run_job, jobs):
+            if error is not None:
+                print('%s: %s' % (machine, error), file=sys.stderr)
+                failed += 1
+                continue
+            print('%s %s %s%s' % (','.join(labels[build_id]), machine, path,
+                                  ' (cached)' if cached else ''))
+            if args.output:
+                for label in labels[build_id]:
+                    name = '%s_%s.json' % (label, machine)
+                    with gzip.open(path, 'rb') as src:
+                        with open(os.path.join(args.output, name), 'wb') as dst:
+                            shutil.copyfileobj(src, dst)
+    finally:
+        pool.close()
+        pool.join()
+    return 1 if failed else 0
+
+if __name__ == '__main__':
+    sys.exit(main())
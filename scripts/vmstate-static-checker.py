@@ -22,7 +22,13 @@
 from __future__ import print_function
 import argparse
 import json
+import multiprocessing
+import os
 import sys
+try:
+    from StringIO import StringIO
+except ImportError:
+    from io import StringIO
 
 # Count the number of errors found
 taint = 0
@@ -279,13 +285,25 @@ def check_fields(src_fields, dest_fields, desc, sec):
         check_description_in_list(s_item, d_item, sec, desc)
 
 
+# Subsections of a description, indexed by name.  Dumps are compared
+# many times over in matrix mode, so the index is built only once.
+subsection_index = {}
+
+def index_subsections(subsections):
+    key = id(subsections)
+    if key not in subsection_index:
+        index = {}
+        for item in subsections:
+            index.setdefault(item["name"], []).append(item)
+        subsection_index[key] = (subsections, index)
+    return subsection_index[key][1]
+
+
 def check_subsections(src_sub, dest_sub, desc, sec):
+    dest_index = index_subsections(dest_sub)
     for s_item in src_sub:
         found = False
-        for d_item in dest_sub:
-            if s_item["name"] != d_item["name"]:
-                continue
-
+        for d_item in dest_index.get(s_item["name"], []):
             found = True
             check_descriptions(s_item, d_item, sec)
 
@@ -371,29 +389,7 @@ def check_machine_type(s, d):
     return
 
 
-def main():
-    help_text = "Parse JSON-formatted vmstate dumps from QEMU in files SRC and DEST.  Checks whether migration from SRC to DEST QEMU versions would break based on the VMSTATE information contained within the JSON outputs.  The JSON output is created from a QEMU invocation with the -dump-vmstate parameter and a filename argument to it.  Other parameters to QEMU do not matter, except the -M (machine type) parameter."
-
-    parser = argparse.ArgumentParser(description=help_text)
-    parser.add_argument('-s', '--src', type=file, required=True,
-                        help='json dump from src qemu')
-    parser.add_argument('-d', '--dest', type=file, required=True,
-                        help='json dump from dest qemu')
-    parser.add_argument('--reverse', required=False, default=False,
-                        action='store_true',
-                        help='reverse the direction')
-    args = parser.parse_args()
-
-    src_data = json.load(args.src)
-    dest_data = json.load(args.dest)
-    args.src.close()
-    args.dest.close()
-
-    if args.reverse:
-        temp = src_data
-        src_data = dest_data
-        dest_data = temp
-
+def check_dumps(src_data, dest_data):
     for sec in src_data:
         dest_sec = sec
         if not dest_sec in dest_data:
@@ -424,6 +420,134 @@ def main():
             if entry == "Description":
                 check_descriptions(s[entry], d[entry], sec)
 
+
+# Dumps loaded by the matrix mode, keyed by name
+matrix_dumps = {}
+
+def set_matrix_dumps(dumps):
+    matrix_dumps.update(dumps)
+
+
+def check_pair(pair):
+    # Findings are printed piecemeal, so capture them and split them
+    # into lines afterwards.
+    global taint
+
+    src, dest = pair
+    taint = 0
+    old_stdout = sys.stdout
+    sys.stdout = StringIO()
+    try:
+        check_dumps(matrix_dumps[src], matrix_dumps[dest])
+        output = sys.stdout.getvalue()
+    finally:
+        sys.stdout = old_stdout
+    return pair, taint, [line.strip() for line in output.splitlines()]
+
+
+def dump_name(filename):
+    return os.path.splitext(os.path.basename(filename))[0]
+
+
+def check_matrix(args):
+    dumps = {}
+    for filename in args.matrix:
+        name = dump_name(filename)
+        if name in dumps:
+            print("Duplicate dump name \"" + name + "\"")
+            return 255
+        with open(filename) as f:
+            dumps[name] = json.load(f)
+
+    if args.pair:
+        pairs = []
+        for pair in args.pair:
+            src, _, dest = pair.partition(':')
+            if src not in dumps or dest not in dumps:
+                print("Unknown dump in pair \"" + pair + "\"")
+                return 255
+            pairs.append((src, dest))
+    else:
+        names = sorted(dumps)
+        pairs = [(s, d) for s in names for d in names if s != d]
+
+    set_matrix_dumps(dumps)
+    if args.jobs > 1 and len(pairs) > 1:
+        pool = multiprocessing.Pool(args.jobs, set_matrix_dumps, (dumps,))
+        try:
+            results = pool.map(check_pair, pairs)
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        results = [check_pair(pair) for pair in pairs]
+
+    # The same problem usually shows up for many pairs; report each
+    # finding once, with the pairs it affects.
+    findings = {}
+    order = []
+    print("Pair results:")
+    for (src, dest), pair_taint, lines in results:
+        print("  " + src + " -> " + dest + ":", end=' ')
+        print("ok" if pair_taint == 0 else "%d error(s)" % pair_taint)
+        for line in lines:
+            if line not in findings:
+                findings[line] = []
+                order.append(line)
+            findings[line].append(src + " -> " + dest)
+
+    if order:
+        print()
+        print("Findings:")
+    for line in order:
+        print(line)
+        print("    in " + ", ".join(findings[line]))
+
+    errors = len([line for line in order if not line.startswith("Warning")])
+    return min(errors, 255)
+
+
+def main():
+    help_text = "Parse JSON-formatted vmstate dumps from QEMU in files SRC and DEST.  Checks whether migration from SRC to DEST QEMU versions would break based on the VMSTATE information contained within the JSON outputs.  The JSON output is created from a QEMU invocation with the -dump-vmstate parameter and a filename argument to it.  Other parameters to QEMU do not matter, except the -M (machine type) parameter."
+
+    parser = argparse.ArgumentParser(description=help_text)
+    parser.add_argument('-s', '--src', type=argparse.FileType('r'),
+                        help='json dump from src qemu')
+    parser.add_argument('-d', '--dest', type=argparse.FileType('r'),
+                        help='json dump from dest qemu')
+    parser.add_argument('--reverse', required=False, default=False,
+                        action='store_true',
+                        help='reverse the direction')
+    parser.add_argument('-m', '--matrix', nargs='+', metavar='DUMP',
+                        help='check migration between many json dumps, '
+                        'named after their file name, and print a single '
+                        'report')
+    parser.add_argument('-p', '--pair', action='append', metavar='SRC:DEST',
+                        help='in matrix mode, pair of dumps to check; can be '
+                        'repeated (default: all pairs, in both directions)')
+    parser.add_argument('-j', '--jobs', type=int,
+                        default=multiprocessing.cpu_count(),
+                        help='in matrix mode, number of pairs checked in '
+                        'parallel')
+    args = parser.parse_args()
+
+    if args.matrix:
+        return check_matrix(args)
+    if not args.src or not args.dest:
+        parser.error('--src and --dest are required')
+
+    src_data = json.load(args.src)
+    dest_data = json.load(args.dest)
+    args.src.close()
+    args.dest.close()
+
+    if args.reverse:
+        temp = src_data
+        src_data = dest_data
+        dest_data = temp
+
+    check_dumps(src_data, dest_data)
+
     return taint
 
 